@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class TdmsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'TDMS'
+
+    def ready(self):
+        from TDMS import signals  # noqa: F401
@@ -0,0 +1,87 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+
+from TDMS.metrics import audit_log_queue
+
+logger = logging.getLogger(__name__)
+
+
+class LogSink:
+    """
+    Process-wide queue of unsaved `Log` rows, written with one `bulk_create` per batch.
+
+    Rows are flushed when `AUDIT_LOG_BATCH_SIZE` rows are queued, and otherwise after the
+    response has been sent (`TDMS.middleware.AuditLogMiddleware`) once the oldest queued
+    row is `AUDIT_LOG_FLUSH_INTERVAL` seconds old, plus once more at interpreter exit.
+    With `AUDIT_LOG_STRICT`, for deployments that need every row written before the response
+    is sent, each row is saved right away, inside the request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = []
+        self._oldest = None
+
+    @property
+    def strict(self):
+        return getattr(settings, 'AUDIT_LOG_STRICT', False)
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'AUDIT_LOG_BATCH_SIZE', 100)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'AUDIT_LOG_FLUSH_INTERVAL', 0.0)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def add(self, log):
+        logger.info('%s', log)
+        if self.strict:
+            log.save()
+            return
+        with self._lock:
+            if not self._queue:
+                self._oldest = time.monotonic()
+            self._queue.append(log)
+            full = len(self._queue) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush_if_due(self):
+        if self._queue and time.monotonic() - self._oldest >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            batch, self._queue = self._queue, []
+        if not batch:
+            return
+        try:
+            with transaction.atomic():
+                apps.get_model('TDMS.Log').objects.bulk_create(batch, batch_size=self.batch_size)
+        except Exception:
+            logger.exception('Could not write %d audit log rows at once, saving them one by one', len(batch))
+            # One bad row, e.g. for a user deleted meanwhile, must not lose the others
+            for log in batch:
+                # Drop a primary key set by a batch that was rolled back
+                log.pk = None
+                log._state.adding = True
+                try:
+                    with transaction.atomic():
+                        log.save()
+                except Exception:
+                    logger.exception('Could not write audit log row: %s', log)
+
+
+log_sink = LogSink()
+atexit.register(log_sink.flush)
+audit_log_queue.set_function(lambda: len(log_sink))
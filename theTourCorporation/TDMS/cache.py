@@ -0,0 +1,103 @@
+import hashlib
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+
+from TDMS.metrics import cache_lookups
+
+
+class VersionedCache:
+    """
+    Results cached in a Django cache (`SEARCH_CACHE_ALIAS`), under keys that embed version counters.
+
+    Nothing is ever deleted: bumping a counter (see `TDMS.signals`) makes every key built from
+    the old value unreachable, and the backend's own `MAX_ENTRIES` culling and `TIMEOUT`
+    evict those entries. Results may live in a per-process cache, but the counters must be
+    in one every worker process shares (`SEARCH_CACHE_VERSION_ALIAS`, a database cache by
+    default), or a bump would only invalidate the process that made the write. A lost
+    counter reads as a new version, which only costs misses.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._lookups = Counter()
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'SEARCH_CACHE_ALIAS', 'default')]
+
+    @property
+    def versions(self):
+        return caches[getattr(settings, 'SEARCH_CACHE_VERSION_ALIAS', 'default')]
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'SEARCH_CACHE_TIMEOUT', 300)
+
+    def _version_key(self, name):
+        return f'{self.prefix}:version:{name}'
+
+    def version(self, name):
+        key = self._version_key(name)
+        version = self.versions.get(key)
+        if version is None:
+            # Start past any value an evicted counter could have reached, so old keys stay unreachable
+            self.versions.add(key, time.time_ns(), None)
+            version = self.versions.get(key)
+        return version
+
+    def bump(self, name):
+        """Invalidate every entry built with the counter `name`."""
+        try:
+            self.versions.incr(self._version_key(name))
+        except ValueError:
+            # Not set yet: nothing cached under it can be stale
+            pass
+
+    def key(self, versions, parts):
+        found = self.versions.get_many([self._version_key(name) for name in versions])
+        current = tuple((name, found.get(self._version_key(name)) or self.version(name)) for name in versions)
+        raw = repr((current, parts))
+        return f'{self.prefix}:{hashlib.sha1(raw.encode()).hexdigest()}'
+
+    def get_or_set(self, versions, parts, compute, kind='search', key=None):
+        """
+        Cached `compute()` for the key `parts`, valid until one of the `versions` counters is bumped.
+        Hits and misses are counted per `kind` of result. A `key` already built from the same
+        `versions` and `parts` saves reading the counters again.
+        """
+        if key is None:
+            key = self.key(versions, parts)
+        value = self.cache.get(key)
+        result = 'miss' if value is None else 'hit'
+        with self._lock:
+            self._lookups[kind, result] += 1
+        cache_lookups.inc(cache=self.prefix, kind=kind, result=result)
+        if value is None:
+            value = compute()
+            self.cache.set(key, value, self.timeout)
+        return value
+
+    def stats(self, kind='search'):
+        """Hits and misses of `kind` results in this process since it started."""
+        with self._lock:
+            hits, misses = self._lookups[kind, 'hit'], self._lookups[kind, 'miss']
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+        }
+
+
+search_cache = VersionedCache('tdms:search')
+
+LOCATIONS_VERSION = 'locations'
+
+
+def bookmarks_version(user_id):
+    return f'bookmarks:{user_id}'
+
@@ -0,0 +1,59 @@
+import csv
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+FORMATS = {
+    'geojson': 'application/geo+json',
+    'csv': 'text/csv',
+}
+
+
+def chunk_size():
+    return getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+
+
+class _Echo:
+    """File-like object whose `write` hands the line back, so `csv.writer` can feed a generator."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows, columns):
+    """Header line, then one CSV line per `values()` row."""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow([row[column] for column in columns])
+
+
+def geojson_lines(rows, properties, point=None):
+    """
+    A FeatureCollection, one feature per line. `point` maps a row to its `(lat, lng)`;
+    without it features have no geometry.
+    """
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    yield '{"type":"FeatureCollection","features":[\n'
+    separator = ''
+    for row in rows:
+        geometry = None
+        if point is not None:
+            lat, lng = point(row)
+            geometry = {'type': 'Point', 'coordinates': [lng, lat]}
+        feature = {'type': 'Feature', 'geometry': geometry, 'properties': {key: row[key] for key in properties}}
+        yield separator + encoder.encode(feature)
+        separator = ',\n'
+    yield '\n]}\n'
+
+
+def export_lines(rows, columns, file_format, point=None):
+    """
+    Lines of a CSV or GeoJSON export of the `values()` queryset `rows`, read in chunks of
+    `EXPORT_CHUNK_SIZE` rows so memory stays flat. `point` gives GeoJSON features a geometry.
+    """
+    rows = rows.iterator(chunk_size=chunk_size())
+    if file_format == 'csv':
+        return csv_lines(rows, columns)
+    return geojson_lines(rows, columns, point)
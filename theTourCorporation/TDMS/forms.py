@@ -1,6 +1,7 @@
 from django import forms
 # from django.contrib.auth.forms import UserCreationForm
-from .models import Account, ROLE, Location
+from django.contrib.contenttypes.models import ContentType
+from .models import Account, ACTION, ROLE, STATUS, Location
 
 class RegistrationForm(forms.ModelForm):
     email = forms.EmailField(
@@ -68,4 +69,64 @@ class PasswordResetForm(forms.Form):
         max_length=11, 
         required=True,
         widget=forms.TextInput(attrs={'class': 'form-control'})
-    )
\ No newline at end of file
+    )
+
+class LogFilterForm(forms.Form):
+    user = forms.ModelChoiceField(
+        queryset=Account.objects.order_by('username'),
+        to_field_name='username',
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-control'})
+    )
+    action = forms.ChoiceField(
+        choices=[('', '---------')] + ACTION.choices,
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-control'})
+    )
+    content_type = forms.ModelChoiceField(
+        queryset=ContentType.objects.filter(app_label='TDMS').order_by('model'),
+        to_field_name='model',
+        label='Object type',
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-control'})
+    )
+    object_id = forms.IntegerField(
+        label='Object ID',
+        min_value=0,
+        required=False,
+        widget=forms.NumberInput(attrs={'class': 'form-control'})
+    )
+    date_from = forms.DateField(
+        label='From',
+        required=False,
+        widget=forms.DateInput(attrs={'class': 'form-control', 'type': 'date'})
+    )
+    date_to = forms.DateField(
+        label='To',
+        required=False,
+        widget=forms.DateInput(attrs={'class': 'form-control', 'type': 'date'})
+    )
+
+
+class PlanFilterForm(forms.Form):
+    status = forms.ChoiceField(
+        choices=[('', '---------')] + STATUS.choices,
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-control'})
+    )
+    operator = forms.ModelChoiceField(
+        queryset=Account.objects.order_by('username'),
+        to_field_name='username',
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-control'})
+    )
+    created_from = forms.DateField(
+        label='Created from',
+        required=False,
+        widget=forms.DateInput(attrs={'class': 'form-control', 'type': 'date'})
+    )
+    created_to = forms.DateField(
+        label='Created to',
+        required=False,
+        widget=forms.DateInput(attrs={'class': 'form-control', 'type': 'date'})
+    )
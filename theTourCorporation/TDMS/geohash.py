@@ -0,0 +1,68 @@
+import numpy as np
+
+from TDMS.spatial import EARTH_RADIUS_METERS
+
+BASE32 = np.array(list('0123456789bcdefghjkmnpqrstuvwxyz'))
+GEOHASH_PRECISION = 9
+
+# Cell height and width in degrees for every precision, index 0 unused
+_BITS = np.arange(13) * 5
+CELL_HEIGHT = 180 / 2.0 ** (_BITS // 2)
+CELL_WIDTH = 360 / 2.0 ** ((_BITS + 1) // 2)
+
+
+def encode(lat, lng, precision=GEOHASH_PRECISION):
+    """Geohash of every `(lat, lng)`, vectorized; scalars give a single string."""
+    scalar = np.ndim(lat) == 0
+    lat = np.atleast_1d(np.asarray(lat, dtype=float))
+    lng = np.atleast_1d(np.asarray(lng, dtype=float))
+    bits = 5 * precision
+    lng_bits, lat_bits = (bits + 1) // 2, bits // 2
+    # Integer cell coordinates on each axis, clipped so the last edge stays in the last cell
+    x = np.clip(np.floor((lng + 180) / 360 * 2.0 ** lng_bits), 0, 2 ** lng_bits - 1).astype(np.int64)
+    y = np.clip(np.floor((lat + 90) / 180 * 2.0 ** lat_bits), 0, 2 ** lat_bits - 1).astype(np.int64)
+
+    # Interleave: even bits (from the most significant) are longitude, odd bits latitude
+    code = np.zeros(len(lat), dtype=np.int64)
+    for i in range(bits):
+        if i % 2 == 0:
+            bit = (x >> (lng_bits - 1 - i // 2)) & 1
+        else:
+            bit = (y >> (lat_bits - 1 - i // 2)) & 1
+        code = (code << 1) | bit
+    chars = BASE32[(code[:, None] >> (5 * np.arange(precision - 1, -1, -1))) & 0x1f]
+    hashes = [''.join(row) for row in chars]
+    return hashes[0] if scalar else hashes
+
+
+def precision_for_radius(radius_meters):
+    """Longest precision whose cells are at least `radius_meters` tall and wide at the equator, or 0."""
+    meters_per_degree = np.pi * EARTH_RADIUS_METERS / 180
+    fits = np.flatnonzero(np.minimum(CELL_HEIGHT, CELL_WIDTH)[1:] * meters_per_degree >= radius_meters)
+    return int(fits[-1]) + 1 if len(fits) else 0
+
+
+def covering_cells(lat, lng, radius_meters):
+    """
+    Geohash prefixes whose cells together cover the circle: the cell of `(lat, lng)` and its
+    neighbours, at a precision with cells larger than the radius. `None` if the circle is
+    too large for any precision.
+    """
+    precision = precision_for_radius(radius_meters / max(np.cos(np.radians(lat)), 1e-6))
+    if precision == 0:
+        return None
+    dlat, dlng = CELL_HEIGHT[precision], CELL_WIDTH[precision]
+    lats = np.clip(lat + np.array([-dlat, 0, dlat]), -90, 90)
+    lngs = (lng + np.array([-dlng, 0, dlng]) + 180) % 360 - 180
+    grid_lat, grid_lng = np.meshgrid(lats, lngs)
+    return sorted(set(encode(grid_lat.ravel(), grid_lng.ravel(), precision)))
+
+
+def prefix_range(prefix):
+    """`(start, stop)` such that `start <= geohash < stop` for every geohash starting with `prefix`;
+    `stop` is `None` past the last cell. Range filters use a plain B-tree index in any collation."""
+    alphabet = ''.join(BASE32)
+    stop = prefix.rstrip(alphabet[-1])
+    if not stop:
+        return prefix, None
+    return prefix, stop[:-1] + alphabet[alphabet.index(stop[-1]) + 1]
@@ -0,0 +1,231 @@
+import numpy as np
+
+from TDMS.spatial import EARTH_RADIUS_METERS
+
+POLYLINE_PRECISION = 5
+
+# Douglas-Peucker tolerances, in meters, precomputed for every stored route.
+# Each one is 4x the previous, about two map zoom levels apart.
+ROUTE_LEVEL_TOLERANCES = [5, 20, 80, 320, 1280]
+
+# Web Mercator ground resolution at zoom 0 on the equator, in meters per pixel
+METERS_PER_PIXEL_AT_ZOOM_0 = 156543.03
+# Web Mercator maps stop at this latitude
+MAX_MERCATOR_LAT = 85.05112878
+
+
+def encode_polyline(coords, precision=POLYLINE_PRECISION):
+    """Encode `(lat, lng)` pairs with the Google polyline algorithm, vectorized."""
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    if len(coords) == 0:
+        return ''
+    scaled = np.round(coords * 10 ** precision).astype(np.int64)
+    deltas = np.diff(scaled, axis=0, prepend=0).ravel()
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+
+    # Split every value into 5-bit chunks, least significant first; 7 chunks fit 35 bits
+    shifts = np.arange(7) * 5
+    chunks = (values[:, None] >> shifts) & 0x1f
+    lengths = 1 + (values[:, None] >= (1 << shifts[1:])).sum(axis=1)
+    used = np.arange(7) < lengths[:, None]
+    more = np.arange(7) < (lengths - 1)[:, None]
+    chars = (chunks | np.where(more, 0x20, 0)) + 63
+    return chars[used].astype(np.uint8).tobytes().decode('ascii')
+
+
+def decode_polyline(polyline, precision=POLYLINE_PRECISION):
+    """Inverse of `encode_polyline`, returns an `(n, 2)` array of `(lat, lng)`."""
+    if not polyline:
+        return np.empty((0, 2))
+    data = np.frombuffer(polyline.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    ends = np.flatnonzero(data < 0x20)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    # Position of every byte inside its value, to shift its 5 bits into place
+    value_index = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    position = np.arange(len(data)) - starts[value_index]
+    values = np.bincount(value_index, weights=((data & 0x1f) << (5 * position)).astype(float)).astype(np.int64)
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1)
+    return np.cumsum(deltas.reshape(-1, 2), axis=0) / 10 ** precision
+
+
+def path_lengths(paths):
+    """Haversine length in meters of every `(lat, lng)` path in `paths`, in one vectorized pass."""
+    paths = [np.asarray(path, dtype=float).reshape(-1, 2) for path in paths]
+    sizes = np.array([len(path) for path in paths], dtype=np.int64)
+    if sizes.sum() < 2:
+        return np.zeros(len(paths))
+    points = np.radians(np.concatenate(paths))
+    dlat = np.diff(points[:, 0])
+    dlng = np.diff(points[:, 1])
+    h = np.sin(dlat / 2) ** 2 + np.cos(points[:-1, 0]) * np.cos(points[1:, 0]) * np.sin(dlng / 2) ** 2
+    steps = 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+    # Drop the steps that jump from the end of one path to the start of the next
+    owner = np.repeat(np.arange(len(paths)), sizes)
+    steps[owner[1:] != owner[:-1]] = 0
+    return np.bincount(owner[1:], weights=steps, minlength=len(paths))
+
+
+def route_coordinates(route):
+    """`(n, 2)` array of a Leaflet route's points, whether stored verbose or as a polyline."""
+    if 'coordinates' in route:
+        return np.array([(point['lat'], point['lng']) for point in route['coordinates']], dtype=float).reshape(-1, 2)
+    return decode_polyline(route.get('polyline', ''))
+
+
+def _local_meters(coords):
+    """Equirectangular projection around the mean latitude, accurate enough at route scale."""
+    lat0 = np.radians(coords[:, 0].mean())
+    return np.radians(coords[:, ::-1]) * EARTH_RADIUS_METERS * np.array([np.cos(lat0), 1.0])
+
+
+def _segment_distances(points, start, end):
+    """Distance of every point in `points` to the segment `start`-`end`."""
+    direction = end - start
+    length = direction @ direction
+    if length == 0:
+        return np.hypot(*(points - start).T)
+    t = np.clip((points - start) @ direction / length, 0, 1)
+    return np.hypot(*(points - (start + t[:, None] * direction)).T)
+
+
+def douglas_peucker_significance(coords, min_tolerance=0.0):
+    """
+    For every `(lat, lng)` point, the largest Douglas-Peucker tolerance in meters at which it
+    is still kept: simplifying at tolerance `t` keeps exactly the points whose value is > `t`.
+    One pass gives every level, recursion stops below `min_tolerance`.
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    significance = np.zeros(len(coords))
+    if len(coords) == 0:
+        return significance
+    significance[[0, -1]] = np.inf
+    points = _local_meters(coords)
+
+    stack = [(0, len(coords) - 1, np.inf)]
+    while stack:
+        start, end, parent = stack.pop()
+        if end - start < 2:
+            continue
+        distances = _segment_distances(points[start + 1:end], points[start], points[end])
+        split = start + 1 + int(np.argmax(distances))
+        # A point can only survive a tolerance its enclosing split also survived
+        value = min(distances[split - start - 1], parent)
+        if value <= min_tolerance:
+            continue
+        significance[split] = value
+        stack.append((start, split, value))
+        stack.append((split, end, value))
+    return significance
+
+
+def tolerance_for_zoom(zoom, lat=0.0):
+    """Size of one map pixel in meters at `zoom`, a tolerance that simplifies invisibly."""
+    return METERS_PER_PIXEL_AT_ZOOM_0 * np.cos(np.radians(lat)) / 2 ** zoom
+
+
+def pixel_cells(coords, zoom, cell_pixels):
+    """Web Mercator grid cell `(x, y)`, `cell_pixels` wide, of every `(lat, lng)` at map `zoom`."""
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    lat = np.radians(np.clip(coords[:, 0], -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT))
+    scale = 256 * 2 ** zoom / cell_pixels
+    x = (coords[:, 1] + 180) / 360 * scale
+    y = (1 - np.log(np.tan(np.pi / 4 + lat / 2)) / np.pi) / 2 * scale
+    return np.floor(x).astype(np.int64), np.floor(y).astype(np.int64)
+
+
+def view_pixels(south, west, north, east, zoom):
+    """Screen `(width, height)` in pixels of a box at map `zoom`; `west > east` crosses the antimeridian."""
+    width = east - west if west <= east else east - west + 360
+    x, y = pixel_cells([[north, 0], [south, 0]], zoom, 1)
+    return width / 360 * 256 * 2 ** zoom, float(y[1] - y[0])
+
+
+def grid_clusters(coords, zoom, cell_pixels=60, min_count=2):
+    """
+    Group `(lat, lng)` points into square screen cells at map `zoom`.
+    Returns `(singles, clusters)`: indices of the points left on their own, in cells with fewer
+    than `min_count` points, and one `(lat, lng, count, south, west, north, east)` row per
+    other cell, placed at the mean of its points.
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    if len(coords) == 0:
+        return np.empty(0, dtype=np.int64), np.empty((0, 7))
+    x, y = pixel_cells(coords, zoom, cell_pixels)
+    _, cell, counts = np.unique(np.stack([x, y], axis=1), axis=0, return_inverse=True, return_counts=True)
+    cell = cell.ravel()
+    singles = np.flatnonzero(counts[cell] < min_count)
+
+    lat = np.bincount(cell, weights=coords[:, 0]) / counts
+    lng = np.bincount(cell, weights=coords[:, 1]) / counts
+    south = np.full(len(counts), np.inf)
+    west = np.full(len(counts), np.inf)
+    north = np.full(len(counts), -np.inf)
+    east = np.full(len(counts), -np.inf)
+    np.minimum.at(south, cell, coords[:, 0])
+    np.minimum.at(west, cell, coords[:, 1])
+    np.maximum.at(north, cell, coords[:, 0])
+    np.maximum.at(east, cell, coords[:, 1])
+    clusters = np.stack([lat, lng, counts, south, west, north, east], axis=1)
+    return singles, clusters[counts >= min_count]
+
+
+def _route_levels(coords):
+    significance = douglas_peucker_significance(coords, min(ROUTE_LEVEL_TOLERANCES))
+    return {str(tolerance): encode_polyline(coords[significance > tolerance]) for tolerance in ROUTE_LEVEL_TOLERANCES}
+
+
+def compact_route_data(route_data):
+    """
+    Replace the verbose `coordinates` of every Leaflet route with an encoded `polyline`,
+    and add its simplified `levels`, one polyline per `ROUTE_LEVEL_TOLERANCES` entry.
+    """
+    if not route_data:
+        return route_data
+    compact = []
+    for route in route_data:
+        if 'coordinates' in route:
+            route = dict(route)
+            coords = np.array([(point['lat'], point['lng']) for point in route.pop('coordinates')], dtype=float).reshape(-1, 2)
+            route['polyline'] = encode_polyline(coords)
+            route['levels'] = _route_levels(coords)
+        elif 'polyline' in route and 'levels' not in route:
+            route = dict(route, levels=_route_levels(decode_polyline(route['polyline'])))
+        compact.append(route)
+    return compact
+
+
+def select_route_level(route_data, tolerance=None, zoom=None):
+    """
+    Drop the stored `levels` of every route, replacing its `polyline` with the most simplified
+    level within `tolerance` meters, or within one pixel at `zoom`. Full detail by default.
+    """
+    if not route_data:
+        return route_data
+    selected = []
+    for route in route_data:
+        route = dict(route)
+        levels = route.pop('levels', None) or {}
+        limit = tolerance
+        if zoom is not None:
+            waypoints = route.get('waypoints') or [{}]
+            lat = waypoints[0].get('latLng', {}).get('lat', 0.0)
+            limit = tolerance_for_zoom(zoom, lat)
+        usable = [level for level in levels if limit is not None and float(level) <= limit]
+        if usable:
+            route['polyline'] = levels[max(usable, key=float)]
+        selected.append(route)
+    return selected
+
+
+def expand_route_data(route_data):
+    """Inverse of `compact_route_data`, for clients that expect `coordinates` lists."""
+    if not route_data:
+        return route_data
+    verbose = []
+    for route in route_data:
+        if 'polyline' in route:
+            route = dict(route)
+            coords = decode_polyline(route.pop('polyline'))
+            route['coordinates'] = [{'lat': lat, 'lng': lng} for lat, lng in coords.tolist()]
+        verbose.append(route)
+    return verbose
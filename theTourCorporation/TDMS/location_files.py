@@ -0,0 +1,112 @@
+import csv
+import json
+
+GEOJSON_CHUNK_SIZE = 1 << 16
+# Longest first line read to tell GeoJSONSeq files from FeatureCollections
+GEOJSON_MAX_LINE = 1 << 20
+
+
+def read_csv(file):
+    """Rows of a CSV file with a header line, as dicts, one at a time."""
+    yield from csv.DictReader(file)
+
+
+def _feature_to_row(feature):
+    """Flatten a GeoJSON Point feature into a `Location.JSON_FIELDS` dict."""
+    row = dict(feature.get('properties') or {})
+    geometry = feature.get('geometry') or {}
+    if geometry.get('type') == 'Point':
+        # GeoJSON positions are (longitude, latitude)
+        row['lng'], row['lat'] = geometry['coordinates'][:2]
+    return row
+
+
+def _iter_array(file, decoder, buffer, position):
+    """Decode the values of the JSON array opened at `buffer[position - 1]`, reading more as needed."""
+    while True:
+        while True:
+            position = _skip(buffer, position, ' \t\r\n,')
+            if position < len(buffer):
+                break
+            chunk = file.read(GEOJSON_CHUNK_SIZE)
+            if not chunk:
+                raise ValueError('Unexpected end of GeoJSON file')
+            buffer, position = buffer[position:] + chunk, 0
+        if buffer[position] == ']':
+            return
+        try:
+            value, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            chunk = file.read(GEOJSON_CHUNK_SIZE)
+            if not chunk:
+                raise
+            # The value runs past the buffer, keep only what is left of it
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        yield value
+        position = end
+
+
+def _skip(buffer, position, characters):
+    while position < len(buffer) and buffer[position] in characters:
+        position += 1
+    return position
+
+
+def _read_feature_lines(file, buffer):
+    *lines, rest = buffer.split('\n')
+    for line in lines:
+        if line.strip():
+            yield _feature_to_row(json.loads(line.lstrip('\x1e')))
+    for line in file:
+        line, rest = rest + line, ''
+        if line.strip():
+            yield _feature_to_row(json.loads(line.lstrip('\x1e')))
+    if rest.strip():
+        yield _feature_to_row(json.loads(rest.lstrip('\x1e')))
+
+
+def read_geojson(file):
+    """
+    Point features of a GeoJSON FeatureCollection, as `Location.JSON_FIELDS` dicts.
+    Features are decoded one at a time, so the file is never loaded whole.
+    Newline-delimited files with one feature per line (GeoJSONSeq) are read too.
+    """
+    decoder = json.JSONDecoder()
+    buffer = file.read(GEOJSON_CHUNK_SIZE).lstrip('\ufeff')
+    while '\n' not in buffer and len(buffer) < GEOJSON_MAX_LINE:
+        chunk = file.read(GEOJSON_CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer += chunk
+    first_line = buffer.split('\n', 1)[0]
+    try:
+        is_sequence = json.loads(first_line.lstrip('\x1e')).get('type') == 'Feature'
+    except (ValueError, AttributeError):
+        is_sequence = False
+    if is_sequence:
+        yield from _read_feature_lines(file, buffer)
+        return
+
+    while True:
+        key = buffer.find('"features"')
+        if key != -1:
+            opening = _skip(buffer, key + len('"features"'), ' \t\r\n:')
+            if opening < len(buffer):
+                if buffer[opening] != '[':
+                    raise ValueError('GeoJSON "features" is not an array')
+                break
+        chunk = file.read(GEOJSON_CHUNK_SIZE)
+        if not chunk:
+            raise ValueError('No "features" array in GeoJSON file')
+        buffer += chunk
+
+    for feature in _iter_array(file, decoder, buffer, opening + 1):
+        yield _feature_to_row(feature)
+
+
+READERS = {
+    'csv': read_csv,
+    'geojson': read_geojson,
+    'json': read_geojson,
+}
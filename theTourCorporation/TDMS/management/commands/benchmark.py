@@ -0,0 +1,324 @@
+import json
+import platform
+import sqlite3
+import subprocess
+import time
+from datetime import timedelta
+
+import django
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import setup_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from TDMS.cache import search_cache
+from TDMS.geometry import compact_route_data
+from TDMS.models import ACTION, ROLE, STATUS, Account, Bookmark, Location, Log, Note, Plan
+from TDMS.spatial import location_index
+
+# Seeded data spreads over roughly a 50 km square around Ho Chi Minh City, over the last year
+SOUTH, WEST, SIZE = 10.55, 106.45, 0.45
+HISTORY_DAYS = 365
+ROUTE_POOL_SIZE = 200
+NAME_WORDS = ['Cafe', 'Pho', 'Museum', 'Park', 'Market', 'Hotel', 'Temple', 'Bridge', 'Gallery', 'Restaurant',
+              'Tower', 'Garden', 'Pagoda', 'Theatre', 'Bakery', 'Harbor', 'Church', 'Square', 'Bistro', 'Station']
+STREETS = ['Le Loi', 'Nguyen Hue', 'Hai Ba Trung', 'Dong Khoi', 'Pasteur', 'Ly Tu Trong', 'Vo Van Tan', 'Tran Hung Dao']
+LOCATION_TYPES = ['restaurant', 'hotel', 'attraction', 'shopping', 'transport', None]
+SEARCH_QUERIES = ['cafe', 'pho market', 'museum', 'le loi', 'temple 12', 'garden', 'hotel district 3', 'bri']
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed synthetic locations, users, bookmarks, notes, plans and logs into a local SQLite database, '
+        'then time the main lookups and views and write the results as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--locations', type=int, default=100_000)
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--bookmarks', type=int, default=200_000)
+        parser.add_argument('--notes', type=int, default=100_000)
+        parser.add_argument('--plans', type=int, default=20_000)
+        parser.add_argument('--logs', type=int, default=1_000_000)
+        parser.add_argument('--runs', type=int, default=20, help='Timed runs per benchmark, after one warm-up run.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per bulk insert while seeding.')
+        parser.add_argument('--reseed', action='store_true', help='Flush the database and seed it again.')
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError(
+                'The benchmark seeds millions of rows, run it on SQLite: --settings=theTourCorporation.settings_benchmark')
+        call_command('migrate', verbosity=0)
+        call_command('createcachetable', verbosity=0)
+        if options['reseed']:
+            call_command('flush', interactive=False, verbosity=0)
+        self.rng = np.random.default_rng(options['seed'])
+        self.batch_size = options['batch_size']
+        if Location.objects.exists():
+            self.stdout.write('Reusing the seeded data, pass --reseed to start over')
+        else:
+            self.seed(options)
+
+        # Allows the test client's host
+        setup_test_environment()
+        results = self.run_benchmarks(options['runs'])
+        report = {
+            'commit': git_commit(),
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'seed': options['seed'],
+            'runs': options['runs'],
+            'rows': {model.__name__: model.objects.count() for model in (Account, Location, Bookmark, Note, Plan, Log)},
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(report, file, indent=2)
+            self.stdout.write(f'Wrote {options["output"]}')
+
+    # Seeding
+
+    def seed(self, options):
+        for name, seeder in (('users', self.seed_users), ('locations', self.seed_locations),
+                             ('bookmarks', self.seed_bookmarks), ('notes', self.seed_notes),
+                             ('plans', self.seed_plans), ('logs', self.seed_logs)):
+            start = time.perf_counter()
+            with transaction.atomic():
+                seeder(options[name])
+            self.stdout.write(f'Seeded {options[name]} {name} in {time.perf_counter() - start:.1f} s')
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def bulk_create(self, model, objects):
+        batch = []
+        for obj in objects:
+            batch.append(obj)
+            if len(batch) == self.batch_size:
+                model.objects.bulk_create(batch)
+                batch = []
+        model.objects.bulk_create(batch)
+
+    def spread_dates(self, model, *fields):
+        """Spread the `auto_now` values of `fields` over `HISTORY_DAYS`, newest on the highest ids."""
+        pks = model.objects.order_by('pk').values_list('pk', flat=True)
+        total = pks.count()
+        if not total:
+            return
+        now = timezone.now()
+        step = timedelta(days=HISTORY_DAYS) / total
+        first = pks.first()
+        # One UPDATE per thousand rows: timestamps are only roughly distinct, like real traffic
+        for start in range(0, total, 1000):
+            value = now - step * (total - start)
+            model.objects.filter(pk__gte=first + start, pk__lt=first + start + 1000).update(
+                **{field: value for field in fields})
+
+    def seed_users(self, count):
+        # Unusable passwords: hashing them would take longer than the rest of the seeding
+        password = make_password(None)
+        self.bulk_create(Account, (
+            Account(username=f'bench{i}', email=f'bench{i}@example.com', ssn=f'{i:09d}', password=password,
+                    full_name=f'Benchmark User {i}', user_role=ROLE.OWNER if i == 0 else ROLE.TOUROP)
+            for i in range(max(count, 1))
+        ))
+        self.user_ids = list(Account.objects.order_by('pk').values_list('pk', flat=True))
+
+    def random_points(self, count):
+        return np.column_stack([SOUTH + self.rng.random(count) * SIZE, WEST + self.rng.random(count) * SIZE])
+
+    def seed_locations(self, count):
+        coords = self.random_points(count)
+        words = self.rng.integers(len(NAME_WORDS), size=(count, 2))
+        streets = self.rng.integers(len(STREETS), size=count)
+        types = self.rng.integers(len(LOCATION_TYPES), size=count)
+        self.bulk_create(Location, (
+            Location(lat=lat, lng=lng, name=f'{NAME_WORDS[a]} {NAME_WORDS[b]} {i}',
+                     address=f'{i % 500 + 1} {STREETS[street]} Street, District {i % 12 + 1}',
+                     location_type=LOCATION_TYPES[kind])
+            for i, ((lat, lng), (a, b), street, kind) in enumerate(zip(coords.tolist(), words.tolist(), streets, types))
+        ))
+        self.spread_dates(Location, 'modified_at')
+        self.location_ids = np.array(Location.objects.order_by('pk').values_list('pk', flat=True))
+
+    def seed_bookmarks(self, count):
+        per_user = min(count // len(self.user_ids), len(self.location_ids))
+        self.bulk_create(Bookmark, (
+            Bookmark(user_id=user_id, location_id=location_id)
+            for user_id in self.user_ids
+            for location_id in self.rng.choice(self.location_ids, per_user, replace=False).tolist()
+        ))
+
+    def seed_notes(self, count):
+        # Skewed like real traffic: a few popular locations get most of the notes
+        popular = self.location_ids[self.rng.zipf(1.5, count) % len(self.location_ids)]
+        authors = self.rng.choice(self.user_ids, count)
+        self.bulk_create(Note, (
+            Note(author_id=author, location_id=location_id, content=f'Synthetic note {i} ' + 'lorem ipsum ' * (i % 20))
+            for i, (author, location_id) in enumerate(zip(authors.tolist(), popular.tolist()))
+        ))
+        self.spread_dates(Note, 'created_at')
+
+    def route_data(self, stops):
+        """A Leaflet Routing Machine route through `stops`, wiggling like a road, stored compact."""
+        coordinates = []
+        for (lat1, lng1), (lat2, lng2) in zip(stops[:-1], stops[1:]):
+            steps = int(self.rng.integers(50, 300))
+            t = np.linspace(0, 1, steps, endpoint=False)
+            wiggle = self.rng.normal(0, 0.0004, (steps, 2)).cumsum(axis=0) * np.sin(np.pi * t)[:, None]
+            leg = np.column_stack([lat1 + (lat2 - lat1) * t, lng1 + (lng2 - lng1) * t]) + wiggle
+            coordinates.extend({'lat': lat, 'lng': lng} for lat, lng in leg.tolist())
+        coordinates.append({'lat': stops[-1][0], 'lng': stops[-1][1]})
+        distance = float(len(coordinates) * 25)
+        return compact_route_data([{
+            'name': f'{STREETS[0]}, {STREETS[1]}',
+            'coordinates': coordinates,
+            'summary': {'totalDistance': distance, 'totalTime': distance / 8},
+            'waypoints': [{'options': {'allowUTurn': False}, 'latLng': {'lat': lat, 'lng': lng}, 'name': ''}
+                          for lat, lng in stops],
+            'inputWaypoints': [{'options': {}, 'latLng': {'lat': lat, 'lng': lng}, 'name': ''} for lat, lng in stops],
+            'waypointIndices': [0, *range(1, len(stops) - 1), len(coordinates) - 1],
+        }]), distance
+
+    def seed_plans(self, count):
+        statuses = STATUS.values
+        coords = dict(zip(self.location_ids.tolist(),
+                          Location.objects.order_by('pk').values_list('lat', 'lng')))
+        # Simplifying a route takes milliseconds, plans share a pool of them instead
+        routes = [
+            self.route_data([coords[pk] for pk in self.rng.choice(self.location_ids, int(self.rng.integers(2, 9))).tolist()])
+            for _ in range(min(count, ROUTE_POOL_SIZE))
+        ]
+
+        def plans():
+            for i in range(count):
+                route_data, distance = routes[i % len(routes)]
+                yield Plan(user_id=self.user_ids[i % len(self.user_ids)], plan_name=f'Plan {i}',
+                           est_distance=distance, est_duration=distance / 8,
+                           status=statuses[i % len(statuses)], route_data=route_data)
+
+        self.bulk_create(Plan, plans())
+        self.spread_dates(Plan, 'created_at', 'updated_at')
+
+    def seed_logs(self, count):
+        content_types = [ContentType.objects.get_for_model(model) for model in (Location, Plan, Account)]
+        users = {pk: username for pk, username in Account.objects.values_list('pk', 'username')}
+        user_ids = self.rng.choice(self.user_ids, count)
+        actions = self.rng.choice(ACTION.values, count)
+        kinds = self.rng.integers(len(content_types), size=count)
+        objects = self.rng.choice(self.location_ids, count)
+        self.bulk_create(Log, (
+            Log(user_id=user_id, username=users[user_id], action=action, content_type=content_types[kind],
+                object_id=object_id, field_name='name' if action == ACTION.UPDATE else None)
+            for user_id, action, kind, object_id in zip(user_ids.tolist(), actions.tolist(), kinds.tolist(), objects.tolist())
+        ))
+        self.spread_dates(Log, 'timestamp')
+
+    # Timing
+
+    def measure(self, name, func, runs):
+        """Time `runs` calls of `func` after a warm-up call, which also counts its queries."""
+        queries = QueryCounter()
+        # Not connection.queries, every request the test client makes clears it
+        with connection.execute_wrapper(queries):
+            func()
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            func()
+            times.append((time.perf_counter() - start) * 1000)
+        result = {
+            'runs': runs,
+            'queries': queries.count,
+            'mean_ms': float(np.mean(times)) if times else None,
+            'median_ms': float(np.median(times)) if times else None,
+            'p95_ms': float(np.percentile(times, 95)) if times else None,
+            'min_ms': float(np.min(times)) if times else None,
+            'max_ms': float(np.max(times)) if times else None,
+        }
+        self.stdout.write(f'{name:<28} {result["median_ms"] or 0:>10.2f} ms {result["p95_ms"] or 0:>10.2f} ms {queries.count:>8}')
+        return result
+
+    def get(self, client, path, params=None):
+        response = client.get(path, params or {})
+        if response.status_code != 200:
+            raise CommandError(f'{path} answered {response.status_code}')
+        # Streamed or not, the body is part of the cost
+        return response.getvalue() if hasattr(response, 'getvalue') else b''.join(response)
+
+    def run_benchmarks(self, runs):
+        client = Client()
+        user = Account.objects.filter(user_role=ROLE.OWNER).order_by('pk').first()
+        client.force_login(user)
+        location_ids = list(Location.objects.values_list('pk', flat=True))
+        # Notes of the most popular location: the longest first page fetch_notes can serve
+        busy_location = (Note.objects.values('location').annotate(count=Count('id')).order_by('-count')
+                         .values_list('location', flat=True).first() or location_ids[0])
+        usernames = list(Account.objects.values_list('username', flat=True))
+        pending_plans = list(Plan.objects.filter(status=STATUS.PENDNG).values_list('pk', flat=True)[:1000])
+        if not location_ids or not pending_plans:
+            raise CommandError('Nothing to benchmark, seed some locations and plans first')
+        rng = self.rng
+        point = lambda: tuple(self.random_points(1)[0].tolist())
+
+        def uncached(func):
+            def run():
+                search_cache.cache.clear()
+                return func()
+            return run
+
+        results = {}
+        self.stdout.write(f'{"benchmark":<28} {"median":>13} {"p95":>13} {"queries":>8}')
+        location_index.reset()
+        results['get_nearest (geohash)'] = self.measure('get_nearest (geohash)', lambda: Location.get_nearest(*point()), runs)
+        results['location_index.build'] = self.measure(
+            'location_index.build', lambda: (location_index.reset(), location_index.build()), min(runs, 5))
+        results['get_nearest'] = self.measure('get_nearest', lambda: Location.get_nearest(*point()), runs)
+        results['get_location_name'] = self.measure('get_location_name', lambda: client.post(
+            reverse('get_location_name'),
+            json.dumps([{'lat': lat, 'lng': lng} for lat, lng in self.random_points(10).tolist()]),
+            content_type='application/json'), runs)
+        results['search'] = self.measure('search', uncached(lambda: self.get(
+            client, reverse('search'), {'q': rng.choice(SEARCH_QUERIES), 'n': 20})), runs)
+        results['search (cached)'] = self.measure('search (cached)', lambda: self.get(
+            client, reverse('search'), {'q': SEARCH_QUERIES[0], 'n': 20}), runs)
+        results['search page'] = self.measure('search page', uncached(lambda: self.get(
+            client, reverse('search'), {'q': rng.choice(SEARCH_QUERIES), 'page_size': 50})), runs)
+        results['planner'] = self.measure('planner', lambda: self.get(
+            client, reverse('planner', args=[int(rng.choice(pending_plans))])), runs)
+        results['view_plans'] = self.measure('view_plans', lambda: self.get(client, reverse('view_plans')), runs)
+        results['view_plans (status)'] = self.measure('view_plans (status)', lambda: self.get(
+            client, reverse('view_plans'), {'status': rng.choice(STATUS.values)}), runs)
+        results['view_logs'] = self.measure('view_logs', lambda: self.get(client, reverse('view_logs')), runs)
+        results['view_logs (user)'] = self.measure('view_logs (user)', lambda: self.get(
+            client, reverse('view_logs'), {'user': rng.choice(usernames)}), runs)
+        results['fetch_notes'] = self.measure('fetch_notes', lambda: self.get(
+            client, reverse('fetch_notes'), {'location_id': busy_location}), runs)
+        return results
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def git_commit():
+    """Commit being benchmarked, so results can be compared across commits."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,38 @@
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from TDMS.tour import optimize_order, tour_length
+
+
+class Command(BaseCommand):
+    help = 'Compare the waypoint order optimizer against the given order on random stops.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 100, 200], help='Numbers of stops.')
+        parser.add_argument('--runs', type=int, default=5, help='Random instances per size.')
+        parser.add_argument('--round-trip', action='store_true', help='Return to the first stop.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        time_limit = getattr(settings, 'TOUR_OPTIMIZATION_TIME_LIMIT', 0.15)
+        round_trip = options['round_trip']
+        self.stdout.write(f'{"stops":>6} {"naive km":>10} {"optimized km":>13} {"saved":>7} {"ms":>8}')
+        for size in options['sizes']:
+            naive, optimized, runtimes = [], [], []
+            for _ in range(options['runs']):
+                # Stops spread over roughly a 50 km square around Ho Chi Minh City
+                coords = np.column_stack([rng.uniform(10.55, 11.0, size), rng.uniform(106.45, 106.9, size)])
+                start = time.perf_counter()
+                order, distances = optimize_order(coords, round_trip, time_limit)
+                runtimes.append((time.perf_counter() - start) * 1000)
+                naive.append(tour_length(distances, np.arange(size), round_trip))
+                optimized.append(tour_length(distances, order, round_trip))
+            naive_km, optimized_km = np.mean(naive) / 1000, np.mean(optimized) / 1000
+            self.stdout.write(
+                f'{size:>6} {naive_km:>10.1f} {optimized_km:>13.1f} {1 - optimized_km / naive_km:>7.1%} '
+                f'{np.mean(runtimes):>8.1f}'
+            )
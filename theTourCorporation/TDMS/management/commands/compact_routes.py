@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from TDMS.geometry import compact_route_data
+from TDMS.models import Plan, ROUTE_FORMAT
+
+
+class Command(BaseCommand):
+    help = (
+        'Convert the route geometry of plans saved before polyline storage to encoded polylines '
+        'and precompute their simplified levels.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Plans converted per transaction.')
+        parser.add_argument('--all', action='store_true', help='Also add missing simplified levels to plans already stored as polylines.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        pending = Plan.objects.order_by('pk')
+        if not options['all']:
+            pending = pending.filter(route_format=ROUTE_FORMAT.VERBOSE)
+        total = pending.count()
+        converted = 0
+        last_pk = 0
+        while True:
+            batch = list(pending.filter(pk__gt=last_pk).only('pk', 'route_data', 'route_format')[:batch_size])
+            if not batch:
+                break
+            # bulk_update skips auto_now, and a plan's ETag comes from updated_at
+            now = timezone.now()
+            updates = []
+            for plan in batch:
+                route_data = compact_route_data(plan.route_data)
+                if route_data != plan.route_data or plan.route_format != ROUTE_FORMAT.POLYLINE:
+                    plan.route_data, plan.route_format, plan.updated_at = route_data, ROUTE_FORMAT.POLYLINE, now
+                    updates.append(plan)
+            with transaction.atomic():
+                Plan.objects.bulk_update(updates, ['route_data', 'route_format', 'updated_at'])
+            last_pk = batch[-1].pk
+            converted += len(batch)
+            self.stdout.write(f'{converted}/{total} plans converted')
+        self.stdout.write(self.style.SUCCESS(f'Converted {converted} plans'))
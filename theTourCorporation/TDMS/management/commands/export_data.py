@@ -0,0 +1,25 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from TDMS.exports import FORMATS
+from TDMS.models import Location, Plan
+
+
+class Command(BaseCommand):
+    help = 'Stream every location (with bookmark counts) or every plan summary to a CSV or GeoJSON file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('table', choices=['locations', 'plans'])
+        parser.add_argument('--format', choices=sorted(FORMATS), default='geojson')
+        parser.add_argument('--output', help='File to write, standard output by default.')
+
+    def handle(self, *args, **options):
+        model = Location if options['table'] == 'locations' else Plan
+        lines = model.export(options['format'])
+        output = open(options['output'], 'w', newline='', encoding='utf-8') if options['output'] else sys.stdout
+        try:
+            output.writelines(lines)
+        finally:
+            if output is not sys.stdout:
+                output.close()
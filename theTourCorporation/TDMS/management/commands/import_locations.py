@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from sklearn.neighbors import BallTree
+
+from TDMS.audit import log_sink
+from TDMS.cache import LOCATIONS_VERSION, search_cache
+from TDMS.location_files import READERS
+from TDMS.models import Account, Location, Log
+from TDMS.spatial import EARTH_RADIUS_METERS, location_index
+
+
+class Command(BaseCommand):
+    help = (
+        'Import locations from a CSV file (lat, lng, name, address, location_type columns) or a GeoJSON file '
+        'of Point features, skipping rows within --min-distance meters of an existing location.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or GeoJSON file.')
+        parser.add_argument('--format', choices=sorted(READERS), help='File format, guessed from the extension by default.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Locations inserted per transaction.')
+        parser.add_argument('--min-distance', type=float, default=10.0,
+                            help='Skip rows closer than this many meters to a known location; 0 keeps duplicates.')
+        parser.add_argument('--user', help='Email of the account the import is logged under.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+        if file_format not in READERS:
+            raise CommandError(f'Unknown file format "{file_format}", use --format')
+        user = None
+        if options['user']:
+            user = Account.objects.filter(email=options['user']).first()
+            if user is None:
+                raise CommandError(f'No account with email {options["user"]}')
+
+        self.min_distance = options['min_distance']
+        self.imported = self.duplicates = self.invalid = 0
+        batch = []
+        with open(path, newline='', encoding='utf-8-sig') as file:
+            for number, row in enumerate(READERS[file_format](file), start=1):
+                try:
+                    batch.append(Location.clean_from_json(row))
+                except (ValidationError, TypeError, ValueError) as error:
+                    self.invalid += 1
+                    self.stderr.write(f"Row {number} skipped: {error}")
+                    continue
+                if len(batch) == options['batch_size']:
+                    self.import_batch(batch)
+                    batch = []
+        if batch:
+            self.import_batch(batch)
+
+        skipped = self.duplicates + self.invalid
+        log = Log.create_import_loc_log(user, os.path.basename(path), self.imported, skipped)
+        log_sink.add(log)
+        log_sink.flush()
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {self.imported} locations, skipped {self.duplicates} near-duplicates and {self.invalid} invalid rows'
+        ))
+
+    def import_batch(self, batch):
+        """Insert the rows of `batch` that are not near a known location or an earlier row of the batch."""
+        coords = np.array([(location.lat, location.lng) for location in batch])
+        keep = np.ones(len(batch), dtype=bool)
+        if self.min_distance > 0:
+            distances, _ = location_index.nearest(coords)
+            keep = distances >= self.min_distance
+            # Within the batch, a row is a duplicate of any earlier kept row
+            points = np.radians(coords)
+            neighbours = BallTree(points, metric='haversine').query_radius(points, r=self.min_distance / EARTH_RADIUS_METERS)
+            for i in np.flatnonzero(keep):
+                earlier = neighbours[i][neighbours[i] < i]
+                if keep[earlier].any():
+                    keep[i] = False
+        new = [location for location, kept in zip(batch, keep) if kept]
+        with transaction.atomic():
+            Location.objects.bulk_create(new)
+        # bulk_create sends no post_save signals, so the index and search cache are updated here
+        location_index.upsert_many((location.pk, location.lat, location.lng) for location in new)
+        search_cache.bump(LOCATIONS_VERSION)
+        self.imported += len(new)
+        self.duplicates += len(batch) - len(new)
+        self.stdout.write(f'{self.imported} locations imported, {self.duplicates} duplicates skipped')
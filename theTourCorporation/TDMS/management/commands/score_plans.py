@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from TDMS.geometry import path_lengths, route_coordinates
+from TDMS.models import Plan
+
+
+class Command(BaseCommand):
+    help = 'Recompute est_distance and est_duration of every plan from its stored route geometry.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Plans read and updated per batch.')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many plans would change.')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        plans = Plan.objects.only('id', 'route_data', 'est_distance', 'est_duration').order_by('pk')
+        scored = changed = 0
+        chunk = []
+        for plan in plans.iterator(chunk_size=chunk_size):
+            chunk.append(plan)
+            if len(chunk) == chunk_size:
+                changed += self.score_chunk(chunk, options['dry_run'])
+                scored += len(chunk)
+                chunk = []
+                self.stdout.write(f'{scored} plans scored, {changed} changed')
+        if chunk:
+            changed += self.score_chunk(chunk, options['dry_run'])
+            scored += len(chunk)
+        self.stdout.write(self.style.SUCCESS(f'Scored {scored} plans, {changed} changed'))
+
+    def score_chunk(self, chunk, dry_run):
+        """Measure every route of `chunk` in one vectorized pass and save the plans whose estimates change."""
+        routes = [route_coordinates(plan.route_data[0]) if plan.route_data else [] for plan in chunk]
+        updates = []
+        for plan, distance in zip(chunk, path_lengths(routes)):
+            estimates = Plan.checked_estimates(distance, plan.est_distance, plan.est_duration)
+            if estimates != (plan.est_distance, plan.est_duration):
+                plan.est_distance, plan.est_duration = estimates
+                updates.append(plan)
+        if updates and not dry_run:
+            # One prepared UPDATE run for every row; bulk_update's CASE WHEN grows with the batch.
+            # updated_at is set too, as a plan's ETag comes from it
+            quote = connection.ops.quote_name
+            sql = (
+                f'UPDATE {quote(Plan._meta.db_table)} SET {quote("est_distance")} = %s, {quote("est_duration")} = %s, '
+                f'{quote("updated_at")} = %s WHERE {quote("id")} = %s'
+            )
+            now = Plan._meta.get_field('updated_at').get_db_prep_value(timezone.now(), connection)
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.executemany(sql, [(plan.est_distance, plan.est_duration, now, plan.pk) for plan in updates])
+        return len(updates)
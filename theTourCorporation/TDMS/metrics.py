@@ -0,0 +1,406 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Seconds; from a cached search to a planner render or an SMTP round trip
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, registry, name, documentation, labels=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def reset(self):
+        self._values = {}
+
+    def dump(self):
+        """JSON-able values, keyed by the JSON list of label values."""
+        return {json.dumps(key): value for key, value in self._values.items()}
+
+    def merge(self, merged, values):
+        """Add the `dump()` of another process into `merged`."""
+        for key, value in values.items():
+            merged[key] = merged.get(key, 0) + value
+
+    def samples(self, values):
+        for key, value in sorted(values.items()):
+            yield self.name, json.loads(key), (), value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        with self.registry.lock:
+            self.registry.check_fork()
+            key = self._key(labels)
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value read when the metrics are collected, from `set_function`. Summed over the
+    worker processes that are still running.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, registry, name, documentation, labels=()):
+        super().__init__(registry, name, documentation, labels)
+        self._function = None
+
+    def set_function(self, function):
+        self._function = function
+
+    def dump(self):
+        return {json.dumps([]): self._function()} if self._function else {}
+
+
+class HitRatio(Metric):
+    """
+    Share of a counter's samples labelled `result="hit"`, for every value of its other
+    labels, computed from the totals of all processes when the metrics are collected.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, registry, name, documentation, counter):
+        super().__init__(registry, name, documentation, [label for label in counter.labels if label != 'result'])
+        self.counter = counter
+
+    def dump(self):
+        return {}
+
+    def derive(self, merged):
+        position = self.counter.labels.index('result')
+        totals, hits = {}, {}
+        for key, value in merged[self.counter.name].items():
+            labels = json.loads(key)
+            result = labels.pop(position)
+            key = json.dumps(labels)
+            totals[key] = totals.get(key, 0) + value
+            if result == 'hit':
+                hits[key] = hits.get(key, 0) + value
+        return {key: hits.get(key, 0) / total for key, total in totals.items() if total}
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        with self.registry.lock:
+            self.registry.check_fork()
+            key = self._key(labels)
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            entry['buckets'][index] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def dump(self):
+        return {json.dumps(key): dict(value, buckets=list(value['buckets'])) for key, value in self._values.items()}
+
+    def merge(self, merged, values):
+        for key, value in values.items():
+            if len(value['buckets']) != len(self.buckets) + 1:
+                # Written by a process running with other buckets, e.g. before a deploy
+                continue
+            entry = merged.setdefault(key, {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0})
+            entry['buckets'] = [a + b for a, b in zip(entry['buckets'], value['buckets'])]
+            entry['sum'] += value['sum']
+            entry['count'] += value['count']
+
+    def samples(self, values):
+        for key, value in sorted(values.items()):
+            labels = json.loads(key)
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), value['buckets']):
+                cumulative += count
+                yield f'{self.name}_bucket', labels, (('le', format_value(float(bound))),), cumulative
+            yield f'{self.name}_sum', labels, (), value['sum']
+            yield f'{self.name}_count', labels, (), value['count']
+
+
+class Registry:
+    """
+    Metrics of this process, exposed in the Prometheus text format by `expose`.
+
+    With `METRICS_DIR` set, every server process writes its values to a file of its own
+    there, at most every `METRICS_FLUSH_INTERVAL` seconds after a response and at exit,
+    and `expose` adds up the files of all processes. Processes that never served a
+    request, such as management commands, write nothing. When a scrape finds files of
+    processes that have exited, it folds their counters and histograms into an archive
+    file and removes them, so totals never go down; their gauges are dropped.
+    Empty the directory when the server starts, as a restart resets every total.
+    """
+
+    # Seconds after which a lock left by a scrape that crashed is broken
+    LOCK_TIMEOUT = 60
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.metrics = {}
+        self._pid = os.getpid()
+        self._started = time.time_ns()
+        self._last_flush = 0.0
+        self._serving = False
+
+    def counter(self, name, documentation, labels=()):
+        return self._add(Counter(self, name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self._add(Gauge(self, name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(self, name, documentation, labels, buckets))
+
+    def hit_ratio(self, name, documentation, counter):
+        return self._add(HitRatio(self, name, documentation, counter))
+
+    def _add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def check_fork(self):
+        """Forget what was counted before a fork, the parent reports it."""
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._started = time.time_ns()
+            self._serving = False
+            for metric in self.metrics.values():
+                metric.reset()
+
+    @property
+    def directory(self):
+        return getattr(settings, 'METRICS_DIR', None)
+
+    def _path(self):
+        return os.path.join(self.directory, f'{self._pid}-{self._started}.json')
+
+    def _process_files(self):
+        return glob.glob(os.path.join(self.directory, '[0-9]*-[0-9]*.json'))
+
+    def _archives(self):
+        """`(generation, path)` of the archive files, newest first."""
+        paths = glob.glob(os.path.join(self.directory, 'archive-[0-9]*.json'))
+        return sorted(((int(os.path.basename(path)[8:-5]), path) for path in paths), reverse=True)
+
+    def dump(self):
+        with self.lock:
+            self.check_fork()
+            return {'pid': self._pid, 'metrics': {name: metric.dump() for name, metric in self.metrics.items()}}
+
+    def flush(self):
+        """Write this process's values to its file in `METRICS_DIR`, once it has served a request."""
+        self.check_fork()
+        if not self.directory or not self._serving:
+            return
+        path = self._path()
+        try:
+            with self.lock:
+                write_json(path, self.dump())
+        except OSError:
+            logger.exception('Could not write metrics to %s', path)
+        self._last_flush = time.monotonic()
+
+    def flush_if_due(self):
+        """Called once a response has been sent."""
+        self.check_fork()
+        self._serving = True
+        if time.monotonic() - self._last_flush >= getattr(settings, 'METRICS_FLUSH_INTERVAL', 1.0):
+            self.flush()
+
+    def _load_archive(self):
+        """`(generation, snapshot)` of the newest archive, `(0, None)` if there is none yet."""
+        for _ in range(3):
+            archives = self._archives()
+            if not archives:
+                return 0, None
+            generation, path = archives[0]
+            snapshot = read_json(path)
+            if snapshot is not None:
+                return generation, snapshot
+            # Replaced by a newer generation while listing, look again
+        return 0, None
+
+    def retire_exited(self):
+        """
+        Fold the files of processes that have exited into a new generation of the archive,
+        then remove them. Skipped while another scrape holds the lock.
+        """
+        dead = [path for path in self._process_files() if not process_alive(int(os.path.basename(path).split('-')[0]))]
+        if not dead:
+            return
+        lock = os.path.join(self.directory, 'retire.lock')
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock) > self.LOCK_TIMEOUT:
+                    os.remove(lock)
+            except OSError:
+                pass
+            return
+        try:
+            generation, archive = self._load_archive()
+            merged = archive['metrics'] if archive else {}
+            retired = []
+            for path in dead:
+                snapshot = read_json(path)
+                if snapshot is None:
+                    continue
+                for name, values in snapshot['metrics'].items():
+                    metric = self.metrics.get(name)
+                    if metric is not None and metric.kind != 'gauge':
+                        metric.merge(merged.setdefault(name, {}), values)
+                retired.append(os.path.basename(path))
+            # Scrapes reading meanwhile skip the files listed in `retired`, so none is counted twice
+            write_json(os.path.join(self.directory, f'archive-{generation + 1}.json'),
+                       {'pid': None, 'metrics': merged, 'retired': retired})
+            for name in retired:
+                os.remove(os.path.join(self.directory, name))
+            for old_generation, path in self._archives():
+                if old_generation <= generation:
+                    os.remove(path)
+        except OSError:
+            logger.exception('Could not archive the metrics of exited processes in %s', self.directory)
+        finally:
+            try:
+                os.remove(lock)
+            except OSError:
+                pass
+
+    def _snapshots(self):
+        yield self.dump()
+        if not self.directory:
+            return
+        self.retire_exited()
+        own = self._path()
+        # Process files first: one removed before it is read was retired into the archive read next
+        snapshots = {path: read_json(path) for path in self._process_files() if path != own}
+        _, archive = self._load_archive()
+        retired = set()
+        if archive is not None:
+            retired = set(archive['retired'])
+            yield archive
+        for path, snapshot in snapshots.items():
+            if snapshot is not None and os.path.basename(path) not in retired:
+                yield snapshot
+
+    def collect(self):
+        """Values of every metric, added up over the processes."""
+        merged = {name: {} for name in self.metrics}
+        for snapshot in self._snapshots():
+            alive = snapshot['pid'] is not None and process_alive(snapshot['pid'])
+            for name, values in snapshot['metrics'].items():
+                metric = self.metrics.get(name)
+                if metric is None or (metric.kind == 'gauge' and not alive):
+                    continue
+                metric.merge(merged[name], values)
+        for name, metric in self.metrics.items():
+            if hasattr(metric, 'derive'):
+                merged[name] = metric.derive(merged)
+        return merged
+
+    def expose(self):
+        """Every metric in the Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for name, values in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for sample, labels, extra, value in metric.samples(values):
+                lines.append(f'{sample}{format_labels(metric.labels, labels, extra)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def read_json(path):
+    """The contents of `path`, `None` if it was removed or is being replaced."""
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(data, file)
+    # Readers never see a half-written file
+    os.replace(f'{path}.tmp', path)
+
+
+def process_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+registry = Registry()
+atexit.register(registry.flush)
+
+request_duration = registry.histogram(
+    'tdms_request_duration_seconds', 'Time to serve a request, by URL name.', ('view', 'method'))
+db_queries = registry.counter(
+    'tdms_db_queries_total', 'SQL statements run while serving requests, by URL name.', ('view',))
+db_duration = registry.counter(
+    'tdms_db_query_seconds_total', 'Time spent in SQL statements while serving requests, by URL name.', ('view',))
+spatial_index_build = registry.histogram(
+    'tdms_spatial_index_build_seconds', 'Full loads of the nearest-location index from the database.')
+spatial_index_sync = registry.histogram(
+    'tdms_spatial_index_sync_seconds', 'Refreshes of the nearest-location index with rows changed elsewhere.')
+cache_lookups = registry.counter(
+    'tdms_cache_lookups_total', 'Lookups in the versioned result caches, by kind of result.', ('cache', 'kind', 'result'))
+cache_hit_ratio = registry.hit_ratio(
+    'tdms_cache_hit_ratio', 'Share of the lookups in the versioned result caches that were hits.', cache_lookups)
+audit_log_queue = registry.gauge(
+    'tdms_audit_log_queue_depth', 'Audit log rows waiting to be written.')
+email_duration = registry.histogram(
+    'tdms_email_send_seconds', 'Time to hand an email to the mail server.', ('result',))
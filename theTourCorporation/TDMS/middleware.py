@@ -0,0 +1,180 @@
+import heapq
+import json
+import logging
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager, nullcontext
+
+from django.conf import settings
+from django.db import connections
+
+from TDMS.audit import log_sink
+from TDMS.metrics import db_duration, db_queries, registry, request_duration
+
+# One line per request, on a logger of its own so settings can keep only the warnings
+logger = logging.getLogger('TDMS.requests')
+
+
+def run_before_close(response, function):
+    """
+    Call `function` from `response.close()`, which the server calls once the body has been
+    sent, ahead of the `request_finished` handlers that close the database connection.
+    """
+    close = response.close
+
+    def close_response():
+        try:
+            function()
+        finally:
+            close()
+
+    response.close = close_response
+
+
+class AuditLogMiddleware:
+    """Write queued audit logs once the response has been sent to the client."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if log_sink.strict:
+            return response
+        run_before_close(response, log_sink.flush_if_due)
+        return response
+
+
+def timing_span(request, name):
+    """
+    `with timing_span(request, 'name'):` times a step of a view, reported with the request's
+    own timings (see `RequestTimingMiddleware`). Does nothing without the middleware.
+    """
+    recorder = getattr(request, 'timing', None)
+    return recorder.span(name) if recorder is not None else nullcontext()
+
+
+class QueryRecorder:
+    """`execute_wrapper` counting and timing statements, keeping the slowest ones, and the spans views time."""
+
+    def __init__(self, keep=3):
+        self.keep = keep
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+        self.spans = {}
+        self._slowest = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.duration += duration
+            # The SQL still has its placeholders, so a statement repeated with other values counts as one
+            self.statements[sql] += 1
+            entry = (duration, self.count, sql)
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, entry)
+            else:
+                heapq.heappushpop(self._slowest, entry)
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0.0) + time.perf_counter() - start
+
+    @property
+    def slowest(self):
+        return [(duration, sql) for duration, _, sql in sorted(self._slowest, reverse=True)]
+
+    def repeated(self, limit):
+        """Statements run more than `limit` times, the usual sign of an N+1 query pattern."""
+        return [(sql, count) for sql, count in self.statements.most_common() if count > limit]
+
+
+class RequestTimingMiddleware:
+    """
+    Count and time the SQL queries of every request, and time its view and the whole request.
+    Views time steps of their own with `timing_span`.
+    Reported in `TDMS.metrics` and one JSON log line per request (`TDMS.requests`), a warning when
+    the view is slower than its `REQUEST_TIMING_SLOW_VIEWS_MS` threshold (by URL name,
+    `REQUEST_TIMING_SLOW_VIEW_MS` otherwise) or a statement repeats like an N+1 pattern, and
+    in a `Server-Timing` header with DEBUG or `REQUEST_TIMING_HEADER`.
+
+    Must come first in `MIDDLEWARE` so the total covers the other middleware. Streamed
+    response bodies are produced after the header is sent and are not included.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder(getattr(settings, 'REQUEST_TIMING_SLOWEST_QUERIES', 3))
+        request.timing = recorder
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        total = time.perf_counter() - start
+        view_start = getattr(request, '_timing_view_start', None)
+        view = time.perf_counter() - view_start if view_start is not None else 0.0
+
+        # Timings tell any client how much work a request takes, so production leaves them out
+        if settings.DEBUG or getattr(settings, 'REQUEST_TIMING_HEADER', False):
+            response['Server-Timing'] = ', '.join([
+                f'db;dur={recorder.duration * 1000:.1f};desc="{recorder.count} queries"',
+                f'view;dur={view * 1000:.1f}',
+                *(f'{name};dur={duration * 1000:.1f}' for name, duration in recorder.spans.items()),
+                f'total;dur={total * 1000:.1f}',
+            ])
+        self.log(request, response, recorder, view, total)
+        self.record(request, recorder, total)
+        # Written out once the body is sent, like the audit logs
+        run_before_close(response, registry.flush_if_due)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._timing_view_start = time.perf_counter()
+
+    def slow_view_ms(self, view_name):
+        thresholds = getattr(settings, 'REQUEST_TIMING_SLOW_VIEWS_MS', {})
+        return thresholds.get(view_name, getattr(settings, 'REQUEST_TIMING_SLOW_VIEW_MS', 500))
+
+    def record(self, request, recorder, total):
+        match = request.resolver_match
+        # URL names, not paths, so unknown URLs do not add label values
+        view_name = match.url_name if match and match.url_name else 'unresolved'
+        request_duration.observe(total, view=view_name, method=request.method)
+        db_queries.inc(recorder.count, view=view_name)
+        db_duration.inc(recorder.duration, view=view_name)
+
+    def log(self, request, response, recorder, view, total):
+        match = request.resolver_match
+        view_name = match.url_name if match else None
+        repeated = recorder.repeated(getattr(settings, 'REQUEST_TIMING_REPEATED_QUERY_LIMIT', 10))
+        slow = view * 1000 > self.slow_view_ms(view_name)
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'view': view_name,
+            'status': response.status_code,
+            'queries': recorder.count,
+            'db_ms': round(recorder.duration * 1000, 1),
+            'view_ms': round(view * 1000, 1),
+            'total_ms': round(total * 1000, 1),
+            'slowest': [{'ms': round(duration * 1000, 1), 'sql': sql} for duration, sql in recorder.slowest],
+        }
+        if recorder.spans:
+            record['spans'] = {name: round(duration * 1000, 1) for name, duration in recorder.spans.items()}
+        if slow:
+            record['slow_view'] = True
+        if repeated:
+            record['repeated_queries'] = [{'count': count, 'sql': sql} for sql, count in repeated]
+        logger.log(logging.WARNING if slow or repeated else logging.INFO, '%s', json.dumps(record))
@@ -0,0 +1,62 @@
+from django.db import migrations
+
+POSTGRESQL_FORWARDS = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS tdms_location_name_trgm ON "TDMS_location" USING gin (name gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS tdms_location_address_trgm ON "TDMS_location" USING gin (address gin_trgm_ops)',
+    "CREATE INDEX IF NOT EXISTS tdms_location_document ON \"TDMS_location\" "
+    "USING gin ((to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(address, ''))))",
+]
+
+POSTGRESQL_BACKWARDS = [
+    'DROP INDEX IF EXISTS tdms_location_document',
+    'DROP INDEX IF EXISTS tdms_location_address_trgm',
+    'DROP INDEX IF EXISTS tdms_location_name_trgm',
+]
+
+# External-content FTS5 table over TDMS_location, kept in sync by triggers. Migration 0020
+# replaces tdms_location_fts_au with one that only fires on updates of name or address
+SQLITE_FORWARDS = [
+    "CREATE VIRTUAL TABLE tdms_location_fts USING fts5("
+    "name, address, content='TDMS_location', content_rowid='location_id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    'CREATE TRIGGER tdms_location_fts_ai AFTER INSERT ON "TDMS_location" BEGIN '
+    'INSERT INTO tdms_location_fts(rowid, name, address) VALUES (new.location_id, new.name, new.address); '
+    'END',
+    'CREATE TRIGGER tdms_location_fts_ad AFTER DELETE ON "TDMS_location" BEGIN '
+    "INSERT INTO tdms_location_fts(tdms_location_fts, rowid, name, address) VALUES ('delete', old.location_id, old.name, old.address); "
+    'END',
+    'CREATE TRIGGER tdms_location_fts_au AFTER UPDATE ON "TDMS_location" BEGIN '
+    "INSERT INTO tdms_location_fts(tdms_location_fts, rowid, name, address) VALUES ('delete', old.location_id, old.name, old.address); "
+    'INSERT INTO tdms_location_fts(rowid, name, address) VALUES (new.location_id, new.name, new.address); '
+    'END',
+    "INSERT INTO tdms_location_fts(tdms_location_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARDS = [
+    'DROP TRIGGER IF EXISTS tdms_location_fts_au',
+    'DROP TRIGGER IF EXISTS tdms_location_fts_ad',
+    'DROP TRIGGER IF EXISTS tdms_location_fts_ai',
+    'DROP TABLE IF EXISTS tdms_location_fts',
+]
+
+
+def run_for_vendor(statements):
+    def run(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TDMS', '0014_account_full_name_account_ssn_alter_account_email'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor({'postgresql': POSTGRESQL_FORWARDS, 'sqlite': SQLITE_FORWARDS}),
+            run_for_vendor({'postgresql': POSTGRESQL_BACKWARDS, 'sqlite': SQLITE_BACKWARDS}),
+        ),
+    ]
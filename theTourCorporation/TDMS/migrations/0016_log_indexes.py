@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-17 19:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TDMS', '0015_location_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='log',
+            index=models.Index(fields=['-timestamp', '-id'], name='log_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='log',
+            index=models.Index(fields=['user', '-timestamp', '-id'], name='log_user_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='log',
+            index=models.Index(fields=['action', '-timestamp', '-id'], name='log_action_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='log',
+            index=models.Index(fields=['content_type', 'object_id', '-timestamp', '-id'], name='log_object_timestamp_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-17 19:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TDMS', '0016_log_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='plan',
+            index=models.Index(fields=['-created_at', '-id'], name='plan_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='plan',
+            index=models.Index(fields=['status', '-created_at', '-id'], name='plan_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='plan',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='plan_user_created_idx'),
+        ),
+    ]
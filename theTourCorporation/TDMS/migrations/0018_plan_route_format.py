@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TDMS', '0017_plan_indexes'),
+    ]
+
+    operations = [
+        # Rows that exist already still hold Leaflet coordinates until `manage.py compact_routes` runs
+        migrations.AddField(
+            model_name='plan',
+            name='route_format',
+            field=models.CharField(choices=[('verbose', 'Leaflet coordinates'), ('polyline', 'Encoded polyline')], default='verbose', max_length=8),
+        ),
+        migrations.AlterField(
+            model_name='plan',
+            name='route_format',
+            field=models.CharField(choices=[('verbose', 'Leaflet coordinates'), ('polyline', 'Encoded polyline')], default='polyline', max_length=8),
+        ),
+    ]
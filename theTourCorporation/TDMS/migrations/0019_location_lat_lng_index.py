@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TDMS', '0018_plan_route_format'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='location',
+            index=models.Index(fields=['lat', 'lng'], name='location_lat_lng_idx'),
+        ),
+    ]
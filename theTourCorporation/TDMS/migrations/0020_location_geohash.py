@@ -0,0 +1,91 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:03
+
+from django.db import migrations
+import numpy as np
+
+import TDMS.models
+
+BACKFILL_BATCH_SIZE = 2000
+
+# A copy of TDMS.geohash.encode as of this migration, so later changes to that module
+# cannot change what this migration writes
+BASE32 = np.array(list('0123456789bcdefghjkmnpqrstuvwxyz'))
+GEOHASH_PRECISION = 9
+
+
+def encode(lats, lngs, precision=GEOHASH_PRECISION):
+    lat = np.asarray(lats, dtype=float)
+    lng = np.asarray(lngs, dtype=float)
+    bits = 5 * precision
+    lng_bits, lat_bits = (bits + 1) // 2, bits // 2
+    x = np.clip(np.floor((lng + 180) / 360 * 2.0 ** lng_bits), 0, 2 ** lng_bits - 1).astype(np.int64)
+    y = np.clip(np.floor((lat + 90) / 180 * 2.0 ** lat_bits), 0, 2 ** lat_bits - 1).astype(np.int64)
+    code = np.zeros(len(lat), dtype=np.int64)
+    for i in range(bits):
+        if i % 2 == 0:
+            bit = (x >> (lng_bits - 1 - i // 2)) & 1
+        else:
+            bit = (y >> (lat_bits - 1 - i // 2)) & 1
+        code = (code << 1) | bit
+    chars = BASE32[(code[:, None] >> (5 * np.arange(precision - 1, -1, -1))) & 0x1f]
+    return [''.join(row) for row in chars]
+
+# Rewrites the FTS5 update trigger of migration 0015 as AFTER UPDATE OF name, address: the
+# backfill below and every later geohash, lat or lng update would otherwise delete and
+# reinsert the row's full-text entry for nothing. Backwards restores the 0015 trigger.
+SQLITE_FORWARDS = [
+    'DROP TRIGGER IF EXISTS tdms_location_fts_au',
+    'CREATE TRIGGER tdms_location_fts_au AFTER UPDATE OF name, address ON "TDMS_location" BEGIN '
+    "INSERT INTO tdms_location_fts(tdms_location_fts, rowid, name, address) VALUES ('delete', old.location_id, old.name, old.address); "
+    'INSERT INTO tdms_location_fts(rowid, name, address) VALUES (new.location_id, new.name, new.address); '
+    'END',
+]
+
+SQLITE_BACKWARDS = [
+    'DROP TRIGGER IF EXISTS tdms_location_fts_au',
+    'CREATE TRIGGER tdms_location_fts_au AFTER UPDATE ON "TDMS_location" BEGIN '
+    "INSERT INTO tdms_location_fts(tdms_location_fts, rowid, name, address) VALUES ('delete', old.location_id, old.name, old.address); "
+    'INSERT INTO tdms_location_fts(rowid, name, address) VALUES (new.location_id, new.name, new.address); '
+    'END',
+]
+
+
+def run_for_sqlite(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor == 'sqlite':
+            for statement in statements:
+                schema_editor.execute(statement)
+    return run
+
+
+def backfill_geohash(apps, schema_editor):
+    Location = apps.get_model('TDMS', 'Location')
+    quote = schema_editor.quote_name
+    update = f'UPDATE {quote(Location._meta.db_table)} SET {quote("geohash")} = %s WHERE {quote("location_id")} = %s'
+    last_pk = 0
+    while True:
+        rows = list(Location.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'lat', 'lng')[:BACKFILL_BATCH_SIZE])
+        if not rows:
+            break
+        pks, lats, lngs = zip(*rows)
+        # Plain executemany, bulk_update's CASE expression is much slower on big batches
+        with schema_editor.connection.cursor() as cursor:
+            cursor.executemany(update, list(zip(encode(lats, lngs), pks)))
+        last_pk = pks[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TDMS', '0019_location_lat_lng_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='geohash',
+            field=TDMS.models.GeohashField(blank=True, db_index=True, editable=False, max_length=12, null=True),
+        ),
+        migrations.RunPython(run_for_sqlite(SQLITE_FORWARDS), run_for_sqlite(SQLITE_BACKWARDS)),
+        migrations.RunPython(backfill_geohash, migrations.RunPython.noop),
+    ]
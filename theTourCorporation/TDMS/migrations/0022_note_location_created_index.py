@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TDMS', '0021_plan_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(fields=['location', '-created_at', '-id'], name='note_location_created_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:11
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def remove_duplicate_bookmarks(apps, schema_editor):
+    # Keep the first bookmark of every (user, location) pair, racing toggles may have made more
+    Bookmark = apps.get_model('TDMS', 'Bookmark')
+    first_ids = (Bookmark.objects.values('user', 'location').order_by()
+                 .annotate(first_id=Min('id')).values_list('first_id', flat=True))
+    Bookmark.objects.exclude(id__in=list(first_ids)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TDMS', '0022_note_location_created_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_bookmarks, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='bookmark',
+            constraint=models.UniqueConstraint(fields=('user', 'location'), name='bookmark_user_location_uniq'),
+        ),
+    ]
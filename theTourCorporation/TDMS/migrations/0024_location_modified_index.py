@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('TDMS', '0023_bookmark_user_location_uniq'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='location',
+            index=models.Index(fields=['-modified_at', '-location_id'], name='location_modified_idx'),
+        ),
+    ]
@@ -1,13 +1,28 @@
-from django.db import models
-from django.db.models import Model, Q
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Model, Q, Case, Count, Exists, Max, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 from django.contrib.auth.models import User
 from django.db.models import JSONField
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
 from django.contrib.contenttypes.fields import GenericForeignKey
+from django.utils import timezone
 import uuid
 import numpy as np
-from sklearn.neighbors import BallTree
+from datetime import datetime, time, timedelta
+
+from TDMS import exports, search
+from TDMS.cache import bookmarks_version, search_cache
+from TDMS.geometry import (
+    compact_route_data, expand_route_data, grid_clusters, path_lengths, route_coordinates, select_route_level,
+    view_pixels,
+)
+from TDMS.geohash import covering_cells, encode as encode_geohash, prefix_range
+from TDMS.pagination import DEFAULT_PAGE_SIZE, keyset_page
+from TDMS.spatial import EARTH_RADIUS_METERS, haversine_distances, location_index
+from TDMS.tour import optimize_order, tour_length
 
 class ROLE(models.TextChoices):
     OWNER = "ownr", ("Owner")
@@ -22,6 +37,10 @@ class STATUS(models.TextChoices):
     PROGRS = "progrs", ("In-progress")
     COMPLT = "complt", ("Complete")
     
+class ROUTE_FORMAT(models.TextChoices):
+    VERBOSE = "verbose", ("Leaflet coordinates")
+    POLYLINE = "polyline", ("Encoded polyline")
+
 class ACTION(models.TextChoices):
     CREATE = "crt", ("Created")
     UPDATE = "upd", ("Updated")
@@ -112,6 +131,17 @@ class Account(AbstractBaseUser):
 def process_json(data, fields: list[str]):
     return {field: data.get(field) for field in fields}
 
+def start_of_day(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+class GeohashField(models.CharField):
+    """Geohash of the row's `lat`/`lng` (see `TDMS.geohash`), set on every save and `bulk_create`."""
+
+    def pre_save(self, model_instance, add):
+        value = encode_geohash(model_instance.lat, model_instance.lng)
+        setattr(model_instance, self.attname, value)
+        return value
+
 class Location(models.Model):
     JSON_FIELDS = ['lat', 'lng', 'name', 'address', 'location_type']
     
@@ -122,14 +152,27 @@ class Location(models.Model):
     address = models.CharField(max_length=255, blank=True, null=True)
     location_type = models.CharField(max_length=255, blank=True, null=True)
     modified_at = models.DateTimeField(auto_now=True)
+    geohash = GeohashField(max_length=12, null=True, blank=True, editable=False, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['lat', 'lng'], name='location_lat_lng_idx'),
+            models.Index(fields=['-modified_at', '-location_id'], name='location_modified_idx'),
+        ]
     
     def __str__(self) -> str:
         return f"({self.lat}, {self.lng}) {self.name} at {self.address}"
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and ('lat' in update_fields or 'lng' in update_fields):
+            kwargs['update_fields'] = {*update_fields, 'geohash'}
+        super().save(*args, **kwargs)
     
     def is_bookmarked_by(self, user):
-        if user is None:
+        if user is None or not user.is_authenticated:
             return False
-        return Bookmark.objects.filter(user=user, location=self).exists()
+        return self.pk in Bookmark.get_location_ids(user)
     
     def serialize(self, user=None):
         return {
@@ -139,8 +182,9 @@ class Location(models.Model):
             'name': self.name, 
             'address': self.address,
             'location_type': self.location_type,
-            'is_bookmarked': self.is_bookmarked_by(user),
-            'modified_at': self.modified_at
+            'is_bookmarked': self.is_bookmarked if hasattr(self, 'is_bookmarked') else self.is_bookmarked_by(user),
+            'modified_at': self.modified_at,
+            **({'note_count': self.note_count} if hasattr(self, 'note_count') else {}),
         }
         
     def can_be_deleted(self):
@@ -148,46 +192,255 @@ class Location(models.Model):
     
     @classmethod
     def get_nearest(cls, lat, lng, max_distance_meters=200):
-        locations = list(Location.objects.all())
-        location_coords = np.radians([(location.lat, location.lng) for location in locations])
-
-        tree = BallTree(location_coords, leaf_size=15, metric='haversine')
-        distances, indices = tree.query([np.radians([float(lat), float(lng)])], return_distance=True)
+        return cls.get_nearest_many([(lat, lng)], max_distance_meters)[0]
 
+    @classmethod
+    def get_nearest_many(cls, coords, max_distance_meters=200):
+        """
+        Nearest location (or `None`) for every `(lat, lng)` in `coords`, in one index query.
+        A few points looked up before this process has built the index are looked up in SQL
+        by geohash cells instead.
+        """
+        if (not location_index.built and max_distance_meters is not None
+                and len(coords) <= getattr(settings, 'GEOHASH_LOOKUP_MAX_POINTS', 32)):
+            nearest = [cls.get_nearest_by_geohash(lat, lng, max_distance_meters) for lat, lng in coords]
+            if all(found is not False for found in nearest):
+                return nearest
+        distances, pks = location_index.nearest(coords)
+        found = pks >= 0
         if max_distance_meters is not None:
-            max_distance_rad = max_distance_meters / 6371000  # Earth's radius in meters
-            close_enough = distances[0] < max_distance_rad
+            found &= distances < max_distance_meters
+        locations = cls.objects.in_bulk(set(pks[found].tolist()))
+        return [locations.get(int(pk)) if ok else None for pk, ok in zip(pks, found)]
 
-            if not np.any(close_enough):
-                return None  # No locations are close enough
 
-            nearest_index = indices[0][np.argmin(distances[0][close_enough])]
-        else:
-            nearest_index = indices[0][np.argmin(distances)]
-        return locations[nearest_index]
+    @staticmethod
+    def filter_geohash_cells(locations, cells):
+        """Locations in any of the geohash `cells` (prefixes), as index range scans."""
+        merged = []
+        for start, stop in map(prefix_range, sorted(cells)):
+            # Neighbouring cells often follow each other, one range scan covers them all
+            if merged and merged[-1][1] == start:
+                merged[-1][1] = stop
+            else:
+                merged.append([start, stop])
+        ranges = Q()
+        for start, stop in merged:
+            ranges |= Q(geohash__gte=start, geohash__lt=stop) if stop else Q(geohash__gte=start)
+        return locations.filter(ranges)
+
+    @staticmethod
+    def get_near_by_geohash(locations, lat, lng, radius_meters):
+        """
+        `(location, distance)` pairs of `locations` within `radius_meters`, closest first,
+        read from the geohash cells around the point; `None` if the circle is too large.
+        """
+        cells = covering_cells(lat, lng, radius_meters)
+        if cells is None:
+            return None
+        candidates = list(Location.filter_geohash_cells(locations, cells))
+        if not candidates:
+            return []
+        distances = haversine_distances([(lat, lng)], [(loc.lat, loc.lng) for loc in candidates])[0]
+        order = np.argsort(distances, kind='stable')
+        return [(candidates[i], float(distances[i])) for i in order if distances[i] <= radius_meters]
 
+    @staticmethod
+    def get_nearest_by_geohash(lat, lng, max_distance_meters):
+        """Nearest location within `max_distance_meters`, or `None`; `False` if the distance is too large."""
+        near = Location.get_near_by_geohash(Location.objects.all(), lat, lng, max_distance_meters)
+        if near is None:
+            return False
+        return near[0][0] if near else None
 
     @staticmethod
-    def get_list_loc_w_bookmark(user, n=None, query='', sort_bookmark=False):
+    def get_visit_order(location_ids, round_trip=False):
+        """
+        Short visiting order for `location_ids`, starting at the first one (see `TDMS.tour`).
+        Returns `None` if any location does not exist.
+        """
+        location_ids = [int(location_id) for location_id in location_ids]
+        rows = dict((pk, (lat, lng)) for pk, lat, lng in
+                    Location.objects.filter(pk__in=location_ids).values_list('location_id', 'lat', 'lng'))
+        if any(location_id not in rows for location_id in location_ids):
+            return None
+        order, distances = optimize_order(
+            [rows[location_id] for location_id in location_ids], round_trip,
+            getattr(settings, 'TOUR_OPTIMIZATION_TIME_LIMIT', 0.15))
+        return {
+            'location_ids': [location_ids[i] for i in order],
+            'distance': tour_length(distances, order, round_trip),
+            'naive_distance': tour_length(distances, range(len(location_ids)), round_trip),
+        }
+
+    EXPORT_FIELDS = ['location_id', 'name', 'address', 'location_type', 'modified_at', 'bookmark_count']
+
+    @staticmethod
+    def export(file_format):
+        """Streamed CSV or GeoJSON lines of every location with its bookmark count."""
+        rows = (Location.objects.annotate(bookmark_count=Count('bookmark'))
+                .order_by('pk').values('lat', 'lng', *Location.EXPORT_FIELDS))
+        if file_format == 'csv':
+            return exports.export_lines(rows, ['lat', 'lng', *Location.EXPORT_FIELDS], file_format)
+        return exports.export_lines(rows, Location.EXPORT_FIELDS, file_format, point=lambda row: (row['lat'], row['lng']))
+
+    @staticmethod
+    def annotate_bookmarks(locations, user):
+        """Annotate `is_bookmarked` for `user` on a Location queryset from the cached `Bookmark.get_location_ids`."""
+        location_ids = Bookmark.get_location_ids(user) if user is not None and user.is_authenticated else ()
+        if not location_ids:
+            return locations.annotate(is_bookmarked=Value(False, output_field=models.BooleanField()))
+        if len(location_ids) > Bookmark.inline_ids_limit():
+            return locations.annotate(is_bookmarked=Exists(Bookmark.objects.filter(user=user, location=OuterRef('pk'))))
+        return locations.annotate(is_bookmarked=Case(
+            When(pk__in=location_ids, then=Value(True)),
+            default=Value(False),
+            output_field=models.BooleanField(),
+        ))
+
+    @staticmethod
+    def search_locations(query=''):
+        """Locations matching `query`, annotated with a relevance `rank` (see `TDMS.search`)."""
         if query:
-            locations = Location.objects.filter(Q(name__icontains=query) | Q(address__icontains=query))
-        else:
-            locations = Location.objects.all()
+            return search.search(Location.objects.all(), query)
+        return Location.objects.all()
+
+    @staticmethod
+    def get_list_loc_w_bookmark(user, n=None, query='', sort_bookmark=False):
+        locations = Location.annotate_bookmarks(Location.search_locations(query), user)
+        locations = locations.annotate(note_count=Note.count_by_location())
+
+        # Most relevant first when searching, then by date modified
+        ordering = ['-rank', '-modified_at', '-location_id'] if query else ['-modified_at', '-location_id']
+        groups = [locations]
+        location_ids = Bookmark.get_location_ids(user) if sort_bookmark and user is not None and user.is_authenticated else ()
+        if location_ids:
+            # Bookmarked ones first, as two queries the modified_at index can still order, not a sort on is_bookmarked
+            if len(location_ids) > Bookmark.inline_ids_limit():
+                location_ids = Bookmark.objects.filter(user=user).values('location_id')
+            groups = [locations.filter(pk__in=location_ids), locations.exclude(pk__in=location_ids)]
+
+        results = []
+        for group in groups:
+            group = group.order_by(*ordering)
+            # Limit the number of locations if n is not None
+            if n is not None:
+                group = group[:n - len(results)]
+            results.extend(loc.serialize(user) for loc in group)
+        return results
 
-        # Sort by date modified
-        locations = locations.order_by('-modified_at')
+    @staticmethod
+    def filter_bbox(locations, south, west, north, east):
+        """Locations inside a box, which may cross the antimeridian (`west > east`)."""
+        locations = locations.filter(lat__gte=south, lat__lte=north)
+        if east - west >= 360:
+            return locations
+        west, east = (west + 180) % 360 - 180, (east + 180) % 360 - 180
+        if west <= east:
+            return locations.filter(lng__gte=west, lng__lte=east)
+        return locations.filter(Q(lng__gte=west) | Q(lng__lte=east))
 
-        loc_w_bookmark = [loc.serialize(user) for loc in locations]
-        loc_w_bookmark.sort(key=lambda x: x['modified_at'], reverse=True)
-        if sort_bookmark:
-            # If sort_bookmark is True, sort by is_bookmarked first and then by date modified
-            loc_w_bookmark.sort(key=lambda x: x['is_bookmarked'], reverse=True)
+    @staticmethod
+    def circle_bbox(lat, lng, radius_meters):
+        """`(south, west, north, east)` of a circle, the whole longitude range near the poles."""
+        dlat = np.degrees(radius_meters / EARTH_RADIUS_METERS)
+        south, north = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+        if south == -90.0 or north == 90.0:
+            return south, -180.0, north, 180.0
+        dlng = dlat / np.cos(np.radians(lat))
+        if dlng >= 180:
+            return south, -180.0, north, 180.0
+        return south, lng - dlng, north, lng + dlng
 
-        # Limit the number of locations if n is not None
-        if n is not None:
-            loc_w_bookmark = loc_w_bookmark[:n]
+    @staticmethod
+    def get_within_radius(user, lat, lng, radius_meters, location_type=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        Up to `limit` locations within `radius_meters` of `(lat, lng)`, closest first, serialized with
+        their `distance` in meters. Candidates come from the BallTree (`SpatialIndex.within`) and are
+        loaded in chunks through the `(lat, lng)` index until `limit` of them pass the filters.
+        """
+        locations = Location.filter_bbox(
+            Location.annotate_bookmarks(Location.objects.all(), user), *Location.circle_bbox(lat, lng, radius_meters))
+        if location_type:
+            locations = locations.filter(location_type=location_type)
+        if not location_index.built and radius_meters <= getattr(settings, 'GEOHASH_LOOKUP_MAX_RADIUS', 5000):
+            # Small circles are cheaper to read from the geohash cells than to build the index for
+            near = Location.get_near_by_geohash(locations, lat, lng, radius_meters)
+            if near is not None:
+                return [dict(location.serialize(user), distance=distance) for location, distance in near[:limit]]
+
+        distances, pks = location_index.within(lat, lng, radius_meters)
+        results = []
+        chunk = max(limit, 100)
+        for start in range(0, len(pks), chunk):
+            found = locations.in_bulk(pks[start:start + chunk].tolist())
+            for pk, distance in zip(pks[start:start + chunk].tolist(), distances[start:start + chunk].tolist()):
+                if pk in found:
+                    results.append(dict(found[pk].serialize(user), distance=distance))
+                    if len(results) == limit:
+                        return results
+        return results
+
+    @staticmethod
+    def get_in_bbox(user, south, west, north, east, location_type=None, center=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        Up to `limit` locations inside the box, serialized. With a `center` `(lat, lng)` they are
+        the closest ones to it, closest first and with their `distance` in meters; otherwise by pk.
+        """
+        locations = Location.filter_bbox(Location.objects.all(), south, west, north, east)
+        if location_type:
+            locations = locations.filter(location_type=location_type)
+        if center is None:
+            page = Location.annotate_bookmarks(locations, user).order_by('pk')[:limit]
+            return [location.serialize(user) for location in page]
+
+        rows = np.array(list(locations.values_list('location_id', 'lat', 'lng')), dtype=float).reshape(-1, 3)
+        distances = haversine_distances([center], rows[:, 1:])[0]
+        closest = np.argsort(distances, kind='stable')[:limit]
+        found = Location.annotate_bookmarks(Location.objects.all(), user).in_bulk(rows[closest, 0].astype(int).tolist())
+        return [dict(found[int(pk)].serialize(user), distance=distance)
+                for pk, distance in zip(rows[closest, 0].tolist(), distances[closest].tolist()) if int(pk) in found]
 
-        return loc_w_bookmark
+    @staticmethod
+    def get_in_view(user, south, west, north, east, zoom):
+        """
+        What a map shows of the box at `zoom`: `locations` standing on their own, serialized,
+        and `clusters` of nearby ones (see `TDMS.geometry.grid_clusters`), none past
+        `LOCATION_CLUSTER_MAX_ZOOM` unless the box holds more than `LOCATION_VIEW_MAX_LOCATIONS`.
+        At most that many locations are sent, `truncated` tells if some were left out.
+        Returns `None` for a box larger than `LOCATION_VIEW_MAX_PIXELS` on screen at `zoom`.
+        """
+        if max(view_pixels(south, west, north, east, zoom)) > getattr(settings, 'LOCATION_VIEW_MAX_PIXELS', 8192):
+            return None
+        rows = np.array(list(Location.filter_bbox(Location.objects.all(), south, west, north, east)
+                             .values_list('location_id', 'lat', 'lng')), dtype=float).reshape(-1, 3)
+        limit = getattr(settings, 'LOCATION_VIEW_MAX_LOCATIONS', 1000)
+        if zoom >= getattr(settings, 'LOCATION_CLUSTER_MAX_ZOOM', 16) and len(rows) <= limit:
+            singles, clusters = np.arange(len(rows)), np.empty((0, 7))
+        else:
+            # Past the max zoom too, a box with too many locations is clustered
+            singles, clusters = grid_clusters(
+                rows[:, 1:], zoom,
+                getattr(settings, 'LOCATION_CLUSTER_CELL_PIXELS', 60),
+                getattr(settings, 'LOCATION_CLUSTER_MIN_COUNT', 2))
+        locations = Location.annotate_bookmarks(
+            Location.objects.filter(pk__in=rows[singles[:limit], 0].astype(int).tolist()), user)
+        return {
+            'locations': [location.serialize(user) for location in locations],
+            'clusters': [
+                {'lat': lat, 'lng': lng, 'count': int(count), 'bounds': [[south, west], [north, east]]}
+                for lat, lng, count, south, west, north, east in clusters.tolist()
+            ],
+            'truncated': len(singles) > limit,
+        }
+
+    @staticmethod
+    def get_page_loc_w_bookmark(user, query='', cursor=None, page_size=DEFAULT_PAGE_SIZE):
+        """Keyset page of search results, newest first. Returns `(locations, next_cursor)`."""
+        locations = Location.annotate_bookmarks(Location.search_locations(query), user)
+        locations = locations.annotate(note_count=Note.count_by_location())
+        page, next_cursor = keyset_page(locations, ['-modified_at', '-location_id'], cursor, page_size)
+        return [loc.serialize(user) for loc in page], next_cursor
     
     @staticmethod
     def create_from_json(data):
@@ -196,6 +449,20 @@ class Location(models.Model):
         except:
             return None
 
+    @staticmethod
+    def clean_from_json(data):
+        """
+        Like `create_from_json`, but validates the fields and coordinates;
+        raises `ValidationError` for an invalid row. Used by bulk imports.
+        """
+        # Only a missing key becomes None: 0 is a valid coordinate
+        fields = {field: data.get(field) for field in Location.JSON_FIELDS}
+        location = Location(**fields)
+        location.clean_fields(exclude=['modified_at'])
+        if not (-90 <= location.lat <= 90 and -180 <= location.lng <= 180):
+            raise ValidationError({'lat': 'Coordinates are out of range.'})
+        return location
+
 
 
 class Bookmark(models.Model):
@@ -203,15 +470,78 @@ class Bookmark(models.Model):
     location = models.ForeignKey(Location, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'location'], name='bookmark_user_location_uniq'),
+        ]
+
     def __repr__(self):
         return f"{self.user.username} bookmarked {self.location.name}"
 
+    @staticmethod
+    def get_location_ids(user):
+        """IDs of the locations `user` bookmarked, cached until one of their bookmarks changes."""
+        return search_cache.get_or_set(
+            [bookmarks_version(user.pk)], ('bookmark_ids', user.pk),
+            lambda: frozenset(Bookmark.objects.filter(user=user).values_list('location_id', flat=True)),
+            kind='bookmark_ids')
+
+    @staticmethod
+    def inline_ids_limit():
+        """Most cached IDs written into a query as a list; past it, queries read the bookmark table."""
+        return getattr(settings, 'BOOKMARK_IDS_INLINE_MAX', 500)
+
+    @staticmethod
+    def set_many(user, location_ids, bookmarked):
+        """
+        Bookmark (or unbookmark) every location in `location_ids` for `user`, a few hundred
+        rows per `INSERT` (or `DELETE`). Returns the IDs whose state changed, as reported by
+        the statements themselves (`RETURNING`): a concurrent request that changed the same
+        bookmarks first gets them, not this one.
+        """
+        location_ids = list(dict.fromkeys(location_ids))
+        quote = connection.ops.quote_name
+        table = quote(Bookmark._meta.db_table)
+        now = Bookmark._meta.get_field('created_at').get_db_prep_value(timezone.now(), connection)
+        done = set()
+        # Three parameters a row stay below SQLite's limit on query parameters
+        chunk_size = 300
+        with transaction.atomic(), connection.cursor() as cursor:
+            for start in range(0, len(location_ids), chunk_size):
+                chunk = location_ids[start:start + chunk_size]
+                if bookmarked:
+                    sql = (
+                        f'INSERT INTO {table} ({quote("user_id")}, {quote("location_id")}, {quote("created_at")}) '
+                        f'VALUES {", ".join(["(%s, %s, %s)"] * len(chunk))} '
+                        f'ON CONFLICT DO NOTHING RETURNING {quote("location_id")}'
+                    )
+                    params = [value for location_id in chunk for value in (user.pk, location_id, now)]
+                else:
+                    sql = (
+                        f'DELETE FROM {table} WHERE {quote("user_id")} = %s '
+                        f'AND {quote("location_id")} IN ({", ".join(["%s"] * len(chunk))}) '
+                        f'RETURNING {quote("location_id")}'
+                    )
+                    params = [user.pk, *chunk]
+                cursor.execute(sql, params)
+                done.update(location_id for location_id, in cursor.fetchall())
+        changed = [location_id for location_id in location_ids if location_id in done]
+        if changed:
+            # Raw statements send no post_save or post_delete
+            search_cache.bump(bookmarks_version(user.pk))
+        return changed
+
 class Note(models.Model):
     author = models.ForeignKey(Account, on_delete=models.CASCADE)
     location = models.ForeignKey(Location, on_delete=models.CASCADE)
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['location', '-created_at', '-id'], name='note_location_created_idx'),
+        ]
+
     def __str__(self):
         return f"Note by {self.author.username} on {self.location.name}"
     
@@ -234,14 +564,38 @@ class Note(models.Model):
         return new_note
     
     @staticmethod
-    def get_note_list_by_loc_id(location_id):
-        location = Location.objects.get(location_id=location_id)
-        loc_notes = []
-        notes = Note.objects.filter(location=location)
-        if location:
-            loc_notes = [note.serialize() for note in notes]
-        
-        return loc_notes
+    def get_notes_etag(location_id):
+        """
+        Validator for the notes of a location: their count and newest `created_at`, which change
+        on every add or delete, and the location's `modified_at` for its name. One query.
+        """
+        # Not first(), its ORDER BY would sort the grouped row
+        row = next(iter(Location.objects.filter(pk=location_id)
+                        .annotate(note_count=Count('note'), last_note=Max('note__created_at'))
+                        .values_list('modified_at', 'note_count', 'last_note')), None)
+        if row is None:
+            return None
+        modified_at, note_count, last_note = row
+        return f'notes-{location_id}-{modified_at.timestamp()}-{note_count}-{last_note.timestamp() if last_note else 0}'
+
+    @staticmethod
+    def get_note_page(location_id, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+        """
+        Keyset page of a location's notes, newest first, with authors and location joined in.
+        Returns `(notes, next_cursor)`, or `None` if there is no such location.
+        """
+        notes = Note.objects.filter(location_id=location_id).select_related('author', 'location')
+        page, next_cursor = keyset_page(notes, ['-created_at', '-id'], cursor, page_size)
+        if not page and not Location.objects.filter(pk=location_id).exists():
+            return None
+        return [note.serialize() for note in page], next_cursor
+
+    @staticmethod
+    def count_by_location():
+        """`note_count` annotation for a Location queryset, as one correlated subquery."""
+        counts = (Note.objects.filter(location=OuterRef('pk')).order_by()
+                  .values('location').annotate(count=Count('pk')).values('count'))
+        return Coalesce(Subquery(counts, output_field=models.IntegerField()), 0)
     
 
 class Plan(models.Model):
@@ -252,12 +606,28 @@ class Plan(models.Model):
     est_distance = models.FloatField(blank=True, null=True)
     est_duration = models.FloatField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     status = models.CharField(
             max_length=6,
             choices=STATUS.choices,
             default=STATUS.PENDNG
         )
     route_data = JSONField(blank=True, null=True)
+    route_format = models.CharField(
+            max_length=8,
+            choices=ROUTE_FORMAT.choices,
+            default=ROUTE_FORMAT.POLYLINE
+        )
+
+    # Columns needed for plan listings, `route_data` is only loaded when a plan is opened
+    SUMMARY_FIELDS = ['id', 'plan_name', 'user__username', 'est_distance', 'est_duration', 'status', 'created_at']
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='plan_created_idx'),
+            models.Index(fields=['status', '-created_at', '-id'], name='plan_status_created_idx'),
+            models.Index(fields=['user', '-created_at', '-id'], name='plan_user_created_idx'),
+        ]
     
     def serialize(self):
         return {
@@ -268,7 +638,59 @@ class Plan(models.Model):
             'est_duration' : self.est_duration,
             'status' : self.get_status_display(),
         }
+
+    @staticmethod
+    def serialize_summary(row):
+        """Same shape as `serialize`, from a `values(*SUMMARY_FIELDS)` row."""
+        return {
+            'pk': row['id'],
+            'plan_name': row['plan_name'],
+            'username': row['user__username'],
+            'est_distance': row['est_distance'],
+            'est_duration': row['est_duration'],
+            'status': STATUS(row['status']).label,
+            'created_at': row['created_at'],
+        }
     
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        # Only when the route is written, not on e.g. a status change
+        if update_fields is None or 'route_data' in update_fields:
+            self.score_route()
+            # Route geometry is always stored as encoded polylines, see `TDMS.geometry`
+            self.route_data = compact_route_data(self.route_data)
+            self.route_format = ROUTE_FORMAT.POLYLINE
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'est_distance', 'est_duration', 'route_format'}
+        super().save(*args, **kwargs)
+
+    def score_route(self):
+        """Check the estimates sent by the browser against the length of the route geometry."""
+        if not self.route_data:
+            return
+        distance = path_lengths([route_coordinates(self.route_data[0])])[0]
+        self.est_distance, self.est_duration = Plan.checked_estimates(distance, self.est_distance, self.est_duration)
+
+    @staticmethod
+    def checked_estimates(distance, est_distance, est_duration):
+        """
+        `(est_distance, est_duration)` in meters and seconds, where a distance more than
+        `ROUTE_DISTANCE_TOLERANCE` away from the measured `distance` is replaced by it, and a
+        duration implying a speed outside `ROUTE_SPEED_RANGE_KMH` is derived from
+        `ROUTE_DEFAULT_SPEED_KMH` instead.
+        """
+        if not distance:
+            return est_distance, est_duration
+        est_distance = float(est_distance) if est_distance is not None else None
+        est_duration = float(est_duration) if est_duration is not None else None
+        if est_distance is None or abs(est_distance - distance) > getattr(settings, 'ROUTE_DISTANCE_TOLERANCE', 0.05) * distance:
+            est_distance = float(distance)
+
+        min_speed, max_speed = getattr(settings, 'ROUTE_SPEED_RANGE_KMH', (2, 130))
+        if not est_duration or not min_speed <= est_distance / est_duration * 3.6 <= max_speed:
+            est_duration = est_distance / (getattr(settings, 'ROUTE_DEFAULT_SPEED_KMH', 40) / 3.6)
+        return est_distance, est_duration
+
     def can_be_deleted(self):
         return self.status != STATUS.COMPLT
     
@@ -297,14 +719,56 @@ class Plan(models.Model):
     
     @staticmethod
     def get_plans(n=10, order="status"):
-        plans = Plan.objects.order_by(order)
-        return {str(plan.pk): plan.serialize() for plan in plans}
+        plans = Plan.objects.order_by(order).values(*Plan.SUMMARY_FIELDS)
+        if n is not None:
+            plans = plans[:n]
+        return {str(plan['id']): Plan.serialize_summary(plan) for plan in plans}
+
+    @staticmethod
+    def filter_plans(status=None, operator=None, created_from=None, created_to=None):
+        plans = Plan.objects.values(*Plan.SUMMARY_FIELDS)
+        if status:
+            plans = plans.filter(status=status)
+        if operator:
+            plans = plans.filter(user=operator)
+        if created_from:
+            plans = plans.filter(created_at__gte=start_of_day(created_from))
+        if created_to:
+            plans = plans.filter(created_at__lt=start_of_day(created_to + timedelta(days=1)))
+        return plans
+
+    @staticmethod
+    def export(file_format, filters=None):
+        """Streamed CSV or GeoJSON lines of the summaries of the plans matching `filters`."""
+        plans = Plan.filter_plans(**(filters or {})).order_by('pk')
+        return exports.export_lines(plans, Plan.SUMMARY_FIELDS, file_format)
+
+    @staticmethod
+    def get_plan_page(filters, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+        """Keyset page of plan summaries, newest first. Returns `(plans, next_cursor)`."""
+        plans, next_cursor = keyset_page(Plan.filter_plans(**filters), ['-created_at', '-id'], cursor, page_size)
+        return [Plan.serialize_summary(plan) for plan in plans], next_cursor
      
     @staticmethod
-    def get_plan_data_by_id(plan_id):
-        plan = Plan.objects.get(pk=plan_id)
+    def get_route_etag(plan_id):
+        """Validator for `get_plan_data_by_id`, from `updated_at` alone; `None` if there is no such plan."""
+        updated_at = Plan.objects.filter(pk=plan_id).values_list('updated_at', flat=True).first()
+        return f'plan-{plan_id}-{updated_at.timestamp()}' if updated_at else None
+
+    @staticmethod
+    def get_plan_data_by_id(plan_id, verbose=False, tolerance=None, zoom=None):
+        """
+        Route of a plan, simplified to `tolerance` meters or to the map `zoom` level if given,
+        with `coordinates` lists instead of polylines if `verbose`.
+        """
+        plan = Plan.objects.only('route_data').get(pk=plan_id)
+        # No-op on routes that are already compact, converts rows saved before polylines
+        route_data = select_route_level(compact_route_data(plan.route_data), tolerance, zoom)
+        if verbose:
+            route_data = expand_route_data(route_data)
         return {
-            'route_data': plan.route_data
+            'route_data': route_data,
+            'format': ROUTE_FORMAT.VERBOSE if verbose else ROUTE_FORMAT.POLYLINE,
         }    
         
     @staticmethod
@@ -341,8 +805,54 @@ class Log(models.Model):
 
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-timestamp', '-id'], name='log_timestamp_idx'),
+            models.Index(fields=['user', '-timestamp', '-id'], name='log_user_timestamp_idx'),
+            models.Index(fields=['action', '-timestamp', '-id'], name='log_action_timestamp_idx'),
+            models.Index(fields=['content_type', 'object_id', '-timestamp', '-id'], name='log_object_timestamp_idx'),
+        ]
+
     def __str__(self):
         return f"{self.username} {self.get_action_display()} a {self.content_type} | {self.field_name} at {self.timestamp}"
+
+    def serialize(self):
+        return {
+            'id': self.id,
+            'username': self.username,
+            'user_role': self.user.get_user_role_display() if self.user else None,
+            'action': self.get_action_display(),
+            'content_type': self.content_type.model if self.content_type else None,
+            'object_id': self.object_id,
+            'field_name': self.field_name,
+            'old_value': self.old_value,
+            'new_value': self.new_value,
+            'timestamp': self.timestamp,
+        }
+
+    @staticmethod
+    def filter_logs(user=None, action=None, content_type=None, object_id=None, date_from=None, date_to=None):
+        """Logs matching the given filters, each one served by an index in `Meta.indexes`."""
+        logs = Log.objects.select_related('user', 'content_type')
+        if user:
+            logs = logs.filter(user=user)
+        if action:
+            logs = logs.filter(action=action)
+        if content_type:
+            logs = logs.filter(content_type=content_type)
+        if object_id is not None:
+            logs = logs.filter(object_id=object_id)
+        # Compare on the raw timestamp rather than `__date` so the index stays usable
+        if date_from:
+            logs = logs.filter(timestamp__gte=start_of_day(date_from))
+        if date_to:
+            logs = logs.filter(timestamp__lt=start_of_day(date_to + timedelta(days=1)))
+        return logs
+
+    @staticmethod
+    def get_log_page(filters, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+        """Keyset page of logs, newest first. Returns `(logs, next_cursor)`."""
+        return keyset_page(Log.filter_logs(**filters), ['-timestamp', '-id'], cursor, page_size)
         
     @staticmethod
     def create_login_log(user: Account):
@@ -365,6 +875,15 @@ class Log(models.Model):
             action=ACTION.CREATE, content_object=location
         )
     
+    @staticmethod
+    def create_import_loc_log(user, source, imported, skipped):
+        """One summary row for a bulk location import; `user` may be `None` for the command line."""
+        return Log(
+            user=user, username=user.username if user else 'manage.py',
+            action=ACTION.CREATE, content_type=ContentType.objects.get_for_model(Location),
+            field_name='bulk import', new_value=f'{imported} locations imported from {source}, {skipped} skipped'
+        )
+
     @staticmethod
     def create_edit_loc_log(user: Account, location: Location, 
                             field_name, old_value, new_value):
@@ -407,7 +926,9 @@ class Log(models.Model):
             user=user, 
             username=user.username, 
             action=ACTION.DELETE, 
-            content_object=obj,
+            # Not `content_object`: the row may be written after `obj` is deleted
+            content_type=ContentType.objects.get_for_model(obj),
+            object_id=obj.pk,
             field_name='whole object',
             old_value=f'{obj_type} with info={obj}'
         )
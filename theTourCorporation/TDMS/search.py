@@ -0,0 +1,79 @@
+import re
+
+from django.db import connection
+from django.db.models import FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+# Must match the expression index created in migration 0015 so PostgreSQL can use it
+PG_DOCUMENT = "to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(address, ''))"
+SQLITE_FTS_TABLE = 'tdms_location_fts'
+
+
+def search_terms(query):
+    return re.findall(r'\w+', query)
+
+
+def escape_like(query):
+    return query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _postgresql_search(locations, query, table):
+    terms = search_terms(query)
+    like = f'%{escape_like(query)}%'
+    # Prefix match on every term, so results keep up while the user is typing
+    tsquery = ' & '.join(f'{term}:*' for term in terms)
+
+    # ILIKE is served by the gin_trgm_ops indexes, @@ by the tsvector index
+    where = 'name ILIKE %s OR address ILIKE %s'
+    params = [like, like]
+    if terms:
+        where += f" OR {PG_DOCUMENT} @@ to_tsquery('simple', %s)"
+        params.append(tsquery)
+    matches = RawSQL(f'SELECT location_id FROM "{table}" WHERE {where}', params)
+
+    rank = (
+        f"greatest(similarity(coalesce(\"{table}\".name, ''), %s), similarity(coalesce(\"{table}\".address, ''), %s))"
+    )
+    rank_params = [query, query]
+    if terms:
+        rank += f" + ts_rank(to_tsvector('simple', coalesce(\"{table}\".name, '') || ' ' || coalesce(\"{table}\".address, '')), to_tsquery('simple', %s))"
+        rank_params.append(tsquery)
+
+    return locations.filter(pk__in=matches).annotate(rank=RawSQL(rank, rank_params, output_field=FloatField()))
+
+
+def _sqlite_search(locations, query, table):
+    terms = search_terms(query)
+    if not terms:
+        # Nothing FTS5 can match, such as punctuation only
+        return _like_search(locations, query)
+    match = ' '.join(f'"{term}"*' for term in terms)
+
+    # bm25(), which is lower-is-better, only works inside a MATCH query on the FTS table. The
+    # ranks are computed once into a materialized CTE (SQLite 3.35+; older versions inline it and
+    # rerun the MATCH for every row) and looked up per row through an automatic index
+    materialized = 'MATERIALIZED ' if connection.Database.sqlite_version_info >= (3, 35) else ''
+    rank = (f'WITH ranks AS {materialized}(SELECT rowid AS location_id, -bm25({SQLITE_FTS_TABLE}) AS rank '
+            f'FROM {SQLITE_FTS_TABLE} WHERE {SQLITE_FTS_TABLE} MATCH %s) '
+            f'SELECT rank FROM ranks WHERE ranks.location_id = "{table}".location_id')
+    matches = RawSQL(f'SELECT rowid FROM {SQLITE_FTS_TABLE} WHERE {SQLITE_FTS_TABLE} MATCH %s', [match])
+    return locations.filter(pk__in=matches).annotate(rank=RawSQL(rank, [match], output_field=FloatField()))
+
+
+def _like_search(locations, query):
+    return locations.filter(Q(name__icontains=query) | Q(address__icontains=query)).annotate(
+        rank=Value(0.0, output_field=FloatField()))
+
+
+def search(locations, query):
+    """
+    Filter a Location queryset by `query` and annotate a relevance `rank` (higher is better).
+    Backed by trigram and tsvector indexes on PostgreSQL and by an FTS5 table on SQLite,
+    both kept in sync by the database itself (see migration 0015).
+    """
+    table = locations.model._meta.db_table
+    if connection.vendor == 'postgresql':
+        return _postgresql_search(locations, query, table)
+    if connection.vendor == 'sqlite':
+        return _sqlite_search(locations, query, table)
+    return _like_search(locations, query)
@@ -0,0 +1,30 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from TDMS.cache import LOCATIONS_VERSION, bookmarks_version, search_cache
+from TDMS.models import Bookmark, Location, Note
+from TDMS.spatial import location_index
+
+
+@receiver(post_save, sender=Location)
+def update_location_index(sender, instance, **kwargs):
+    location_index.upsert(instance.pk, instance.lat, instance.lng)
+
+
+@receiver(post_delete, sender=Location)
+def remove_from_location_index(sender, instance, **kwargs):
+    location_index.remove(instance.pk)
+
+
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+@receiver(post_save, sender=Note)
+@receiver(post_delete, sender=Note)
+def invalidate_location_searches(sender, instance, **kwargs):
+    search_cache.bump(LOCATIONS_VERSION)
+
+
+@receiver(post_save, sender=Bookmark)
+@receiver(post_delete, sender=Bookmark)
+def invalidate_bookmark_searches(sender, instance, **kwargs):
+    search_cache.bump(bookmarks_version(instance.user_id))
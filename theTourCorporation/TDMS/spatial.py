@@ -0,0 +1,222 @@
+import threading
+import time
+
+import numpy as np
+from django.apps import apps
+from django.conf import settings
+from django.db.models import Count, Max
+from sklearn.neighbors import BallTree
+
+from TDMS.metrics import spatial_index_build, spatial_index_sync
+
+EARTH_RADIUS_METERS = 6371000
+
+
+def haversine_distances(a, b):
+    """Great-circle distance matrix in meters between `(lat, lng)` degree arrays `a` (m, 2) and `b` (p, 2)."""
+    a = np.radians(np.asarray(a, dtype=float).reshape(-1, 2))
+    b = np.radians(np.asarray(b, dtype=float).reshape(-1, 2))
+    dlat = b[None, :, 0] - a[:, None, 0]
+    dlng = b[None, :, 1] - a[:, None, 1]
+    h = np.sin(dlat / 2) ** 2 + np.cos(a[:, None, 0]) * np.cos(b[None, :, 0]) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+class SpatialIndex:
+    """
+    Process-wide haversine BallTree over a model with `lat`, `lng` and `modified_at` fields.
+
+    The tree is built once, on first use. Saves and deletes made in this process are
+    applied through `upsert`/`remove` (see `TDMS.signals`): moved or new rows go to a
+    small brute-force buffer and stale tree rows are masked out, until the buffer grows
+    past `SPATIAL_INDEX_REBUILD_THRESHOLD` and the tree is recompacted in memory.
+    Changes made by other processes are picked up every `SPATIAL_INDEX_SYNC_INTERVAL`
+    seconds through a `modified_at` high-water mark and a row count check.
+    """
+
+    def __init__(self, model_label):
+        self.model_label = model_label
+        self._lock = threading.RLock()
+        self.reset()
+
+    @property
+    def model(self):
+        return apps.get_model(self.model_label)
+
+    @property
+    def rebuild_threshold(self):
+        return getattr(settings, 'SPATIAL_INDEX_REBUILD_THRESHOLD', 256)
+
+    @property
+    def sync_interval(self):
+        return getattr(settings, 'SPATIAL_INDEX_SYNC_INTERVAL', 5.0)
+
+    def reset(self):
+        """Drop the index, it is rebuilt from the database on next use."""
+        with self._lock:
+            self._built = False
+            self._tree = None
+            self._ids = np.empty(0, dtype=np.int64)
+            self._coords = np.empty((0, 2))
+            self._positions = {}
+            self._removed = set()
+            self._pending = {}
+            self._high_water = None
+            self._last_sync = 0.0
+
+    @property
+    def built(self):
+        return self._built
+
+    def __len__(self):
+        with self._lock:
+            # Moved rows are both masked in the tree and buffered in `_pending`
+            return len(self._ids) - len(self._removed) + len(self._pending)
+
+    def build(self):
+        """(Re)load every row from the database."""
+        with self._lock:
+            start = time.perf_counter()
+            rows = np.array(list(self.model.objects.values_list('pk', 'lat', 'lng')), dtype=float).reshape(-1, 3)
+            stats = self.model.objects.aggregate(high_water=Max('modified_at'))
+            self._load(rows[:, 0].astype(np.int64), rows[:, 1:])
+            self._high_water = stats['high_water']
+            self._last_sync = time.monotonic()
+            self._built = True
+            spatial_index_build.observe(time.perf_counter() - start)
+
+    def _load(self, ids, coords):
+        self._ids = ids
+        self._coords = coords
+        self._positions = {int(pk): i for i, pk in enumerate(ids)}
+        self._removed = set()
+        self._pending = {}
+        self._tree = BallTree(np.radians(coords), leaf_size=15, metric='haversine') if len(ids) else None
+
+    def _compact(self):
+        stale = np.fromiter(self._removed | self._pending.keys(), dtype=np.int64)
+        keep = ~np.isin(self._ids, stale)
+        ids = np.concatenate([self._ids[keep], np.fromiter(self._pending.keys(), dtype=np.int64, count=len(self._pending))])
+        coords = np.concatenate([self._coords[keep], np.array(list(self._pending.values()), dtype=float).reshape(-1, 2)])
+        self._load(ids, coords)
+
+    def upsert(self, pk, lat, lng):
+        """Record a new or moved row."""
+        with self._lock:
+            if not self._built:
+                return
+            pk = int(pk)
+            if pk in self._positions:
+                self._removed.add(pk)
+            self._pending[pk] = (float(lat), float(lng))
+            self._maybe_compact()
+
+    def upsert_many(self, rows):
+        """Record many new or moved `(pk, lat, lng)` rows, recompacting at most once."""
+        with self._lock:
+            if not self._built:
+                return
+            for pk, lat, lng in rows:
+                pk = int(pk)
+                if pk in self._positions:
+                    self._removed.add(pk)
+                self._pending[pk] = (float(lat), float(lng))
+            self._maybe_compact()
+
+    def remove(self, pk):
+        """Record a deleted row."""
+        with self._lock:
+            if not self._built:
+                return
+            pk = int(pk)
+            if pk in self._positions:
+                self._removed.add(pk)
+            self._pending.pop(pk, None)
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        if len(self._pending) + len(self._removed) > self.rebuild_threshold:
+            self._compact()
+
+    def sync(self, force=False):
+        """Build the index if needed and pull in rows changed by other processes."""
+        with self._lock:
+            if not self._built:
+                self.build()
+                return
+            if not force and time.monotonic() - self._last_sync < self.sync_interval:
+                return
+            start = time.perf_counter()
+            self._last_sync = time.monotonic()
+            stats = self.model.objects.aggregate(high_water=Max('modified_at'), count=Count('pk'))
+            if stats['high_water'] is not None and (self._high_water is None or stats['high_water'] > self._high_water):
+                changed = self.model.objects.filter(modified_at__gt=self._high_water) if self._high_water else self.model.objects.all()
+                self.upsert_many(changed.values_list('pk', 'lat', 'lng'))
+                self._high_water = stats['high_water']
+            if stats['count'] != len(self):
+                # Rows were deleted elsewhere, the high-water mark cannot see those
+                self.build()
+            spatial_index_sync.observe(time.perf_counter() - start)
+
+    def nearest(self, coords):
+        """
+        Closest indexed row for every `(lat, lng)` pair in `coords`.
+        Returns `(distances_meters, pks)`; pk is -1 when the index is empty.
+        """
+        points = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self.sync()
+        with self._lock:
+            best_dist = np.full(len(points), np.inf)
+            best_pk = np.full(len(points), -1, dtype=np.int64)
+            if len(points) == 0:
+                return best_dist, best_pk
+
+            if self._tree is not None and len(self._removed) < len(self._ids):
+                # Ask for enough neighbours that at least one of them is not stale
+                k = min(len(self._ids), len(self._removed) + 1)
+                dist, ind = self._tree.query(np.radians(points), k=k)
+                pks = self._ids[ind]
+                if self._removed:
+                    dist[np.isin(pks, np.fromiter(self._removed, dtype=np.int64))] = np.inf
+                col = np.argmin(dist, axis=1)
+                rows = np.arange(len(points))
+                best_dist = dist[rows, col] * EARTH_RADIUS_METERS
+                best_pk = np.where(np.isfinite(best_dist), pks[rows, col], -1)
+
+            if self._pending:
+                pending_pks = np.fromiter(self._pending.keys(), dtype=np.int64, count=len(self._pending))
+                dist = haversine_distances(points, list(self._pending.values()))
+                col = np.argmin(dist, axis=1)
+                pending_dist = dist[np.arange(len(points)), col]
+                closer = pending_dist < best_dist
+                best_dist = np.where(closer, pending_dist, best_dist)
+                best_pk = np.where(closer, pending_pks[col], best_pk)
+
+            return best_dist, best_pk
+
+    def within(self, lat, lng, radius_meters):
+        """Every indexed row within `radius_meters` of `(lat, lng)`, closest first, as `(distances_meters, pks)`."""
+        point = np.radians([[lat, lng]])
+        self.sync()
+        with self._lock:
+            distances = np.empty(0)
+            pks = np.empty(0, dtype=np.int64)
+            if self._tree is not None:
+                ind, dist = self._tree.query_radius(point, r=radius_meters / EARTH_RADIUS_METERS, return_distance=True)
+                pks, distances = self._ids[ind[0]], dist[0] * EARTH_RADIUS_METERS
+                if self._removed:
+                    fresh = ~np.isin(pks, np.fromiter(self._removed, dtype=np.int64))
+                    pks, distances = pks[fresh], distances[fresh]
+
+            if self._pending:
+                pending_pks = np.fromiter(self._pending.keys(), dtype=np.int64, count=len(self._pending))
+                pending_dist = haversine_distances([(lat, lng)], list(self._pending.values()))[0]
+                close = pending_dist <= radius_meters
+                pks = np.concatenate([pks, pending_pks[close]])
+                distances = np.concatenate([distances, pending_dist[close]])
+
+            order = np.argsort(distances, kind='stable')
+            return distances[order], pks[order]
+
+
+location_index = SpatialIndex('TDMS.Location')
@@ -5,6 +5,14 @@ const viewNotesModalLabel = $('#viewNotesModalLabel')
 const locationList = $("#locationList");
 const locationCount = $("#locationCount")
 const notesList = $('#notesList');
+const loadMoreButton = $('#loadMoreLocations');
+const allLocationsPageSize = 100;
+
+const loadMoreNotesButton = $('#loadMoreNotes');
+
+var nextLocationsCursor = null;
+var nextNotesCursor = null;
+var shownLocations = 0;
 
 var currentLocationSelected;
 
@@ -31,7 +39,7 @@ function createLocationRow(location) {
             <td>${formatDateModified(location.modified_at)}</td>
             <td>
                 <i class='fa-star ${location.is_bookmarked ? "fas" : "far"}' data-location-id='${location.pk}'></i>
-                <button class='view-notes btn btn-info' data-location-id='${location.pk}'>View Notes</button>
+                <button class='view-notes btn btn-info' data-location-id='${location.pk}'>View Notes (${location.note_count})</button>
                 <button class='add-note btn btn-secondary' data-location-id='${location.pk}'>Add Note</button>
                 <button class='edit-location btn btn-warning' data-location-id='${location.pk}'>Edit Location</button>
                 <button class='delete-location btn btn-danger' data-location-id='${location.pk}'>Delete Location</button>
@@ -39,18 +47,22 @@ function createLocationRow(location) {
         </tr>`;
 };
 
-function updateLocationList(locations) {
-    locationList.empty();
+function updateLocationList(locations, append=false) {
+    if (!append) {
+        locationList.empty();
+        loadMoreButton.hide();
+    }
     if (locations.length > 0) {
         $.each(locations, function(index, location) {
             locationList.append(createLocationRow(location));
         });
-    } else {
+    } else if (!append) {
         locationList.append("<tr><td colspan='3'>No locations found.</td></tr>");
     }
 
     // Update the location count text
-    locationCount.text(`Showing ${locations.length} locations...`);
+    shownLocations = append ? shownLocations + locations.length : locations.length;
+    locationCount.text(`Showing ${shownLocations} locations...`);
 };
 
 function createDeleteNoteButton(username, author, note_id) {
@@ -82,13 +94,32 @@ function fetchLocations(query, n=10) {
     )
 };
 
-function updateNotesList(notes) {
-    notesList.empty();
+// "View all locations" goes page by page instead of loading the whole table
+function fetchAllLocations(cursor=null) {
+    var data = {'q': '', 'page_size': allLocationsPageSize};
+    if (cursor) {
+        data.cursor = cursor;
+    }
+    makeGetAjaxCallWithData(
+        searchURL, data,
+        function(page) {
+            updateLocationList(page.results, cursor !== null);
+            nextLocationsCursor = page.next_cursor;
+            loadMoreButton.toggle(nextLocationsCursor !== null);
+        },
+        alertError
+    )
+};
+
+function updateNotesList(notes, append=false) {
+    if (!append) {
+        notesList.empty();
+    }
     if (notes.length > 0) {
         $.each(notes, function(index, note) {
             notesList.append(createNoteElement(note));
         });
-    } else {
+    } else if (!append) {
         notesList.append("<p>No notes found.</p>");
     }
     viewNoteModal.modal('show');
@@ -120,13 +151,17 @@ function handleDeleteBookmark(data) {
     }
 }
 
-function fetchNotes(locationId) {
+function fetchNotes(locationId, cursor=null) {
+    var data = {'location_id': locationId};
+    if (cursor) {
+        data.cursor = cursor;
+    }
     makeGetAjaxCallWithData(
-        fetchNotesURL, {
-            'location_id': locationId
-        },
-        function (data) {
-            updateNotesList(JSON.parse(data));
+        fetchNotesURL, data,
+        function (page) {
+            updateNotesList(page.results, cursor !== null);
+            nextNotesCursor = page.next_cursor;
+            loadMoreNotesButton.toggle(nextNotesCursor !== null);
         },
         alertError
     )
@@ -156,7 +191,11 @@ $(document).ready(function(){
 
     // View all locations
     $("#searchAllButton").on("click", function() {
-        fetchLocations('', null);
+        fetchAllLocations();
+    });
+
+    loadMoreButton.on("click", function() {
+        fetchAllLocations(nextLocationsCursor);
     });
 
     // Handle the "View Notes" action
@@ -167,6 +206,10 @@ $(document).ready(function(){
         viewNotesModalLabel.text('View notes for ' + locationName);
     });
     
+    loadMoreNotesButton.on('click', function() {
+        fetchNotes(currentLocationSelected, nextNotesCursor);
+    });
+    
     // Handle the "Add Note" action
     $(document).on('click', '.add-note', function() {
         var locationId = $(this).data('location-id');
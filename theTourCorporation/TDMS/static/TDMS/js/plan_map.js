@@ -15,6 +15,11 @@ const locationList = $("#locationList");
 
 var locationsById = {};
 
+// Locations and clusters of the current viewport
+var viewLayer;
+var viewRequest = 0;
+var hideNonBookmarked = false;
+
 // Load locations to object
 
 locations.forEach(function(location) {
@@ -90,17 +95,84 @@ function createLocationRow(location, vehicles) {
     </tr>`;
 }
 
+function isSelected(locationId) {
+    return $('#anchor' + locationId).is(':checked') || $('#sub' + locationId).is(':checked');
+}
+
+// Add rows for locations not listed yet, and drop the unselected rows of locations out of view
 function updateLocationList(locations, vehicles) {
-    locationList.empty();
-    if (Object.keys(locations).length != 0) {
-        $.each(locations, function(index, location) {
-            locationList.append(createLocationRow(location, vehicles));
-        });
-    } else {
-        locationList.append("<tr><td colspan='3'>No plan found.</td></tr>");
+    var inView = {};
+    locations.forEach(function(location) {
+        inView[location.pk] = true;
+        locationsById[location.pk] = location;
+        if ($('#location' + location.pk).length === 0) {
+            var row = $(createLocationRow(location, vehicles));
+            if (hideNonBookmarked && !location.is_bookmarked) {
+                row.hide();
+            }
+            locationList.append(row);
+        }
+    });
+    locationList.children('tr').each(function() {
+        var locationId = this.id.replace('location', '');
+        if (!inView[locationId] && !isSelected(locationId)) {
+            $(this).remove();
+        }
+    });
+    $('#noLocations').remove();
+    if (locationList.children('tr').length === 0) {
+        locationList.append("<tr id='noLocations'><td colspan='5'>No locations here, zoom in on a cluster or move the map.</td></tr>");
     }
 }
 
+function createClusterMarker(cluster) {
+    var size = 30 + 6 * Math.min(Math.floor(Math.log10(cluster.count)), 4);
+    var marker = L.marker([cluster.lat, cluster.lng], {
+        icon: L.divIcon({
+            className: 'location-cluster',
+            html: `<div style="width:${size}px;height:${size}px;line-height:${size}px">${cluster.count}</div>`,
+            iconSize: [size, size]
+        })
+    });
+    marker.on('click', function() {
+        map.fitBounds(cluster.bounds);
+    });
+    return marker;
+}
+
+function createLocationDot(location) {
+    return L.circleMarker([location.lat, location.lng], {radius: 5, color: '#3388ff', fillOpacity: 0.8})
+        .bindTooltip(location.name || location.address || '');
+}
+
+function showLocationsInView(data) {
+    viewLayer.clearLayers();
+    data.clusters.forEach(function(cluster) {
+        viewLayer.addLayer(createClusterMarker(cluster));
+    });
+    data.locations.forEach(function(location) {
+        viewLayer.addLayer(createLocationDot(location));
+    });
+    updateLocationList(data.locations, vehicles);
+}
+
+function fetchLocationsInView() {
+    var request = ++viewRequest;
+    makeGetAjaxCallWithData(
+        locationsInViewURL, {
+            bbox: map.getBounds().toBBoxString(),
+            zoom: map.getZoom()
+        },
+        function(data) {
+            // Ignore answers to viewports the map has already left
+            if (request === viewRequest) {
+                showLocationsInView(data);
+            }
+        },
+        consoleLogError
+    );
+}
+
 
 const anchorOptions = {
     title: "",
@@ -126,6 +198,7 @@ function initMap() {
         maxZoom: 19,
     }).addTo(map);
     polyline = L.polyline([], {color: 'red'}).addTo(map); 
+    viewLayer = L.layerGroup().addTo(map);
 }
 
 function createCircle(L, latLng, color='red', fillColor='#f03', fillOpacity=0.2, radius=0) {
@@ -253,6 +326,36 @@ function updateMessage(totalDistance, totalTimeSeconds) {
     messageField.innerHTML = `Distance: ${(totalDistance / 1000).toFixed(3)} km; Est duration: ${(totalTimeSeconds / 3600).toFixed(3)} hours.`;
 }
 
+function findLocationId(latLng) {
+    for (var markerList of [markers, sub_markers]) {
+        for (var locationId in markerList) {
+            if (markerList[locationId].marker.getLatLng().equals(latLng)) {
+                return locationId;
+            }
+        }
+    }
+    return null;
+}
+
+function optimizeOrder() {
+    var locationIds = polyline.getLatLngs().map(findLocationId);
+    if (locationIds.length < 3 || locationIds.includes(null)) {
+        alert("Select at least 3 locations on the map to optimize their order.");
+        return;
+    }
+    makePostAjaxCallWithData(
+        'optimize_route',
+        JSON.stringify({location_ids: locationIds}),
+        function(response) {
+            polyline.setLatLngs(response.location_ids.map(function(locationId) {
+                return markers[locationId] ? markers[locationId].marker.getLatLng() : sub_markers[locationId].marker.getLatLng();
+            }));
+            messageField.innerHTML = `Straight-line distance: ${(response.naive_distance / 1000).toFixed(3)} km -> ${(response.distance / 1000).toFixed(3)} km. Create Route to update the road route.`;
+        },
+        consoleLogError
+    );
+}
+
 function createControl(serviceUrl=osrmLink) {
     var control = L.Routing.control({
         waypoints: polyline.getLatLngs(),
@@ -277,12 +380,14 @@ $(document).ready(function() {
     if(refillData) {
         initAddMarkersEdit();
     }
+    map.on('moveend', fetchLocationsInView);
+    fetchLocationsInView();
 
     
     
     console.log($('#planId').val());
 
-    $('.is_anchor, .is_sub').on('click', function() {
+    $(document).on('click', '.is_anchor, .is_sub', function() {
         var locationId = $(this).data('location-id');
     
         var isAnchor = $(this).hasClass('is_anchor');
@@ -303,7 +408,9 @@ $(document).ready(function() {
         }
     });
     
-    $('input[id^="duration"], select[id^="vehicle"]').on('input change', updateRadius);
+    $(document).on('input change', 'input[id^="duration"], select[id^="vehicle"]', updateRadius);
+
+    $('#optimizeOrderButton').click(optimizeOrder);
 
     $('#createRouteButton').click(function() {
         if (control) {
@@ -361,7 +468,8 @@ $(document).ready(function() {
     $('#toggleLocations').on('click', function() {
         var button = $(this);
         
-        if (button.text() === 'Hide Non-Bookmarked Locations') {
+        hideNonBookmarked = button.text() === 'Hide Non-Bookmarked Locations';
+        if (hideNonBookmarked) {
             // Loop over the locations
             for (var locationId in locationsById) {
                 var location = locationsById[locationId];
@@ -377,7 +485,7 @@ $(document).ready(function() {
             button.removeClass('btn-primary').addClass('btn-success');
         } else {
             // Show all table rows
-            $('tr').show();
+            locationList.children('tr').show();
             
             // Change the button text
             button.text('Hide Non-Bookmarked Locations');
@@ -72,11 +72,69 @@ function updatePlanList(plans) {
     } else {
         planList.append("<tr><td colspan='3'>No plan found.</td></tr>");
     }
+    updateLoadMoreButton();
 }
 
+function updateLoadMoreButton() {
+    $('#loadMorePlans').toggle(Boolean(nextPlansCursor));
+}
+
+function loadMorePlans() {
+    // Keep the filters of the current page and ask for the page after the last loaded plan
+    var params = new URLSearchParams(window.location.search);
+    params.set('cursor', nextPlansCursor);
+    makeGetAjaxCallWithData(
+        getPlansURL, params.toString(),
+        function(data) {
+            $.each(data.results, function(index, plan) {
+                planList.append(createPlanRow(plan));
+            });
+            nextPlansCursor = data.next_cursor;
+            updateLoadMoreButton();
+        },
+        alertError
+    )
+}
+
+const initialPlanZoom = 13;
+var routePolyline;
+var loadedRouteZoom;
+var displayedPlanId = null;
+
 function displayPlan(planId) {
-    makeGetAjaxCallWithId(
-        planId, 'get_plan_route', planGetSuccess, consoleLogError
+    displayedPlanId = planId;
+    // Ask for a line simplified to the zoom level the map opens at
+    makeGetAjaxCallWithData(
+        'get_plan_route/' + planId + '/', { 'zoom': initialPlanZoom },
+        function(data) {
+            // Another plan was opened while this one loaded
+            if (planId !== displayedPlanId) return;
+            loadedRouteZoom = initialPlanZoom;
+            planGetSuccess(data);
+            // One handler for every plan, it refines whichever one is displayed
+            map.off('zoomend', refineDisplayedRoute);
+            map.on('zoomend', refineDisplayedRoute);
+        },
+        consoleLogError
+    )
+}
+
+function refineDisplayedRoute() {
+    if (displayedPlanId !== null) refineRoute(displayedPlanId);
+}
+
+function refineRoute(planId) {
+    // Fetch more detail only when zooming in past what is already loaded
+    var zoom = map.getZoom();
+    if (zoom <= loadedRouteZoom) return;
+    loadedRouteZoom = zoom;
+    makeGetAjaxCallWithData(
+        'get_plan_route/' + planId + '/', { 'zoom': zoom },
+        function(data) {
+            if (planId !== displayedPlanId) return;
+            routePolyline.setLatLngs(getRouteLatLngs(data.route_data[0]));
+        },
+        consoleLogError
     )
 }
 
@@ -95,7 +153,7 @@ function planGetSuccess(data) {
     // Create a Leaflet map
     map = L.map('map').setView([
         data.route_data[0].waypoints[0].latLng.lat, data.route_data[0].waypoints[0].latLng.lng
-    ], 13);
+    ], initialPlanZoom);
 
 
 
@@ -105,11 +163,9 @@ function planGetSuccess(data) {
     }).addTo(map);
 
     // Create a polyline from the route data and add it to the map
-    var latlngs = data.route_data[0].coordinates.map(function(coordinate) {
-        return [coordinate.lat, coordinate.lng];
-    });
+    var latlngs = getRouteLatLngs(data.route_data[0]);
     // Create a polyline with renderer option set to L.canvas()
-    var polyline = L.polyline(latlngs, { renderer: L.canvas() }).addTo(map);
+    routePolyline = L.polyline(latlngs, { renderer: L.canvas() }).addTo(map);
 
     // Add markers for the waypoints
     data.route_data[0].waypoints.forEach(function(waypoint) {
@@ -202,6 +258,38 @@ $('#saveImage').click(function() {
 });
 
 
+function decodePolyline(encoded, precision = 5) {
+    // Google polyline algorithm, the server stores route geometry in this form
+    var latlngs = [];
+    var factor = Math.pow(10, precision);
+    var index = 0, lat = 0, lng = 0;
+    while (index < encoded.length) {
+        var deltas = [0, 0];
+        for (var i = 0; i < 2; i++) {
+            var result = 0, shift = 0, byte;
+            do {
+                byte = encoded.charCodeAt(index++) - 63;
+                result |= (byte & 0x1f) << shift;
+                shift += 5;
+            } while (byte >= 0x20);
+            deltas[i] = (result & 1) ? ~(result >> 1) : (result >> 1);
+        }
+        lat += deltas[0];
+        lng += deltas[1];
+        latlngs.push([lat / factor, lng / factor]);
+    }
+    return latlngs;
+}
+
+function getRouteLatLngs(route) {
+    if (route.polyline !== undefined) {
+        return decodePolyline(route.polyline);
+    }
+    return route.coordinates.map(function(coordinate) {
+        return [coordinate.lat, coordinate.lng];
+    });
+}
+
 function getWaypointCoordinates(waypoints) {
     var coordinates = [];
     waypoints.forEach(element => {
@@ -277,6 +365,8 @@ function planDeleteSuccess(data) {
 $(document).ready(function() {
     updatePlanList(plans);
 
+    $('#loadMorePlans').click(loadMorePlans);
+
     $(document).on('click', '.view-plan', function() {
         displayPlan($(this).data('plan-id'));
     });
@@ -1,3 +1,1288 @@
-from django.test import TestCase
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+from datetime import timedelta
+from io import StringIO
 
-# Create your tests here.
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Q
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from TDMS import geohash, metrics
+from TDMS.audit import log_sink
+from TDMS.cache import search_cache
+from TDMS.geometry import (
+    ROUTE_LEVEL_TOLERANCES, compact_route_data, decode_polyline, douglas_peucker_significance, encode_polyline,
+    expand_route_data, select_route_level,
+)
+from TDMS.models import ACTION, Account, Bookmark, Location, Log, Note, Plan, ROUTE_FORMAT, STATUS
+from TDMS.pagination import MAX_PAGE_SIZE, InvalidCursor, encode_cursor, keyset_page, parse_page_size
+from TDMS.spatial import EARTH_RADIUS_METERS, location_index
+from TDMS.tour import optimize_order, tour_length
+
+HOT_TABLES = {
+    Location._meta.db_table, Log._meta.db_table, Plan._meta.db_table,
+    Note._meta.db_table, Bookmark._meta.db_table,
+}
+# Full table scans, as reported by SQLite's EXPLAIN QUERY PLAN and PostgreSQL's EXPLAIN
+SQLITE_FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?"?(\w+)"?$')
+POSTGRESQL_FULL_SCAN = re.compile(r'Seq Scan on "?(\w+)"?')
+
+
+def haversine(a, b):
+    """Reference great-circle distance in meters between two `(lat, lng)` points."""
+    lat1, lng1, lat2, lng2 = map(math.radians, (*a, *b))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(min(h, 1.0)))
+
+
+def random_locations(rng, count):
+    """Unsaved locations around Ho Chi Minh City, plus a few by the poles and the antimeridian."""
+    locations = [Location(lat=rng.uniform(10.5, 11), lng=rng.uniform(106.4, 107), name=f'Place {i}') for i in range(count)]
+    locations += [Location(lat=lat, lng=lng, name=f'Edge {lat} {lng}')
+                  for lat, lng in ((89.99, 0), (-89.99, 45), (0, 179.999), (0, -179.999), (-33.9, 151.2))]
+    return locations
+
+
+class QueryPlanTests(TestCase):
+    """
+    The queries behind the listing views must be served by indexes: no full scan of a hot
+    table, and for keyset pages no sort either, the index returns rows in page order.
+    The tables are seeded and analyzed first so the planner has statistics to go on.
+    """
+
+    LOCATIONS = 3000
+    PLANS = 3000
+    LOGS = 6000
+    NOTES = 6000
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [Account.objects.create_user(f'user{i}@example.com', 'pw', ssn=str(i)) for i in range(10)]
+        cls.user = cls.users[0]
+        Location.objects.bulk_create([
+            Location(lat=10 + i % 100 / 100, lng=106 + i // 100 / 100, name=f'Place {i}', address=f'{i} Street')
+            for i in range(cls.LOCATIONS)
+        ])
+        locations = list(Location.objects.order_by('pk'))
+        cls.location = locations[0]
+        Bookmark.objects.bulk_create([Bookmark(user=cls.user, location=location) for location in locations[::50]])
+        Note.objects.bulk_create([
+            Note(author=cls.users[i % 10], location=locations[i % 200], content=f'Note {i}') for i in range(cls.NOTES)
+        ])
+        statuses = list(STATUS.values)
+        Plan.objects.bulk_create([
+            Plan(user=cls.users[i % 10], plan_name=f'Plan {i}', status=statuses[i % len(statuses)], route_data=[])
+            for i in range(cls.PLANS)
+        ])
+        location_type = ContentType.objects.get_for_model(Location)
+        actions = list(ACTION.values)
+        Log.objects.bulk_create([
+            Log(user=cls.users[i % 10], username=cls.users[i % 10].username, action=actions[i % len(actions)],
+                content_type=location_type, object_id=locations[i % cls.LOCATIONS].pk)
+            for i in range(cls.LOGS)
+        ])
+        # auto_now_add fields all got the same value, spread them out so the orderings mean something
+        now = timezone.now()
+        for model, field in ((Plan, 'created_at'), (Log, 'timestamp'), (Note, 'created_at'), (Location, 'modified_at')):
+            for pk in model.objects.values_list('pk', flat=True):
+                model.objects.filter(pk=pk).update(**{field: now - timedelta(minutes=pk)})
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        # A cached search response would run no query at all
+        search_cache.cache.clear()
+        self.client.force_login(self.user)
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                return [row[-1] for row in cursor.fetchall()]
+            cursor.execute(f'EXPLAIN {sql}')
+            return [row[0] for row in cursor.fetchall()]
+
+    def full_scans(self, plan):
+        pattern = SQLITE_FULL_SCAN if connection.vendor == 'sqlite' else POSTGRESQL_FULL_SCAN
+        return [line for line in plan if (match := pattern.search(line.strip())) and match.group(1) in HOT_TABLES]
+
+    def sorts(self, plan):
+        if connection.vendor == 'sqlite':
+            return [line for line in plan if 'TEMP B-TREE FOR ORDER BY' in line]
+        return [line for line in plan if line.strip().lstrip('->').strip().startswith('Sort')]
+
+    def hot_queries(self, path, params=None):
+        """SELECTs on the hot tables run while serving a `GET` of `path`."""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path, params or {})
+        self.assertEqual(response.status_code, 200)
+        selects = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('SELECT')]
+        return [sql for sql in selects if any(f'FROM "{table}"' in sql for table in HOT_TABLES)]
+
+    def assertIndexed(self, path, params=None, ordered=True):
+        queries = self.hot_queries(path, params)
+        self.assertTrue(queries, f'{path} ran no query on {sorted(HOT_TABLES)}')
+        if connection.vendor == 'postgresql':
+            # A few thousand rows fit in a handful of pages, where a scan would win anyway; this
+            # asks whether an index can serve the query at all
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        for sql in queries:
+            plan = self.explain(sql)
+            self.assertFalse(self.full_scans(plan), f'full scan in {sql}\n' + '\n'.join(plan))
+            if ordered:
+                self.assertFalse(self.sorts(plan), f'sort in {sql}\n' + '\n'.join(plan))
+
+    def test_search_page(self):
+        self.assertIndexed(reverse('search'), {'page_size': 20})
+
+    def test_search_list(self):
+        # The bookmarked locations come first: read by primary key and sorted, one row per bookmark
+        self.assertIndexed(reverse('search'), {'n': 20}, ordered=False)
+
+    def test_search_list_not_bookmarked(self):
+        # The other locations are read in page order from the modified_at index
+        queries = [sql for sql in self.hot_queries(reverse('search'), {'n': 100}) if 'NOT (' in sql]
+        self.assertEqual(len(queries), 1)
+        plan = self.explain(queries[0])
+        self.assertFalse(self.full_scans(plan), '\n'.join(plan))
+        self.assertFalse(self.sorts(plan), '\n'.join(plan))
+
+    def test_search_list_without_bookmarks(self):
+        self.client.force_login(self.users[1])
+        self.assertIndexed(reverse('search'), {'n': 20})
+
+    def test_search_query(self):
+        # Matches come from the text search index and are ranked, which takes a sort
+        self.assertIndexed(reverse('search'), {'q': 'Place 12', 'n': 20}, ordered=False)
+
+    def test_view_logs(self):
+        self.assertIndexed(reverse('view_logs'))
+
+    def test_view_logs_filtered(self):
+        today = timezone.localdate()
+        for params in (
+            {'user': self.users[3].username},
+            {'action': ACTION.values[1]},
+            {'content_type': 'location', 'object_id': self.location.pk},
+            {'date_from': today - timedelta(days=1), 'date_to': today},
+        ):
+            with self.subTest(**params):
+                self.assertIndexed(reverse('view_logs'), params)
+
+    def test_view_plans(self):
+        self.assertIndexed(reverse('view_plans'))
+
+    def test_view_plans_filtered(self):
+        today = timezone.localdate()
+        for params in (
+            {'status': STATUS.ACCEPT},
+            {'operator': self.users[3].username},
+            {'created_from': today - timedelta(days=1), 'created_to': today},
+        ):
+            with self.subTest(**params):
+                self.assertIndexed(reverse('view_plans'), params)
+
+    def test_fetch_notes(self):
+        self.assertIndexed(reverse('fetch_notes'), {'location_id': self.location.pk})
+
+
+class SpatialIndexTests(TestCase):
+    """`location_index` must answer like a scan of the whole table, also after edits made through the ORM."""
+
+    @classmethod
+    def setUpTestData(cls):
+        Location.objects.bulk_create(random_locations(random.Random(1), 500))
+
+    def setUp(self):
+        # The index is process-wide, start every test from the rows in the database
+        location_index.reset()
+        self.addCleanup(location_index.reset)
+        rng = random.Random(2)
+        self.points = [(rng.uniform(10.4, 11.1), rng.uniform(106.3, 107.1)) for _ in range(40)]
+        self.points += [(90, 0), (-90, 0), (0, 180), (0, -180), (45, 90)]
+
+    def rows(self):
+        return list(Location.objects.values_list('pk', 'lat', 'lng'))
+
+    def assertMatchesBruteForce(self):
+        rows = self.rows()
+        distances, pks = location_index.nearest(self.points)
+        for point, distance, pk in zip(self.points, distances.tolist(), pks.tolist()):
+            expected_distance, expected_pk = min((haversine(point, (lat, lng)), pk) for pk, lat, lng in rows)
+            self.assertEqual(pk, expected_pk, point)
+            self.assertAlmostEqual(distance, expected_distance, delta=1e-6 * expected_distance + 1e-6)
+
+        for point in self.points[:10]:
+            for radius in (300, 3000, 30000):
+                distances, pks = location_index.within(*point, radius)
+                expected = {pk for pk, lat, lng in rows if haversine(point, (lat, lng)) <= radius}
+                self.assertEqual(set(pks.tolist()), expected, (point, radius))
+                self.assertEqual(distances.tolist(), sorted(distances.tolist()))
+
+    def test_matches_brute_force(self):
+        self.assertMatchesBruteForce()
+
+    def test_follows_saves_and_deletes(self):
+        location_index.build()
+        moved = Location.objects.order_by('pk')[0]
+        moved.lat, moved.lng = self.points[0]
+        moved.save()
+        Location.objects.create(lat=self.points[1][0] + 0.0001, lng=self.points[1][1], name='New')
+        Location.objects.order_by('pk')[5].delete()
+        self.assertMatchesBruteForce()
+
+    @override_settings(SPATIAL_INDEX_REBUILD_THRESHOLD=3)
+    def test_recompacts_after_many_edits(self):
+        location_index.build()
+        rng = random.Random(3)
+        for location in Location.objects.order_by('pk')[:10]:
+            location.lat, location.lng = rng.uniform(10.5, 11), rng.uniform(106.4, 107)
+            location.save()
+        for location in Location.objects.order_by('-pk')[:5]:
+            location.delete()
+        self.assertMatchesBruteForce()
+
+    def test_empty_table(self):
+        Location.objects.all().delete()
+        location_index.reset()
+        distances, pks = location_index.nearest(self.points[:3])
+        self.assertEqual(pks.tolist(), [-1, -1, -1])
+        self.assertEqual(len(location_index.within(*self.points[0], 1000)[1]), 0)
+
+
+class NearestLocationTests(TestCase):
+    """Batched nearest lookups, through the index or the geohash cells, must agree with a scan."""
+
+    @classmethod
+    def setUpTestData(cls):
+        Location.objects.bulk_create(random_locations(random.Random(4), 300))
+
+    def setUp(self):
+        location_index.reset()
+        self.addCleanup(location_index.reset)
+        rng = random.Random(5)
+        # Points near the locations, and a few far from every one of them
+        self.points = [(rng.uniform(10.5, 11), rng.uniform(106.4, 107)) for _ in range(20)] + [(40, -100), (0, 179.9995)]
+
+    def expected(self, max_distance):
+        rows = list(Location.objects.values_list('pk', 'lat', 'lng'))
+        expected = []
+        for point in self.points:
+            distance, pk = min((haversine(point, (lat, lng)), pk) for pk, lat, lng in rows)
+            expected.append(pk if max_distance is None or distance < max_distance else None)
+        return expected
+
+    def pks(self, locations):
+        return [location.pk if location else None for location in locations]
+
+    def test_index(self):
+        location_index.build()
+        for max_distance in (None, 200, 2000):
+            with self.subTest(max_distance=max_distance):
+                self.assertEqual(self.pks(Location.get_nearest_many(self.points, max_distance)), self.expected(max_distance))
+
+    @override_settings(GEOHASH_LOOKUP_MAX_POINTS=100)
+    def test_geohash_cells(self):
+        for max_distance in (200, 2000):
+            with self.subTest(max_distance=max_distance):
+                with CaptureQueriesContext(connection) as queries:
+                    nearest = Location.get_nearest_many(self.points, max_distance)
+                self.assertFalse(location_index.built)
+                self.assertEqual(self.pks(nearest), self.expected(max_distance))
+                self.assertTrue(all('"geohash"' in query['sql'] for query in queries.captured_queries))
+
+    def test_get_location_name(self):
+        self.client.force_login(Account.objects.create_user('names@example.com', 'pw', ssn='1'))
+        response = self.client.post(reverse('get_location_name'), [{'lat': lat, 'lng': lng} for lat, lng in self.points],
+                                    content_type='application/json')
+        names = dict(Location.objects.values_list('pk', 'name'))
+        self.assertEqual(response.json()['names'], [
+            names[pk] if pk else f'({lat}, {lng})' for (lat, lng), pk in zip(self.points, self.expected(200))
+        ])
+
+
+class KeysetPaginationTests(TestCase):
+    """Walking the cursors must return every row once, in order, whatever is inserted meanwhile."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = Account.objects.create_user('pages@example.com', 'pw', ssn='1')
+        Location.objects.bulk_create([
+            Location(lat=10, lng=106, name=f'{"Cafe" if i % 2 else "Museum"} {i}') for i in range(103)
+        ])
+        # Ties on modified_at, three rows each, and microseconds apart, which the cursor must keep
+        now = timezone.now()
+        for i, pk in enumerate(Location.objects.order_by('pk').values_list('pk', flat=True)):
+            Location.objects.filter(pk=pk).update(modified_at=now - timedelta(microseconds=i // 3))
+
+    def setUp(self):
+        search_cache.cache.clear()
+        self.client.force_login(self.user)
+
+    def walk(self, params):
+        pks, cursor = [], None
+        while True:
+            response = self.client.get(reverse('search'), {**params, **({'cursor': cursor} if cursor else {})})
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertLessEqual(len(data['results']), int(params['page_size']))
+            pks += [int(location['pk']) for location in data['results']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                return pks
+
+    def test_keyset_page(self):
+        ordering = ['-modified_at', '-location_id']
+        expected = list(Location.objects.order_by(*ordering).values_list('pk', flat=True))
+        pks, cursor = [], None
+        while True:
+            rows, cursor = keyset_page(Location.objects.all(), ordering, cursor, page_size=10)
+            pks += [row.pk for row in rows]
+            if cursor is None:
+                break
+        self.assertEqual(pks, expected)
+
+    def test_search_pages(self):
+        expected = list(Location.objects.order_by('-modified_at', '-location_id').values_list('pk', flat=True))
+        for page_size in (1, 7, 103, 500):
+            with self.subTest(page_size=page_size):
+                self.assertEqual(self.walk({'page_size': page_size}), expected)
+
+    def test_search_query_pages(self):
+        expected = list(Location.objects.filter(name__startswith='Cafe')
+                        .order_by('-modified_at', '-location_id').values_list('pk', flat=True))
+        self.assertEqual(self.walk({'q': 'cafe', 'page_size': 10}), expected)
+
+    def test_insert_between_pages(self):
+        first = self.client.get(reverse('search'), {'page_size': 10}).json()
+        # Newer than every row, so it belongs before the pages already read
+        Location.objects.create(lat=10, lng=106, name='Late')
+        rest = self.walk({'page_size': 10, 'cursor': first['next_cursor']})
+        expected = list(Location.objects.exclude(name='Late')
+                        .order_by('-modified_at', '-location_id').values_list('pk', flat=True))
+        self.assertEqual([int(location['pk']) for location in first['results']] + rest, expected)
+
+    def test_invalid_cursor(self):
+        for cursor in ('not a cursor', encode_cursor([1]), encode_cursor({'a': 1}), encode_cursor(['yesterday', 1])):
+            with self.subTest(cursor=cursor):
+                response = self.client.get(reverse('search'), {'page_size': 10, 'cursor': cursor})
+                self.assertEqual(response.status_code, 400)
+        with self.assertRaises(InvalidCursor):
+            keyset_page(Location.objects.all(), ['-modified_at', '-location_id'], '!!!')
+
+    def test_page_size(self):
+        self.assertEqual(parse_page_size('20'), 20)
+        self.assertEqual(parse_page_size('0'), 1)
+        self.assertEqual(parse_page_size('100000'), MAX_PAGE_SIZE)
+        self.assertEqual(parse_page_size('x', default=5), 5)
+
+
+def random_route(rng, count, start=(10.77, 106.69)):
+    """A wandering `(lat, lng)` path, with straight runs the simplification can drop."""
+    lat, lng = start
+    heading = rng.uniform(0, 2 * math.pi)
+    route = []
+    for _ in range(count):
+        heading += rng.gauss(0, 0.3) if rng.random() < 0.3 else 0
+        step = rng.uniform(0.00005, 0.002)
+        lat, lng = lat + step * math.sin(heading), lng + step * math.cos(heading)
+        route.append((lat, lng))
+    return route
+
+
+def douglas_peucker(coords, tolerance):
+    """Reference recursive Douglas-Peucker, indices of the points kept at `tolerance` meters."""
+    lat0 = math.radians(sum(lat for lat, _ in coords) / len(coords))
+    points = [(math.radians(lng) * EARTH_RADIUS_METERS * math.cos(lat0), math.radians(lat) * EARTH_RADIUS_METERS)
+              for lat, lng in coords]
+
+    def distance(p, a, b):
+        dx, dy = b[0] - a[0], b[1] - a[1]
+        length = dx * dx + dy * dy
+        t = 0 if length == 0 else max(0, min(1, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / length))
+        return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+    kept = {0, len(coords) - 1}
+
+    def simplify(start, end):
+        if end - start < 2:
+            return
+        split = max(range(start + 1, end), key=lambda i: distance(points[i], points[start], points[end]))
+        if distance(points[split], points[start], points[end]) > tolerance:
+            kept.add(split)
+            simplify(start, split)
+            simplify(split, end)
+
+    simplify(0, len(coords) - 1)
+    return sorted(kept)
+
+
+class RouteGeometryTests(SimpleTestCase):
+    """Encoded polylines and the simplified route levels stored with every plan."""
+
+    def setUp(self):
+        self.rng = random.Random(6)
+
+    def test_polyline_reference(self):
+        # The example of Google's polyline algorithm documentation
+        coords = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+        self.assertEqual(encode_polyline(coords), '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+        self.assertEqual(decode_polyline('_p~iF~ps|U_ulLnnqC_mqNvxq`@').tolist(), [list(point) for point in coords])
+
+    def test_polyline_round_trip(self):
+        routes = [
+            [], [(0.0, 0.0)], [(-89.99999, 179.99999), (89.99999, -179.99999), (0.00001, -0.00001)],
+            random_route(self.rng, 1000),
+            [(self.rng.uniform(-90, 90), self.rng.uniform(-180, 180)) for _ in range(200)],
+        ]
+        for route in routes:
+            with self.subTest(points=len(route)):
+                decoded = decode_polyline(encode_polyline(route))
+                self.assertEqual(decoded.shape, (len(route), 2))
+                for (lat, lng), (decoded_lat, decoded_lng) in zip(route, decoded.tolist()):
+                    self.assertAlmostEqual(decoded_lat, lat, delta=0.5e-5 + 1e-9)
+                    self.assertAlmostEqual(decoded_lng, lng, delta=0.5e-5 + 1e-9)
+
+    def test_douglas_peucker_levels(self):
+        for count in (2, 3, 50, 800):
+            route = random_route(self.rng, count)
+            significance = douglas_peucker_significance(route)
+            kept_before = set(range(count))
+            for tolerance in ROUTE_LEVEL_TOLERANCES:
+                with self.subTest(count=count, tolerance=tolerance):
+                    kept = [i for i in range(count) if significance[i] > tolerance]
+                    self.assertEqual(kept, douglas_peucker(route, tolerance))
+                    # Every level is a subset of the finer ones
+                    self.assertLessEqual(set(kept), kept_before)
+                    kept_before = set(kept)
+
+    def test_compact_route_data(self):
+        route = random_route(self.rng, 500)
+        route_data = [{'coordinates': [{'lat': lat, 'lng': lng} for lat, lng in route], 'waypoints': []}]
+        compact = compact_route_data(route_data)
+        self.assertNotIn('coordinates', compact[0])
+        self.assertEqual(compact[0]['waypoints'], [])
+        self.assertEqual(set(compact[0]['levels']), {str(tolerance) for tolerance in ROUTE_LEVEL_TOLERANCES})
+        significance = douglas_peucker_significance(route)
+        for tolerance in ROUTE_LEVEL_TOLERANCES:
+            level = decode_polyline(compact[0]['levels'][str(tolerance)])
+            self.assertEqual(len(level), int((significance > tolerance).sum()))
+        # Compacting again changes nothing, and expanding gives the points back
+        self.assertEqual(compact_route_data(compact), compact)
+        expanded = expand_route_data(compact)[0]['coordinates']
+        self.assertEqual(len(expanded), len(route))
+        for point, (lat, lng) in zip(expanded, route):
+            self.assertAlmostEqual(point['lat'], lat, delta=1e-5)
+            self.assertAlmostEqual(point['lng'], lng, delta=1e-5)
+
+    def test_select_route_level(self):
+        compact = compact_route_data([{'coordinates': [{'lat': lat, 'lng': lng} for lat, lng in random_route(self.rng, 500)]}])
+        levels = compact[0]['levels']
+        self.assertEqual(select_route_level(compact), [{'polyline': compact[0]['polyline']}])
+        self.assertEqual(select_route_level(compact, tolerance=100), [{'polyline': levels['80']}])
+        self.assertEqual(select_route_level(compact, tolerance=1), [{'polyline': compact[0]['polyline']}])
+        # One pixel at zoom 10 is about 150 m on the equator
+        self.assertEqual(select_route_level(compact, zoom=10), [{'polyline': levels['80']}])
+
+
+class CompactRoutesTests(TestCase):
+    """`compact_routes` converts plans in batches, with the same few queries however many plans a batch holds."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = Account.objects.create_user('routes@example.com', 'pw', ssn='1')
+
+    def create_verbose_plans(self, count):
+        rng = random.Random(count)
+        Plan.objects.bulk_create([Plan(user=self.user, plan_name=f'Plan {i}') for i in range(count)])
+        for plan in Plan.objects.all():
+            route = random_route(rng, 20)
+            Plan.objects.filter(pk=plan.pk).update(route_format=ROUTE_FORMAT.VERBOSE, route_data=[
+                {'coordinates': [{'lat': lat, 'lng': lng} for lat, lng in route], 'waypoints': []}])
+
+    def compact(self, *args):
+        with CaptureQueriesContext(connection) as queries:
+            call_command('compact_routes', '--batch-size', '100', *args, stdout=StringIO())
+        self.assertFalse(Plan.objects.filter(route_format=ROUTE_FORMAT.VERBOSE).exists())
+        self.assertTrue(all('levels' in plan.route_data[0] for plan in Plan.objects.all()))
+        return len(queries)
+
+    def test_queries_per_batch(self):
+        counts = []
+        for plans in (3, 30):
+            Plan.objects.all().delete()
+            self.create_verbose_plans(plans)
+            # Converting, then going over plans that are already compact
+            counts.append((self.compact(), self.compact('--all')))
+        self.assertEqual(counts[0], counts[1])
+
+
+def nearest_neighbour_length(coords, round_trip):
+    """Length of the greedy tour from the first stop, the baseline the optimizer starts from."""
+    order, left = [0], set(range(1, len(coords)))
+    while left:
+        order.append(min(left, key=lambda i: (haversine(coords[order[-1]], coords[i]), i)))
+        left.remove(order[-1])
+    if round_trip:
+        order.append(0)
+    return sum(haversine(coords[a], coords[b]) for a, b in zip(order, order[1:]))
+
+
+class TourOptimizationTests(TestCase):
+    """2-opt and Or-opt must never make a trip longer than the nearest-neighbour tour they improve."""
+
+    def setUp(self):
+        self.rng = random.Random(7)
+
+    def assertValidOrder(self, order, count):
+        self.assertEqual(sorted(order.tolist()), list(range(count)))
+        self.assertEqual(order[0], 0)
+
+    def test_never_longer_than_nearest_neighbour(self):
+        for count in (1, 2, 3, 4, 8, 20, 60):
+            for round_trip in (False, True):
+                for _ in range(5):
+                    coords = [(self.rng.uniform(10.6, 10.9), self.rng.uniform(106.5, 106.9)) for _ in range(count)]
+                    with self.subTest(count=count, round_trip=round_trip):
+                        order, distances = optimize_order(coords, round_trip, time_limit=1.0)
+                        self.assertValidOrder(order, count)
+                        self.assertLessEqual(tour_length(distances, order, round_trip),
+                                             nearest_neighbour_length(coords, round_trip) + 1e-6)
+
+    def test_finds_the_obvious_order(self):
+        # Stops along a line, listed out of order: the best open trip walks the line
+        coords = [(10.0, 106.0 + 0.01 * i) for i in (0, 5, 2, 8, 1, 7, 3, 6, 4)]
+        order, _ = optimize_order(coords, time_limit=1.0)
+        self.assertEqual([coords[i][1] for i in order], sorted(lng for _, lng in coords))
+
+    def test_optimize_route(self):
+        self.client.force_login(Account.objects.create_user('tour@example.com', 'pw', ssn='1'))
+        coords = [(self.rng.uniform(10.6, 10.9), self.rng.uniform(106.5, 106.9)) for _ in range(12)]
+        locations = Location.objects.bulk_create([Location(lat=lat, lng=lng, name='Stop') for lat, lng in coords])
+        location_ids = [location.pk for location in locations]
+        for round_trip in (False, True):
+            with self.subTest(round_trip=round_trip):
+                response = self.client.post(reverse('optimize_route'), {
+                    'location_ids': location_ids, 'round_trip': round_trip}, content_type='application/json')
+                data = response.json()
+                self.assertEqual(data['location_ids'][0], location_ids[0])
+                self.assertEqual(sorted(data['location_ids']), sorted(location_ids))
+                self.assertLessEqual(data['distance'], nearest_neighbour_length(coords, round_trip) + 1e-6)
+                self.assertLessEqual(data['distance'], data['naive_distance'] + 1e-6)
+
+        response = self.client.post(reverse('optimize_route'), {'location_ids': [location_ids[0], 0]},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post(reverse('optimize_route'), {'location_ids': ['x']}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class ImportLocationsTests(TestCase):
+    """Row validation of bulk imports and the `import_locations` command."""
+
+    def setUp(self):
+        location_index.reset()
+        self.addCleanup(location_index.reset)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        return path
+
+    def import_file(self, path, *args):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('import_locations', path, *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_clean_from_json(self):
+        for row in (
+            {'lat': 0, 'lng': 0},
+            {'lat': '10.5', 'lng': '-106.25', 'name': '', 'address': 'Somewhere'},
+            {'lat': -90, 'lng': 180, 'name': 'Edge', 'location_type': 'park'},
+        ):
+            with self.subTest(row=row):
+                location = Location.clean_from_json(row)
+                self.assertEqual((location.lat, location.lng), (float(row['lat']), float(row['lng'])))
+                self.assertEqual(location.name, row.get('name'))
+        for row in (
+            {'lng': 106}, {'lat': 10}, {'lat': '', 'lng': 106}, {'lat': 'north', 'lng': 106},
+            {'lat': 90.5, 'lng': 0}, {'lat': 0, 'lng': -180.5}, {'lat': 10, 'lng': 106, 'name': 'x' * 256},
+        ):
+            with self.subTest(row=row), self.assertRaises(ValidationError):
+                Location.clean_from_json(row)
+
+    def test_import_csv(self):
+        Location.objects.create(lat=10.77, lng=106.69, name='Known')
+        path = self.write('places.csv', '\n'.join([
+            'lat,lng,name,address,location_type',
+            '0,0,Null Island,,',
+            '10.8,106.7,Market,1 Le Loi,market',
+            '10.77003,106.69,Next to known,,',
+            '10.80003,106.7,Next to market,,',
+            'abc,106.7,Bad latitude,,',
+            '95,106.7,Out of range,,',
+            '10.9,,No longitude,,',
+        ]) + '\n')
+        stdout, stderr = self.import_file(path)
+        self.assertEqual(sorted(Location.objects.values_list('name', flat=True)), ['Known', 'Market', 'Null Island'])
+        self.assertIn('Imported 2 locations, skipped 2 near-duplicates and 3 invalid rows', stdout)
+        self.assertEqual([line.split(' skipped')[0] for line in stderr.splitlines()], ['Row 5', 'Row 6', 'Row 7'])
+        self.assertEqual(Log.objects.get(field_name='bulk import').new_value, '2 locations imported from places.csv, 5 skipped')
+
+    def test_import_keeps_duplicates(self):
+        path = self.write('places.csv', 'lat,lng,name\n10.8,106.7,A\n10.8,106.7,B\n')
+        self.import_file(path, '--min-distance', '0')
+        self.assertEqual(Location.objects.count(), 2)
+
+    def test_import_geojson(self):
+        features = [
+            {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [106.7, 10.8]}, 'properties': {'name': 'Market'}},
+            {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [0, 0]}, 'properties': {'name': 'Origin'}},
+            {'type': 'Feature', 'geometry': None, 'properties': {'name': 'Nowhere'}},
+        ]
+        path = self.write('places.geojson', json.dumps({'type': 'FeatureCollection', 'features': features}))
+        stdout, _ = self.import_file(path, '--batch-size', '1')
+        self.assertEqual(set(Location.objects.values_list('name', 'lat', 'lng')), {('Market', 10.8, 106.7), ('Origin', 0, 0)})
+        self.assertIn('and 1 invalid rows', stdout)
+
+
+class SpatialQueryTests(TestCase):
+    """The radius and bounding-box endpoints against a brute-force scan, by the poles and the antimeridian too."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = Account.objects.create_user('spatial@example.com', 'pw', ssn='1')
+        rng = random.Random(8)
+        locations = []
+        for center_lat, center_lng, spread in ((10.77, 106.69, 0.05), (64.1, -21.9, 3), (-16.5, 179.9, 0.3), (89.5, 0, 1)):
+            for i in range(100):
+                lng = (center_lng + rng.uniform(-spread, spread) + 180) % 360 - 180
+                lat = max(-90, min(90, center_lat + rng.uniform(-spread, spread) / 2))
+                locations.append(Location(lat=lat, lng=lng, name=f'Place {i}', location_type=rng.choice(['cafe', 'park'])))
+        Location.objects.bulk_create(locations)
+
+    def setUp(self):
+        location_index.reset()
+        self.addCleanup(location_index.reset)
+        search_cache.cache.clear()
+        self.client.force_login(self.user)
+
+    def near(self, lat, lng, radius, **params):
+        response = self.client.get(reverse('locations_near'), {'lat': lat, 'lng': lng, 'radius': radius, 'limit': 500, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def expected_near(self, lat, lng, radius, location_type=None):
+        rows = Location.objects.values_list('pk', 'lat', 'lng', 'location_type')
+        found = [(haversine((lat, lng), (row_lat, row_lng)), pk) for pk, row_lat, row_lng, row_type in rows
+                 if location_type in (None, row_type)]
+        return sorted((distance, pk) for distance, pk in found if distance <= radius)
+
+    def assertNear(self, lat, lng, radius, **params):
+        results = self.near(lat, lng, radius, **params)
+        expected = self.expected_near(lat, lng, radius, params.get('type'))
+        self.assertEqual([int(location['pk']) for location in results], [pk for _, pk in expected], (lat, lng, radius))
+        for location, (distance, _) in zip(results, expected):
+            self.assertAlmostEqual(location['distance'], distance, delta=1e-6 * distance + 1e-6)
+
+    def test_near(self):
+        for lat, lng, radius in (
+            (10.77, 106.69, 500), (10.77, 106.69, 3000), (10.77, 106.69, 20000),
+            (64.1, -21.9, 4000), (64.1, -21.9, 150000), (-16.5, -179.95, 4000), (-16.5, 180, 30000),
+            (89.9, 0, 2000), (90, 0, 150000),
+        ):
+            # Small circles are read from the geohash cells, the others through the index
+            with self.subTest(lat=lat, lng=lng, radius=radius, index='geohash'):
+                location_index.reset()
+                self.assertNear(lat, lng, radius)
+            with self.subTest(lat=lat, lng=lng, radius=radius, index='tree'):
+                location_index.build()
+                self.assertNear(lat, lng, radius)
+
+    def test_near_type_and_limit(self):
+        location_index.build()
+        self.assertNear(10.77, 106.69, 20000, type='park')
+        expected = self.expected_near(10.77, 106.69, 20000, 'cafe')[:5]
+        results = self.near(10.77, 106.69, 20000, type='cafe', limit=5)
+        self.assertEqual([int(location['pk']) for location in results], [pk for _, pk in expected])
+
+    def test_bbox(self):
+        rows = list(Location.objects.values_list('pk', 'lat', 'lng'))
+        for west, south, east, north in ((106.6, 10.7, 106.8, 10.8), (179.8, -17, -179.8, -16), (-180, 80, 180, 90)):
+            with self.subTest(bbox=(west, south, east, north)):
+                response = self.client.get(reverse('locations_in_bbox'), {'bbox': f'{west},{south},{east},{north}', 'limit': 500})
+                inside_lng = (lambda lng: west <= lng <= east) if west <= east else (lambda lng: lng >= west or lng <= east)
+                expected = sorted(pk for pk, lat, lng in rows if south <= lat <= north and inside_lng(lng))
+                self.assertTrue(expected)
+                self.assertEqual([int(location['pk']) for location in response.json()['results']], expected)
+
+    def test_bbox_center(self):
+        center = (-16.5, 179.95)
+        response = self.client.get(reverse('locations_in_bbox'), {
+            'bbox': '179.8,-17,-179.8,-16', 'lat': center[0], 'lng': center[1], 'limit': 10})
+        rows = Location.objects.filter(lat__gte=-17, lat__lte=-16).filter(Q(lng__gte=179.8) | Q(lng__lte=-179.8))
+        expected = sorted((haversine(center, (location.lat, location.lng)), location.pk) for location in rows)[:10]
+        self.assertEqual([int(location['pk']) for location in response.json()['results']], [pk for _, pk in expected])
+
+    def test_invalid(self):
+        for params in ({'lat': 10, 'lng': 106}, {'lat': 'x', 'lng': 106, 'radius': 10}, {'lat': 91, 'lng': 0, 'radius': 10},
+                       {'lat': 10, 'lng': 106, 'radius': -1}):
+            with self.subTest(**params):
+                self.assertEqual(self.client.get(reverse('locations_near'), params).status_code, 400)
+        for params in ({'bbox': '1,2,3'}, {'bbox': '1,2,3,4', 'lat': 10}):
+            with self.subTest(**params):
+                self.assertEqual(self.client.get(reverse('locations_in_bbox'), params).status_code, 400)
+
+
+def destination(origin, bearing, distance):
+    """Point `distance` meters from `origin` on the initial `bearing` in degrees."""
+    lat, lng, bearing = map(math.radians, (*origin, bearing))
+    angle = distance / EARTH_RADIUS_METERS
+    end_lat = math.asin(math.sin(lat) * math.cos(angle) + math.cos(lat) * math.sin(angle) * math.cos(bearing))
+    end_lng = lng + math.atan2(math.sin(bearing) * math.sin(angle) * math.cos(lat),
+                               math.cos(angle) - math.sin(lat) * math.sin(end_lat))
+    return math.degrees(end_lat), (math.degrees(end_lng) + 180) % 360 - 180
+
+
+class MapViewportTests(TestCase):
+    """`locations_in_view` clusters what a viewport holds and never sends more than a capped number of locations."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = Account.objects.create_user('viewport@example.com', 'pw', ssn='1')
+        rng = random.Random(15)
+        # A dense block of ~100 x 100 m and a few scattered locations, all within 2 km
+        locations = [Location(lat=10.77 + rng.uniform(0, 0.001), lng=106.69 + rng.uniform(0, 0.001)) for _ in range(200)]
+        locations += [Location(lat=10.76 + i * 0.0005, lng=106.70 + (i % 3) * 0.003) for i in range(30)]
+        Location.objects.bulk_create(locations)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def view(self, bbox, zoom):
+        response = self.client.get(reverse('locations_in_view'), {'bbox': bbox, 'zoom': zoom})
+        return response.status_code, response.json()
+
+    def test_clustered(self):
+        status, data = self.view('106.68,10.75,106.72,10.79', 13)
+        self.assertEqual(status, 200)
+        self.assertFalse(data['truncated'])
+        self.assertTrue(data['clusters'])
+        self.assertEqual(len(data['locations']) + sum(cluster['count'] for cluster in data['clusters']), 230)
+
+    def test_every_location_past_max_zoom(self):
+        status, data = self.view('106.68,10.75,106.72,10.79', 16)
+        self.assertEqual((len(data['locations']), data['clusters'], data['truncated']), (230, [], False))
+
+    @override_settings(LOCATION_VIEW_MAX_LOCATIONS=100)
+    def test_capped_past_max_zoom(self):
+        # Too many for one response: the dense block is clustered even past the max zoom
+        status, data = self.view('106.68,10.75,106.72,10.79', 16)
+        self.assertLessEqual(len(data['locations']), 100)
+        self.assertTrue(data['clusters'])
+        self.assertEqual(len(data['locations']) + sum(cluster['count'] for cluster in data['clusters']), 230)
+
+    @override_settings(LOCATION_VIEW_MAX_LOCATIONS=10)
+    def test_truncated(self):
+        status, data = self.view('106.68,10.75,106.72,10.79', 16)
+        self.assertEqual(len(data['locations']), 10)
+        self.assertTrue(data['truncated'])
+
+    def test_too_large_for_zoom(self):
+        self.assertEqual(self.view('106.68,10.75,106.72,10.79', 18)[0], 200)
+        # The whole city at street level, then the whole world
+        self.assertEqual(self.view('106.5,10.6,107,11', 16)[0], 400)
+        self.assertEqual(self.view('-180,-85,180,85', 16)[0], 400)
+        self.assertEqual(self.view('-180,-85,180,85', 3)[0], 200)
+        # Across the antimeridian, the box is 0.04 degrees wide
+        self.assertEqual(self.view('179.98,-16.52,-179.98,-16.48', 16)[0], 200)
+        self.assertEqual(self.view('1,2,3', 16)[0], 400)
+
+
+class GeohashTests(TestCase):
+    """Geohash encoding, covering cells and prefix ranges, and the lookups built on them."""
+
+    def test_encode(self):
+        self.assertEqual(geohash.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(geohash.encode(42.6, -5.6, 5), 'ezs42')
+        self.assertEqual(geohash.encode([42.6, 90, -90], [-5.6, 180, -180], 5), ['ezs42', 'zzzzz', '00000'])
+
+    def test_precision_for_radius(self):
+        self.assertEqual(geohash.precision_for_radius(1), 9)
+        self.assertEqual(geohash.precision_for_radius(1e8), 0)
+        meters_per_degree = math.pi * EARTH_RADIUS_METERS / 180
+        for radius in (10, 500, 5000, 100000):
+            precision = geohash.precision_for_radius(radius)
+            size = min(geohash.CELL_HEIGHT[precision], geohash.CELL_WIDTH[precision]) * meters_per_degree
+            self.assertGreaterEqual(size, radius)
+            if precision < 12:
+                self.assertLess(min(geohash.CELL_HEIGHT[precision + 1], geohash.CELL_WIDTH[precision + 1]) * meters_per_degree, radius)
+
+    def test_covering_cells(self):
+        rng = random.Random(17)
+        centers = [(rng.uniform(-80, 80), rng.uniform(-180, 180)) for _ in range(30)]
+        centers += [(10.77, 106.69), (0, 179.9999), (0, -180), (-45, 0), (84, 90)]
+        for center in centers:
+            for radius in (5, 200, 5000, 60000):
+                cells = geohash.covering_cells(*center, radius)
+                if cells is None:
+                    continue
+                precision = len(cells[0])
+                for _ in range(50):
+                    point = destination(center, rng.uniform(0, 360), radius * math.sqrt(rng.random()))
+                    self.assertIn(geohash.encode(*point, precision), cells, (center, radius, point))
+        self.assertIsNone(geohash.covering_cells(10, 10, 1e7))
+
+    def test_prefix_range(self):
+        rng = random.Random(3)
+        alphabet = ''.join(geohash.BASE32)
+        hashes = sorted(''.join(rng.choice(alphabet) for _ in range(4)) for _ in range(5000))
+        hashes += ['zzzz', 'bzzz', 'c000']
+        for prefix in ('c', 'bz', 'b', 'zz', 'z', 'u4p', 'gz'):
+            start, stop = geohash.prefix_range(prefix)
+            in_range = {h for h in hashes if start <= h and (stop is None or h < stop)}
+            self.assertEqual(in_range, {h for h in hashes if h.startswith(prefix)}, prefix)
+        self.assertEqual(geohash.prefix_range('zz'), ('zz', None))
+
+    def test_geohash_saved(self):
+        location = Location.objects.create(lat=57.64911, lng=10.40744)
+        self.assertEqual(location.geohash, 'u4pruydqq')
+        Location.objects.bulk_create([Location(lat=42.6, lng=-5.6)])
+        self.assertTrue(Location.objects.get(lat=42.6).geohash.startswith('ezs42'))
+
+        location.lat, location.lng = 42.6, -5.6
+        location.save(update_fields=['lat', 'lng'])
+        location.refresh_from_db()
+        self.assertTrue(location.geohash.startswith('ezs42'))
+        location.name = 'Renamed'
+        location.save(update_fields=['name'])
+        location.refresh_from_db()
+        self.assertTrue(location.geohash.startswith('ezs42'))
+
+    def test_near_by_geohash(self):
+        rng = random.Random(5)
+        Location.objects.bulk_create(random_locations(rng, 500))
+        rows = list(Location.objects.all())
+        for lat, lng, radius in ((10.77, 106.69, 1000), (10.6, 106.9, 4000), (0, 180, 5000), (10.77, 106.69, 20)):
+            with self.subTest(lat=lat, lng=lng, radius=radius):
+                near = Location.get_near_by_geohash(Location.objects.all(), lat, lng, radius)
+                expected = sorted((haversine((lat, lng), (loc.lat, loc.lng)), loc.pk) for loc in rows)
+                expected = [(pk, distance) for distance, pk in expected if distance <= radius]
+                self.assertEqual([loc.pk for loc, _ in near], [pk for pk, _ in expected])
+                for (_, distance), (_, expected_distance) in zip(near, expected):
+                    self.assertAlmostEqual(distance, expected_distance, delta=1e-6)
+        self.assertIsNone(Location.get_near_by_geohash(Location.objects.all(), 10, 106, 1e7))
+
+
+class ConditionalGetTests(TestCase):
+    """Search, notes and plan routes answer a matching `If-None-Match` with 304 until they change."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = Account.objects.create_user('etag@example.com', 'pw', ssn='1')
+        cls.location = Location.objects.create(lat=10.77, lng=106.69, name='Ben Thanh Market')
+        route = random_route(random.Random(19), 50)
+        cls.plan = Plan.objects.create(user=cls.user, plan_name='Market tour', route_data=[
+            {'coordinates': [{'lat': lat, 'lng': lng} for lat, lng in route], 'waypoints': []}])
+
+    def setUp(self):
+        search_cache.cache.clear()
+        self.client.force_login(self.user)
+        # ETags come from timestamps, keep every change after the first response
+        Plan.objects.filter(pk=self.plan.pk).update(updated_at=timezone.now() - timedelta(days=1))
+        Location.objects.filter(pk=self.location.pk).update(modified_at=timezone.now() - timedelta(days=1))
+
+    def assertNotModified(self, url, params=None):
+        """GET `url`, then again with its ETag: 304 with no body. Returns the ETag."""
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        return etag
+
+    def assertModified(self, url, params, etag):
+        """A GET with the old `etag` gets the new content and a new ETag."""
+        response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_search(self):
+        url, params = reverse('search'), {'q': 'market'}
+        etag = self.assertNotModified(url, params)
+        self.assertNotEqual(self.assertNotModified(url, {'q': 'tour'}), etag)
+        Location.objects.create(lat=10.78, lng=106.7, name='Night market')
+        self.assertModified(url, params, etag)
+
+        etag = self.assertNotModified(url, params)
+        Bookmark.objects.create(user=self.user, location=self.location)
+        self.assertModified(url, params, etag)
+
+    def test_search_reads_versions_once(self):
+        for params in ({'q': 'market'}, {'q': 'market', 'page_size': 10}):
+            with self.subTest(**params):
+                self.client.get(reverse('search'), params)
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertEqual(self.client.get(reverse('search'), params).status_code, 200)
+                reads = [query['sql'] for query in queries.captured_queries if 'tdms_cache_versions' in query['sql']]
+                self.assertEqual(len(reads), 1, reads)
+
+    def test_notes(self):
+        url, params = reverse('fetch_notes'), {'location_id': self.location.pk}
+        etag = self.assertNotModified(url, params)
+        note = Note.objects.create(author=self.user, location=self.location, content='Opens at 6')
+        self.assertModified(url, params, etag)
+
+        etag = self.assertNotModified(url, params)
+        note.delete()
+        self.assertModified(url, params, etag)
+
+        etag = self.assertNotModified(url, params)
+        self.location.name = 'Cho Ben Thanh'
+        self.location.save()
+        self.assertModified(url, params, etag)
+        self.assertEqual(self.client.get(url, {'location_id': 0}).status_code, 404)
+
+    def test_plan_route(self):
+        url = reverse('get_plan_route', args=[self.plan.pk])
+        etag = self.assertNotModified(url)
+        # The zoom level is not part of the validator: a client sends the ETag of the same URL
+        self.assertEqual(self.client.get(url, {'zoom': 12}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.client.post(reverse('update_plan_status', args=[self.plan.pk]), {'status': STATUS.COMPLT})
+        self.assertEqual(Plan.objects.get(pk=self.plan.pk).status, STATUS.COMPLT)
+        self.assertModified(url, None, etag)
+
+    def test_plan_route_after_commands(self):
+        url = reverse('get_plan_route', args=[self.plan.pk])
+        etag = self.assertNotModified(url)
+        Plan.objects.filter(pk=self.plan.pk).update(est_distance=1, est_duration=1)
+        call_command('score_plans', stdout=StringIO())
+        self.assertModified(url, None, etag)
+
+        plan = Plan.objects.get(pk=self.plan.pk)
+        verbose = expand_route_data(plan.route_data)
+        Plan.objects.filter(pk=plan.pk).update(
+            route_data=verbose, route_format=ROUTE_FORMAT.VERBOSE, updated_at=timezone.now() - timedelta(days=1))
+        etag = self.assertNotModified(url)
+        call_command('compact_routes', stdout=StringIO())
+        self.assertModified(url, None, etag)
+
+        # Nothing left to change: the ETag stays
+        etag = self.assertNotModified(url)
+        call_command('compact_routes', '--all', stdout=StringIO())
+        call_command('score_plans', stdout=StringIO())
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class AuditLogTests(TestCase):
+    """Audit log rows are queued and written in batches, or saved in the request with `AUDIT_LOG_STRICT`."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = Account.objects.create_user('audit@example.com', 'pw', ssn='1')
+        cls.plan = Plan.objects.create(user=cls.user, plan_name='Audited', route_data=[])
+
+    def setUp(self):
+        self.addCleanup(log_sink.flush)
+        self.client.force_login(self.user)
+
+    def status_log(self, status):
+        return Log.create_update_plan_status_log(self.user, self.plan, STATUS.PENDNG, status)
+
+    def test_batched(self):
+        for status in (STATUS.ACCEPT, STATUS.REJECT):
+            log_sink.add(self.status_log(status))
+        self.assertEqual(len(log_sink), 2)
+        self.assertFalse(Log.objects.exists())
+        with self.assertNumQueries(3):
+            # One INSERT, in a savepoint
+            log_sink.flush()
+        self.assertEqual(sorted(Log.objects.values_list('new_value', flat=True)), sorted([STATUS.ACCEPT, STATUS.REJECT]))
+
+    @override_settings(AUDIT_LOG_BATCH_SIZE=3)
+    def test_full_batch(self):
+        for status in (STATUS.ACCEPT, STATUS.REJECT, STATUS.CANCEL):
+            log_sink.add(self.status_log(status))
+        self.assertEqual(len(log_sink), 0)
+        self.assertEqual(Log.objects.count(), 3)
+
+    def test_written_after_response(self):
+        self.client.post(reverse('update_plan_status', args=[self.plan.pk]), {'status': STATUS.ACCEPT})
+        self.assertEqual(len(log_sink), 0)
+        self.assertEqual(list(Log.objects.values_list('new_value', flat=True)), [STATUS.ACCEPT])
+
+    def test_bad_row(self):
+        bad = self.status_log(STATUS.REJECT)
+        bad.action = None
+        for log in (self.status_log(STATUS.ACCEPT), bad, self.status_log(STATUS.CANCEL)):
+            log_sink.add(log)
+        with self.assertLogs('TDMS.audit', 'ERROR'):
+            log_sink.flush()
+        self.assertEqual(sorted(Log.objects.values_list('new_value', flat=True)), sorted([STATUS.ACCEPT, STATUS.CANCEL]))
+
+    @override_settings(AUDIT_LOG_STRICT=True)
+    def test_strict(self):
+        log_sink.add(self.status_log(STATUS.ACCEPT))
+        self.assertEqual(len(log_sink), 0)
+        self.assertEqual(Log.objects.count(), 1)
+
+
+class BulkBookmarkTests(TestCase):
+    """`bookmark_locations` changes many bookmarks in one request and invalidates the cached searches."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = Account.objects.create_user('bookmarks@example.com', 'pw', ssn='1')
+        cls.other = Account.objects.create_user('other@example.com', 'pw', ssn='2')
+        cls.locations = Location.objects.bulk_create(
+            [Location(lat=10.7 + i / 1000, lng=106.7, name=f'Museum {i}') for i in range(30)])
+        cls.ids = sorted(location.pk for location in cls.locations)
+
+    def setUp(self):
+        search_cache.cache.clear()
+        self.client.force_login(self.user)
+
+    def post(self, data):
+        return self.client.post(reverse('bookmark_locations'), json.dumps(data), content_type='application/json')
+
+    def bookmarked(self, user):
+        return sorted(Bookmark.objects.filter(user=user).values_list('location_id', flat=True))
+
+    def searched(self):
+        results = self.client.get(reverse('search'), {'q': 'museum', 'n': 100}).json()
+        return sorted(int(location['pk']) for location in results if location['is_bookmarked'])
+
+    def test_bookmark_and_unbookmark(self):
+        self.assertEqual(self.searched(), [])
+        Bookmark.objects.create(user=self.user, location_id=self.ids[0])
+        Bookmark.objects.create(user=self.other, location_id=self.ids[1])
+
+        response = self.post({'location_ids': self.ids[:10], 'bookmarked': True})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'bookmarked': True, 'changed': self.ids[1:10]})
+        self.assertEqual(self.bookmarked(self.user), self.ids[:10])
+        self.assertEqual(self.searched(), self.ids[:10])
+
+        # Repeating the request changes nothing
+        self.assertEqual(self.post({'location_ids': self.ids[:10]}).json()['changed'], [])
+        self.assertEqual(self.bookmarked(self.user), self.ids[:10])
+
+        response = self.post({'location_ids': [str(pk) for pk in self.ids[5:15]], 'bookmarked': False})
+        self.assertEqual(response.json(), {'bookmarked': False, 'changed': self.ids[5:10]})
+        self.assertEqual(self.bookmarked(self.user), self.ids[:5])
+        self.assertEqual(self.searched(), self.ids[:5])
+        # The other user's bookmarks are their own
+        self.assertEqual(self.bookmarked(self.other), [self.ids[1]])
+
+    def test_cached_ids(self):
+        Bookmark.set_many(self.user, self.ids[:3], True)
+        expected = [pk in self.ids[:3] for pk in self.ids]
+        listed = lambda: [location['is_bookmarked'] for location in
+                          sorted(Location.get_list_loc_w_bookmark(self.user, sort_bookmark=True), key=lambda row: int(row['pk']))]
+        self.assertEqual(listed(), expected)
+        # Listings read the bookmarked IDs from the cache, not from the bookmark table
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(listed(), expected)
+        self.assertFalse([query['sql'] for query in queries.captured_queries if 'TDMS_bookmark' in query['sql']])
+        Bookmark.objects.create(user=self.user, location_id=self.ids[3])
+        self.assertEqual(listed(), [pk in self.ids[:4] for pk in self.ids])
+        # Past the inline limit, the queries read the bookmark table instead
+        with override_settings(BOOKMARK_IDS_INLINE_MAX=2):
+            self.assertEqual(listed(), [pk in self.ids[:4] for pk in self.ids])
+
+    def test_query_count(self):
+        # The same few queries for one location or thirty
+        with CaptureQueriesContext(connection) as one:
+            self.post({'location_ids': self.ids[:1]})
+        with CaptureQueriesContext(connection) as many:
+            self.post({'location_ids': self.ids})
+        self.assertEqual(len(many), len(one))
+        self.assertEqual(self.bookmarked(self.user), self.ids)
+
+    def test_invalid(self):
+        for body in ('not json', '[]', '{}', '{"location_ids": 5}', '{"location_ids": ["x"]}'):
+            with self.subTest(body=body):
+                response = self.client.post(reverse('bookmark_locations'), body, content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+        response = self.post({'location_ids': [self.ids[0], max(self.ids) + 1]})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.bookmarked(self.user), [])
+        self.assertEqual(self.client.get(reverse('bookmark_locations')).status_code, 405)
+
+
+class RequestTimingTests(TestCase):
+    """Per-request timings: a log line on `TDMS.requests`, and a `Server-Timing` header with the views' own spans."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = Account.objects.create_user('timing@example.com', 'pw', ssn='1')
+        Location.objects.create(lat=10.77, lng=106.69, name='Ben Thanh Market')
+
+    def setUp(self):
+        search_cache.cache.clear()
+        self.client.force_login(self.user)
+
+    def search(self):
+        with self.assertLogs('TDMS.requests', 'INFO') as logs:
+            response = self.client.get(reverse('search'), {'q': 'market'})
+        self.assertEqual(response.status_code, 200)
+        return response, json.loads(logs.records[-1].getMessage())
+
+    @override_settings(DEBUG=True)
+    def test_spans(self):
+        response, record = self.search()
+        self.assertEqual(record['view'], 'search')
+        self.assertIn('render', record['spans'])
+        names = [part.split(';')[0].strip() for part in response['Server-Timing'].split(',')]
+        self.assertEqual(names, ['db', 'view', 'render', 'total'])
+        # Served from the cache: nothing rendered
+        response, record = self.search()
+        self.assertNotIn('spans', record)
+        self.assertNotIn('render', response['Server-Timing'])
+
+    @override_settings(DEBUG=False)
+    def test_no_header_in_production(self):
+        response, record = self.search()
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertGreater(record['queries'], 0)
+        with override_settings(REQUEST_TIMING_HEADER=True):
+            self.assertTrue(self.search()[0].has_header('Server-Timing'))
+
+
+class MetricsTests(SimpleTestCase):
+    """Metrics added up over worker processes through the files in `METRICS_DIR`."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings_override = override_settings(METRICS_DIR=self.directory, METRICS_FLUSH_INTERVAL=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.registry = metrics.Registry()
+        self.requests = self.registry.counter('test_requests_total', 'Requests.', ('view',))
+        self.duration = self.registry.histogram('test_duration_seconds', 'Durations.', buckets=(0.1, 1))
+        self.queue = self.registry.gauge('test_queue_depth', 'Queue depth.')
+        self.queue.set_function(lambda: 1)
+        self.lookups = self.registry.counter('test_lookups_total', 'Lookups.', ('cache', 'result'))
+        self.ratio = self.registry.hit_ratio('test_hit_ratio', 'Hit ratio.', self.lookups)
+
+        # A process that has exited, and one still running
+        self.dead_pid = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                                       capture_output=True, text=True, check=True).stdout.strip()
+        self.live_pid = os.getppid()
+
+    def write_process(self, pid, started, requests=0, queue=0, durations=(0, 0, 0), hits=0):
+        metrics.write_json(os.path.join(self.directory, f'{pid}-{started}.json'), {'pid': int(pid), 'metrics': {
+            'test_requests_total': {'["search"]': requests},
+            'test_duration_seconds': {'[]': {'buckets': list(durations), 'sum': 0.5 * sum(durations), 'count': sum(durations)}},
+            'test_queue_depth': {'[]': queue},
+            'test_lookups_total': {'["search", "hit"]': hits, '["search", "miss"]': 1},
+        }})
+
+    def files(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_nothing_written_before_serving(self):
+        self.requests.inc(view='search')
+        self.registry.flush()
+        self.assertEqual(self.files(), [])
+        self.registry.flush_if_due()
+        self.assertEqual(len(self.files()), 1)
+        self.assertEqual(metrics.read_json(os.path.join(self.directory, self.files()[0]))['pid'], os.getpid())
+
+    def test_collect(self):
+        self.requests.inc(view='search')
+        self.duration.observe(0.05)
+        self.write_process(self.live_pid, 1, requests=2, queue=3, durations=(0, 1, 1), hits=1)
+        self.write_process(self.dead_pid, 2, requests=10, queue=5, durations=(1, 0, 0), hits=3)
+
+        collected = self.registry.collect()
+        self.assertEqual(collected['test_requests_total'], {'["search"]': 13})
+        # Only the running processes have a queue
+        self.assertEqual(collected['test_queue_depth'], {'[]': 1 + 3})
+        self.assertEqual(collected['test_duration_seconds']['[]']['buckets'], [2, 1, 1])
+        self.assertEqual(collected['test_duration_seconds']['[]']['count'], 4)
+        self.assertEqual(collected['test_hit_ratio'], {'["search"]': 4 / 6})
+
+        # The exited process was folded into the archive, and is counted once
+        self.assertEqual(self.files(), [f'{self.live_pid}-1.json', 'archive-1.json'])
+        self.assertEqual(self.registry.collect(), collected)
+
+        self.write_process(self.dead_pid, 3, requests=3)
+        collected = self.registry.collect()
+        self.assertEqual(collected['test_requests_total'], {'["search"]': 16})
+        self.assertEqual(self.files(), [f'{self.live_pid}-1.json', 'archive-2.json'])
+
+    def test_retired_file_not_counted_twice(self):
+        # A scrape reading while another one retires: the file is still there, but in the archive
+        self.write_process(self.live_pid, 1, requests=2)
+        metrics.write_json(os.path.join(self.directory, 'archive-1.json'), {
+            'pid': None, 'metrics': {'test_requests_total': {'["search"]': 2}}, 'retired': [f'{self.live_pid}-1.json']})
+        self.assertEqual(self.registry.collect()['test_requests_total'], {'["search"]': 2})
+
+    def test_retiring_locked(self):
+        self.write_process(self.dead_pid, 1, requests=2)
+        open(os.path.join(self.directory, 'retire.lock'), 'w').close()
+        self.assertEqual(self.registry.collect()['test_requests_total'], {'["search"]': 2})
+        self.assertIn(f'{self.dead_pid}-1.json', self.files())
+
+    def test_fork(self):
+        self.requests.inc(view='search')
+        # What the parent counted is not counted again by the child
+        self.registry._pid = -1
+        self.requests.inc(view='plans')
+        self.assertEqual(self.registry.collect()['test_requests_total'], {'["plans"]': 1})
+
+    def test_other_buckets_skipped(self):
+        self.duration.observe(2)
+        metrics.write_json(os.path.join(self.directory, f'{self.live_pid}-1.json'), {'pid': self.live_pid, 'metrics': {
+            'test_duration_seconds': {'[]': {'buckets': [1, 1], 'sum': 1, 'count': 2}}}})
+        self.assertEqual(self.registry.collect()['test_duration_seconds']['[]']['buckets'], [0, 0, 1])
+
+    def test_expose(self):
+        self.requests.inc(2, view='say "hi"\n')
+        self.duration.observe(0.5)
+        self.lookups.inc(cache='search', result='hit')
+        lines = self.registry.expose().splitlines()
+        for line in (
+            '# HELP test_requests_total Requests.',
+            '# TYPE test_requests_total counter',
+            r'test_requests_total{view="say \"hi\"\n"} 2',
+            '# TYPE test_duration_seconds histogram',
+            'test_duration_seconds_bucket{le="0.1"} 0',
+            'test_duration_seconds_bucket{le="1.0"} 1',
+            'test_duration_seconds_bucket{le="+Inf"} 1',
+            'test_duration_seconds_sum 0.5',
+            'test_duration_seconds_count 1',
+            'test_queue_depth 1',
+            '# TYPE test_hit_ratio gauge',
+            'test_hit_ratio{cache="search"} 1.0',
+        ):
+            self.assertIn(line, lines)
+
+    def test_view(self):
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('# TYPE tdms_request_duration_seconds histogram', response.content.decode())
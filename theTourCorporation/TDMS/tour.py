@@ -0,0 +1,120 @@
+import time
+
+import numpy as np
+
+from TDMS.spatial import haversine_distances
+
+IMPROVEMENT_EPSILON = 1e-6
+
+
+def tour_length(distances, order, round_trip=False):
+    order = np.asarray(order)
+    if len(order) < 2:
+        return 0.0
+    length = distances[order[:-1], order[1:]].sum()
+    if round_trip:
+        length += distances[order[-1], order[0]]
+    return float(length)
+
+
+def _nearest_neighbour(distances):
+    """Greedy tour from node 0, always visiting the closest unvisited node next."""
+    n = len(distances)
+    order = [0]
+    visited = np.zeros(n, dtype=bool)
+    visited[0] = True
+    for _ in range(n - 1):
+        candidates = np.where(visited, np.inf, distances[order[-1]])
+        nxt = int(np.argmin(candidates))
+        order.append(nxt)
+        visited[nxt] = True
+    return np.array(order)
+
+
+def _two_opt_pass(distances, tour, last, deadline):
+    """
+    Reverse segments of the cycle `tour` while that shortens it; every end `j` is tried at once
+    for each start `i`. Only positions 1 to `last` may move.
+    """
+    m = len(tour)
+    improved = False
+    for i in range(1, last):
+        if time.perf_counter() > deadline:
+            break
+        j = np.arange(i + 1, last + 1)
+        a, b = tour[i - 1], tour[i]
+        c, d = tour[j], tour[(j + 1) % m]
+        delta = distances[a, c] + distances[b, d] - distances[a, b] - distances[c, d]
+        best = int(np.argmin(delta))
+        if delta[best] < -IMPROVEMENT_EPSILON:
+            tour[i:j[best] + 1] = tour[i:j[best] + 1][::-1].copy()
+            improved = True
+    return improved
+
+
+def _or_opt_pass(distances, tour, last, deadline, max_segment=3):
+    """
+    Move runs of up to `max_segment` stops, possibly reversed, to their best position in the
+    cycle `tour`. Only positions 1 to `last` may move.
+    """
+    m = len(tour)
+    improved = False
+    for length in range(1, max_segment + 1):
+        i = 1
+        while i + length - 1 <= last:
+            if time.perf_counter() > deadline:
+                return improved
+            segment = tour[i:i + length]
+            prev, nxt = tour[i - 1], tour[(i + length) % m]
+            first, final = segment[0], segment[-1]
+            removal = distances[prev, first] + distances[final, nxt] - distances[prev, nxt]
+
+            # Candidate gaps are between rest[k] and rest[k + 1], up to the last movable one
+            rest = np.concatenate([tour[:i], tour[i + length:]])
+            gaps = last - length + 1 if last < m - 1 else len(rest)
+            left, right = rest[:gaps], np.roll(rest, -1)[:gaps]
+            forward = distances[left, first] + distances[final, right] - distances[left, right]
+            backward = distances[left, final] + distances[first, right] - distances[left, right]
+            # Inserting back between `prev` and `nxt` is the current tour
+            forward[i - 1] = backward[i - 1] = np.inf
+            k_forward, k_backward = int(np.argmin(forward)), int(np.argmin(backward))
+            if min(forward[k_forward], backward[k_backward]) - removal < -IMPROVEMENT_EPSILON:
+                if forward[k_forward] <= backward[k_backward]:
+                    k, moved = k_forward, segment
+                else:
+                    k, moved = k_backward, segment[::-1]
+                tour[:] = np.concatenate([rest[:k + 1], moved, rest[k + 1:]])
+                improved = True
+            else:
+                i += 1
+    return improved
+
+
+def optimize_order(coords, round_trip=False, time_limit=0.15):
+    """
+    Visiting order for `(lat, lng)` stops, starting from the first one, that shortens the trip:
+    nearest neighbour, then 2-opt and Or-opt moves until none helps or `time_limit` seconds pass.
+    Without `round_trip` the trip ends wherever is shortest.
+    Returns `(order, distance_matrix)`, distances in meters.
+    """
+    deadline = time.perf_counter() + time_limit
+    distances = haversine_distances(coords, coords)
+    n = len(distances)
+    if n < 3:
+        return np.arange(n), distances
+
+    tour = _nearest_neighbour(distances)
+    cycle, last = distances, n - 1
+    if not round_trip:
+        # An open path is a cycle closed by a dummy stop, at no cost, that never moves
+        cycle = np.zeros((n + 1, n + 1))
+        cycle[:n, :n] = distances
+        tour, last = np.append(tour, n), n - 1
+
+    while time.perf_counter() < deadline:
+        improved = _two_opt_pass(cycle, tour, last, deadline)
+        improved |= _or_opt_pass(cycle, tour, last, deadline)
+        if not improved:
+            break
+
+    return tour[:n], distances
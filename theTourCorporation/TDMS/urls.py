@@ -18,12 +18,18 @@ urlpatterns = [
     # Location (db)
     path('TDMS/lookup_loc', views.display_locations, name='lookup_loc'),
     path('TDMS/search', views.search, name='search'),
+    path('TDMS/search_cache_stats', views.search_cache_stats, name='search_cache_stats'),
+    path('metrics', views.metrics, name='metrics'),
+    path('TDMS/locations_in_view', views.locations_in_view, name='locations_in_view'),
+    path('TDMS/locations_near', views.locations_near, name='locations_near'),
+    path('TDMS/locations_in_bbox', views.locations_in_bbox, name='locations_in_bbox'),
     path('TDMS/delete_location/<int:location_id>/', views.delete_location, name='delete_location'),
     path('TDMS/edit_location/<int:location_id>/', views.edit_location, name='edit_location'),
     path('TDMS/get_location_name', views.get_location_name, name='get_location_name'),
 
     # bookmark
     path('TDMS/bookmark_location', views.bookmark_location, name='bookmark_location'),
+    path('TDMS/bookmark_locations', views.bookmark_locations, name='bookmark_locations'),
     
     # note
     path('TDMS/fetch_notes', views.fetch_notes, name='fetch_notes'),
@@ -35,13 +41,19 @@ urlpatterns = [
     path('TDMS/planner/<int:id>/', views.planner, name='planner'),
     path('TDMS/save_route', views.save_route, name='save_route'),
     path('TDMS/planner/<int:id>/save_route', views.save_route, name='save_route'),
+    path('TDMS/optimize_route', views.optimize_route, name='optimize_route'),
+    path('TDMS/planner/<int:id>/optimize_route', views.optimize_route, name='optimize_route'),
     path('TDMS/view_plans', views.view_plans, name='view_plans'),
+    path('TDMS/get_plans', views.get_plans, name='get_plans'),
+    path('TDMS/export_plans', views.export_plans, name='export_plans'),
+    path('TDMS/export_locations', views.export_locations, name='export_locations'),
     path('TDMS/get_plan_route/<int:plan_id>/', views.get_plan_route, name='get_plan_route'),
     path('TDMS/delete_route/<int:plan_id>/', views.delete_route, name='delete_route'),
     path('TDMS/update_plan_status/<int:plan_id>/', views.update_plan_status, name='update_plan_status'),
     
     # Logs
     path('TDMS/view_logs', views.view_logs, name='view_logs'),
+    path('TDMS/get_logs', views.get_logs, name='get_logs'),
     
     # Password reset
     path('reset/<uidb64>/<token>/', auth_views.PasswordResetConfirmView.as_view(template_name='password_reset_confirm.html'), name='password_reset_confirm'),
@@ -1,10 +1,12 @@
 import json
+import time
 
-from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_http_methods
 
 from django.shortcuts import get_object_or_404, render, redirect
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
@@ -14,7 +16,8 @@ from django.db.models import Q
 from django.core import serializers
 from django.core.serializers.json import DjangoJSONEncoder
 
-from django.views.decorators.http import require_POST, require_GET
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_POST, require_GET
 
 
 from django.contrib.auth.tokens import default_token_generator
@@ -25,9 +28,15 @@ from django.urls import reverse
 from django.core.mail import EmailMessage
 from django.utils.encoding import force_bytes
 
-from TDMS.forms import RegistrationForm, LoginForm, EditLocationForm, PasswordResetForm
+from TDMS.forms import RegistrationForm, LoginForm, EditLocationForm, PasswordResetForm, LogFilterForm, PlanFilterForm
 
-from TDMS.models import Account, Bookmark, Location, Note, Plan, ROLE, Log, STATUS
+from TDMS.audit import log_sink
+from TDMS.cache import LOCATIONS_VERSION, bookmarks_version, search_cache
+from TDMS.exports import FORMATS
+from TDMS.metrics import email_duration, registry
+from TDMS.middleware import timing_span
+from TDMS.models import Account, Bookmark, Location, Note, Plan, ROLE, ROUTE_FORMAT, Log, STATUS
+from TDMS.pagination import InvalidCursor, parse_page_size
 
 JSON_INSUFFICIENT_PERMISSION = {'status': 'error', 'error': 'Insufficient permissions'}
 
@@ -48,8 +57,7 @@ def json_return_error_status(model=None, action=None, error_code=None):
 def create_logout_log(user):
     """Create a logout log for the given user."""
     new_log = Log.create_logout_log(user)
-    new_log.save()
-    print(new_log)
+    log_sink.add(new_log)
 
 @login_required(login_url='home')
 def logout_view(request):
@@ -71,8 +79,7 @@ def authenticate_user(request, form):
 def create_login_log(user):
     """Create a login log for the given user."""
     new_log = Log.create_login_log(user)
-    new_log.save()
-    print(new_log)
+    log_sink.add(new_log)
 
 def login_view(request): 
     form = LoginForm(request.POST or None)
@@ -128,7 +135,7 @@ def account_create_view(request):
         to_email = form.cleaned_data.get('email')
         uid = urlsafe_base64_encode(force_bytes(user.pk))
         email = create_activate_acc_email(request, user, to_email, uid, token)
-        print(email.send())
+        send_email(email)
         return HttpResponse(f'Email is sent to {to_email}. <a href="TDMS/home">Return to home</a>')
     return render(request, 'register.html', {'form': form})
 
@@ -144,6 +151,17 @@ def create_pass_reset_email(request, user, to_email, uid, token):
     email = EmailMessage(mail_subject, message, to=[to_email])
     return email
 
+def send_email(email):
+    """`email.send()`, timed for `TDMS.metrics`."""
+    start = time.perf_counter()
+    result = 'failed'
+    try:
+        sent = email.send()
+        result = 'sent'
+        return sent
+    finally:
+        email_duration.observe(time.perf_counter() - start, result=result)
+
 def password_reset_view(request):
     form = PasswordResetForm(request.POST or None)
     if form.is_valid():
@@ -157,7 +175,7 @@ def password_reset_view(request):
             token = default_token_generator.make_token(user)
             uid = urlsafe_base64_encode(force_bytes(user.pk))
             email = create_pass_reset_email(request, user, to_email, uid, token)
-            email.send()
+            send_email(email)
             return HttpResponse(f'Email is sent to {user.email}. <a href="TDMS/home">Return to home</a>')
     else:
         form = PasswordResetForm()
@@ -167,8 +185,7 @@ def password_reset_view(request):
 def create_add_loc_log(user, location):
     """Create an add location log for the given user and new location."""
     new_log = Log.create_add_loc_log(user, location)
-    new_log.save()
-    print(new_log)
+    log_sink.add(new_log)
 
 @login_required(login_url='home')
 def add_loc_view(request):
@@ -187,34 +204,145 @@ def add_loc_view(request):
 def display_locations(request):   
     return render(request, 'lookup_loc.html', {'current_user': request.user})
 
-@login_required(login_url='home')
-def search(request):
+def search_cache_key(request):
+    """Search cache key of `request`: `(versions, parts)` for `search_cache`."""
     query = request.GET.get('q', '')
+    versions = [LOCATIONS_VERSION, bookmarks_version(request.user.pk)]
+    if 'cursor' in request.GET or 'page_size' in request.GET:
+        return versions, ('page', request.user.pk, query, request.GET.get('cursor'), parse_page_size(request.GET.get('page_size')))
     n = request.GET.get('n')
     try:
         n = int(n)
     except (TypeError, ValueError):
         n = None
+    return versions, ('list', request.user.pk, query, n)
+
+def search_key(request):
+    """`search_cache` key of `request`, built once per request: it reads the shared version counters."""
+    if not hasattr(request, 'search_key'):
+        request.search_key = search_cache.key(*search_cache_key(request))
+    return request.search_key
 
-    data = Location.get_list_loc_w_bookmark(request.user, n, query, True)
+def render_search(request, results):
+    """Encoded `results()`, on a cache miss; the time it takes shows as the `render` timing span."""
+    with timing_span(request, 'render'):
+        return json.dumps(results(), cls=DjangoJSONEncoder)
+
+def search_etag(request):
+    # The cache key changes whenever the cached response would, so it doubles as an ETag
+    return search_key(request)
+
+@login_required(login_url='home')
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=search_etag)
+def search(request):
+    versions, parts = search_cache_key(request)
+    if parts[0] == 'page':
+        return search_page(request, versions, parts)
+    _, _, query, n = parts
+
+    # Cached as the encoded response, until a location or one of the user's bookmarks changes
+    content = search_cache.get_or_set(
+        versions, parts,
+        lambda: render_search(request, lambda: Location.get_list_loc_w_bookmark(request.user, n, query, True)),
+        key=search_key(request))
  
-    return JsonResponse(data, safe=False, encoder=DjangoJSONEncoder)
+    return HttpResponse(content, content_type='application/json')
+
+def search_page(request, versions, parts):
+    """Cursor-paginated search: `{'results': [...], 'next_cursor': token or null}`."""
+    _, _, query, cursor, page_size = parts
+
+    def page():
+        data, next_cursor = Location.get_page_loc_w_bookmark(request.user, query, cursor=cursor, page_size=page_size)
+        return {'results': data, 'next_cursor': next_cursor}
+
+    try:
+        content = search_cache.get_or_set(versions, parts, lambda: render_search(request, page), key=search_key(request))
+    except InvalidCursor:
+        return JsonResponse(json_return_error_status("Cursor", "is invalid", 400), status=400)
+
+    return HttpResponse(content, content_type='application/json')
+
+@login_required(login_url='home')
+@require_GET
+def search_cache_stats(request):
+    """Hit rate of the search cache in this process."""
+    if not request.user.can_modify():
+        return JsonResponse(JSON_INSUFFICIENT_PERMISSION)
+    return JsonResponse(search_cache.stats())
+
+@require_GET
+def metrics(request):
+    """Metrics of every worker process in the Prometheus text format, for local scrapers only."""
+    if request.META.get('REMOTE_ADDR') not in getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1', '::1']):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.expose(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@login_required(login_url='home')
+@require_GET
+def locations_in_view(request):
+    """
+    Locations and clusters inside the map viewport, for `?bbox=west,south,east,north&zoom=z`
+    (the order of Leaflet's `toBBoxString()`).
+    """
+    try:
+        west, south, east, north = [float(value) for value in request.GET['bbox'].split(',')]
+        zoom = int(request.GET['zoom'])
+    except (KeyError, ValueError):
+        return JsonResponse(json_return_error_status("Viewport", "is invalid", 400), status=400)
+    data = Location.get_in_view(request.user, south, west, north, east, zoom)
+    if data is None:
+        return JsonResponse(json_return_error_status("Viewport", "is too large for the zoom", 400), status=400)
+    return JsonResponse(data, encoder=DjangoJSONEncoder)
+
+def location_query_options(request):
+    """`location_type` and result `limit` shared by the spatial query endpoints."""
+    return request.GET.get('type') or None, parse_page_size(request.GET.get('limit'))
+
+@login_required(login_url='home')
+@require_GET
+def locations_near(request):
+    """Locations within `?radius=` meters of `?lat=&lng=`, closest first, optionally of one `?type=`."""
+    try:
+        lat, lng, radius = float(request.GET['lat']), float(request.GET['lng']), float(request.GET['radius'])
+    except (KeyError, ValueError):
+        return JsonResponse(json_return_error_status("Point or radius", "is invalid", 400), status=400)
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180 and radius >= 0):
+        return JsonResponse(json_return_error_status("Point or radius", "is out of range", 400), status=400)
+    location_type, limit = location_query_options(request)
+    data = Location.get_within_radius(request.user, lat, lng, radius, location_type, limit)
+    return JsonResponse({'results': data}, encoder=DjangoJSONEncoder)
+
+@login_required(login_url='home')
+@require_GET
+def locations_in_bbox(request):
+    """
+    Locations inside `?bbox=west,south,east,north`, optionally of one `?type=`.
+    With `?lat=&lng=` the closest ones to that point come first.
+    """
+    try:
+        west, south, east, north = [float(value) for value in request.GET['bbox'].split(',')]
+        center = None
+        if 'lat' in request.GET or 'lng' in request.GET:
+            center = (float(request.GET['lat']), float(request.GET['lng']))
+    except (KeyError, ValueError):
+        return JsonResponse(json_return_error_status("Box or point", "is invalid", 400), status=400)
+    location_type, limit = location_query_options(request)
+    data = Location.get_in_bbox(request.user, south, west, north, east, location_type, center, limit)
+    return JsonResponse({'results': data}, encoder=DjangoJSONEncoder)
 
 def get_location_name(request):
     data = json.loads(request.body)
-    location_names = []
-    for coord in data:
-        lat = coord['lat']
-        lng = coord['lng']
+    coords = [(coord['lat'], coord['lng']) for coord in data]
 
-        # Find the nearest location to the given coordinates
-        location = Location.get_nearest(lat, lng)
+    # Find the nearest location to every given coordinate at once
+    locations = Location.get_nearest_many(coords)
 
-        if location is None:
-            location_names.append(f"({lat}, {lng})")
-        else:
-            # Add the location name to the list
-            location_names.append(location.name)
+    location_names = [
+        f"({lat}, {lng})" if location is None else location.name
+        for (lat, lng), location in zip(coords, locations)
+    ]
 
     # Return the location names as a JSON response
     return JsonResponse({'names': location_names})
@@ -233,8 +361,7 @@ def create_edit_loc_log(user, location, field, old_val, new_val):
         old_value=old_val, 
         new_value=new_val
     )
-    new_log.save()
-    print(new_log)
+    log_sink.add(new_log)
 
 def process_edit_location_form_log(user, location, form, old_name, old_addr):
     new_name = form.cleaned_data.get('name')
@@ -293,14 +420,46 @@ def bookmark_location(request):
         
     return JsonResponse({'bookmarked': created})
 
+@login_required(login_url='home')
+@require_POST
+def bookmark_locations(request):
+    """Bookmark (`bookmarked: true`) or unbookmark every location in `location_ids` at once."""
+    try:
+        data = json.loads(request.body)
+        location_ids = {int(location_id) for location_id in data['location_ids']}
+        bookmarked = bool(data.get('bookmarked', True))
+    except (ValueError, TypeError, KeyError):
+        return JsonResponse(json_return_error_status("Location list", "is invalid", 400), status=400)
+    if Location.objects.filter(pk__in=location_ids).count() != len(location_ids):
+        return JsonResponse(json_return_error_status("Location", "not found", 404), status=404)
+    changed = Bookmark.set_many(request.user, sorted(location_ids), bookmarked)
+    return JsonResponse({'bookmarked': bookmarked, 'changed': changed})
+
+def notes_etag(request):
+    try:
+        return Note.get_notes_etag(int(request.GET.get('location_id')))
+    except (TypeError, ValueError):
+        return None
+
 @login_required(login_url='home')
 @require_GET
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=notes_etag)
 def fetch_notes(request):
-    data = json.dumps(
-        Note.get_note_list_by_loc_id(request.GET.get('location_id')),
-        cls=DjangoJSONEncoder)
+    """Cursor-paginated notes of `?location_id=`: `{'results': [...], 'next_cursor': token or null}`."""
+    try:
+        page = Note.get_note_page(
+            int(request.GET.get('location_id')),
+            cursor=request.GET.get('cursor'),
+            page_size=parse_page_size(request.GET.get('page_size')))
+    except (TypeError, ValueError):
+        # InvalidCursor is a ValueError too
+        return JsonResponse(json_return_error_status("Location or cursor", "is invalid", 400), status=400)
+    if page is None:
+        return JsonResponse(json_return_error_status("Location", "not found", 404), status=404)
 
-    return JsonResponse(data, safe=False)
+    notes, next_cursor = page
+    return JsonResponse({'results': notes, 'next_cursor': next_cursor}, encoder=DjangoJSONEncoder)
 
 @login_required(login_url='home')
 @require_POST
@@ -315,15 +474,31 @@ def add_note(request):
         return JsonResponse(json_return_success_status("Note", "added")) 
     return JsonResponse(json_return_error_status("Location", "not found")) 
 
-def edit_planner(request, id, data):
+@login_required(login_url='home')
+@require_POST
+def optimize_route(request, id=None):
+    """Reorder `location_ids` (the first one stays the start) to shorten the trip."""
+    try:
+        data = json.loads(request.body)
+        location_ids = data['location_ids']
+        with timing_span(request, 'optimize'):
+            order = Location.get_visit_order(location_ids, bool(data.get('round_trip', False)))
+    except (ValueError, TypeError, KeyError):
+        return JsonResponse(json_return_error_status("Location list", "is invalid", 400), status=400)
+    if order is None:
+        return JsonResponse(json_return_error_status("Location", "not found", 404), status=404)
+    return JsonResponse({'status': 'success', **order})
+
+def edit_planner(request, id):
     plan = Plan.objects.get(pk=id)
     waypoints = plan.route_data[0]['waypoints']
     waypoint_coords = [(waypoint['latLng']['lat'], waypoint['latLng']['lng']) for waypoint in waypoints]
     locations_waypoints = []
-    for lat, lng in waypoint_coords:
-        found_location = Location.get_nearest(lat, lng)
+    found_locations = []
+    for (lat, lng), found_location in zip(waypoint_coords, Location.get_nearest_many(waypoint_coords)):
         if found_location:
             locations_waypoints.append((found_location.location_id, 1))
+            found_locations.append(found_location.location_id)
         else:
             locations_waypoints.append(((lat, lng), -1))
     refill_data = {
@@ -332,20 +507,20 @@ def edit_planner(request, id, data):
         "location_waypoints": locations_waypoints
     }
     refill_data = json.dumps(refill_data, cls=DjangoJSONEncoder)
+    # Only the plan's own locations are embedded, the rest is loaded per viewport
+    locations = Location.annotate_bookmarks(Location.objects.filter(pk__in=found_locations), request.user)
+    data = json.dumps([location.serialize(request.user) for location in locations], cls=DjangoJSONEncoder)
     return render(request, 'planner.html', {'locations_json': data, 'current_user': request.user, 'refill_data': refill_data})
     
 
 @login_required(login_url='home')
 def planner(request, id=None):
-    data = json.dumps(
-            Location.get_list_loc_w_bookmark(request.user, None, '', True),
-            cls=DjangoJSONEncoder)
     if id is None:
-        return render(request, 'planner.html', {'locations_json': data, 'current_user': request.user})
+        return render(request, 'planner.html', {'locations_json': '[]', 'current_user': request.user})
     else:
         plan = Plan.objects.get(pk=id)
         if plan.can_be_edited():
-            return edit_planner(request, id, data)
+            return edit_planner(request, id)
         return JsonResponse(json_return_error_status("Plan", "is completed, cannot be edited", 400))
         
 def save_edit_route(request, plan, data):
@@ -360,13 +535,11 @@ def save_edit_route(request, plan, data):
 
 def create_edit_plan_log(user, plan):
     new_log = Log.create_edit_plan_log(user, plan)
-    new_log.save()
-    print(new_log)
+    log_sink.add(new_log)
     
 def create_plan_log(user, plan):
     new_log = Log.create_plan_log(user, plan)
-    new_log.save()
-    print(new_log)
+    log_sink.add(new_log)
     
 @login_required(login_url='home')
 def save_route(request, id=None):
@@ -379,27 +552,93 @@ def save_route(request, id=None):
                 create_plan_log(request.user, plan)
                 return JsonResponse(json_return_success_status("Plan", "created"))
         else:   # updating existing plan
-            # print(data)
-            save_edit_route(request, id, data)            
-            return JsonResponse(json_return_success_status("Plan", "edited"))
+            plan = get_object_or_404(Plan, pk=id)
+            return save_edit_route(request, plan, data)
         return JsonResponse(json_return_error_status())
     return JsonResponse(json_return_error_status("Request method", "invalid"))
 
+def get_filtered_plan_page(request):
+    """Filter form and keyset page of plan summaries for the `GET` parameters of `request`."""
+    form = PlanFilterForm(request.GET or None)
+    filters = form.cleaned_data if form.is_valid() else {}
+    plans, next_cursor = Plan.get_plan_page(
+        filters,
+        cursor=request.GET.get('cursor'),
+        page_size=parse_page_size(request.GET.get('page_size')))
+    return form, plans, next_cursor
+
 @login_required(login_url='home')
-def view_plans(request):      
+def view_plans(request):
+    try:
+        form, plans, next_cursor = get_filtered_plan_page(request)
+    except InvalidCursor:
+        return redirect('view_plans')
     return render(request, 'view_plans.html', {
-        'plans_json': json.dumps(Plan.get_plans()), 
+        'form': form,
+        'plans_json': json.dumps(plans, cls=DjangoJSONEncoder),
+        'next_cursor': next_cursor or '',
         'current_user': request.user
         })
 
 @login_required(login_url='home')
+@require_GET
+def get_plans(request):
+    """Cursor-paginated plan summaries as JSON: `{'results': [...], 'next_cursor': token or null}`."""
+    try:
+        form, plans, next_cursor = get_filtered_plan_page(request)
+    except InvalidCursor:
+        return JsonResponse(json_return_error_status("Cursor", "is invalid", 400), status=400)
+    if form.errors:
+        return JsonResponse({'status': 400, 'error': form.errors}, status=400)
+
+    return JsonResponse({'results': plans, 'next_cursor': next_cursor}, encoder=DjangoJSONEncoder)
+
+def streaming_export(lines, name, file_format):
+    response = StreamingHttpResponse(lines, content_type=FORMATS[file_format])
+    response['Content-Disposition'] = f'attachment; filename="{name}.{file_format}"'
+    return response
+
+@login_required(login_url='home')
+@require_GET
+def export_locations(request):
+    """Every location, streamed as `?format=geojson` (default) or `csv`."""
+    file_format = request.GET.get('format', 'geojson')
+    if file_format not in FORMATS:
+        return JsonResponse(json_return_error_status("Format", "is invalid", 400), status=400)
+    return streaming_export(Location.export(file_format), 'locations', file_format)
+
+@login_required(login_url='home')
+@require_GET
+def export_plans(request):
+    """Plan summaries matching the `view_plans` filters, streamed as `?format=csv` (default) or `geojson`."""
+    file_format = request.GET.get('format', 'csv')
+    form = PlanFilterForm(request.GET)
+    if file_format not in FORMATS:
+        return JsonResponse(json_return_error_status("Format", "is invalid", 400), status=400)
+    if not form.is_valid():
+        return JsonResponse({'status': 400, 'error': form.errors}, status=400)
+    return streaming_export(Plan.export(file_format, form.cleaned_data), 'plans', file_format)
+
+def plan_route_etag(request, plan_id):
+    return Plan.get_route_etag(plan_id)
+
+@login_required(login_url='home')
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=plan_route_etag)
 def get_plan_route(request, plan_id):
-    return JsonResponse(Plan.get_plan_data_by_id(plan_id))
+    # Older clients can ask for `?format=verbose` to get Leaflet `coordinates` lists back
+    verbose = request.GET.get('format') == ROUTE_FORMAT.VERBOSE
+    # Overview maps pass their `zoom` (or a `tolerance` in meters) to get a simplified line
+    try:
+        zoom = float(request.GET['zoom']) if 'zoom' in request.GET else None
+        tolerance = float(request.GET['tolerance']) if 'tolerance' in request.GET else None
+    except ValueError:
+        return JsonResponse(json_return_error_status("Zoom or tolerance", "is invalid", 400), status=400)
+    return JsonResponse(Plan.get_plan_data_by_id(plan_id, verbose, tolerance, zoom))
 
 def create_update_plan_status_log(user, plan, old_status, new_status):
     new_log = Log.create_update_plan_status_log(user, plan, old_status, new_status)
-    new_log.save()
-    print(new_log)
+    log_sink.add(new_log)
 
 def update_plan_status(request, plan_id):
     if request.method == 'POST':
@@ -420,7 +659,7 @@ def update_plan_status(request, plan_id):
 
         # Update the status
         plan.status = new_status
-        plan.save()
+        plan.save(update_fields=['status', 'updated_at'])
 
         # Log the change
         create_update_plan_status_log(request.user, plan, old_status, new_status)
@@ -469,8 +708,7 @@ def delete_object(request, obj_id, model):
                 obj=obj,
                 obj_type=model.__name__
             )
-            new_log.save()
-            print(new_log)
+            log_sink.add(new_log)
             obj.delete()
             
             return JsonResponse({'status': 'success'})
@@ -480,7 +718,48 @@ def delete_object(request, obj_id, model):
         # return JsonResponse({'status': 'error', 'error': f'{model.__name__} not found'})
         return JsonResponse(json_return_error_status(model.__name__, "not found"))
     
+def get_filtered_log_page(request):
+    """Filter form and keyset page of logs for the `GET` parameters of `request`."""
+    form = LogFilterForm(request.GET or None)
+    filters = form.cleaned_data if form.is_valid() else {}
+    logs, next_cursor = Log.get_log_page(
+        filters,
+        cursor=request.GET.get('cursor'),
+        page_size=parse_page_size(request.GET.get('page_size')))
+    return form, logs, next_cursor
+
 @login_required(login_url='home')
 def view_logs(request):
-    logs = Log.objects.all().order_by('-timestamp')
-    return render(request, 'view_logs.html', {'logs': logs})
\ No newline at end of file
+    try:
+        form, logs, next_cursor = get_filtered_log_page(request)
+    except InvalidCursor:
+        return redirect('view_logs')
+
+    next_page = None
+    if next_cursor is not None:
+        query = request.GET.copy()
+        query['cursor'] = next_cursor
+        next_page = f'?{query.urlencode()}'
+    first_page = request.GET.copy()
+    first_page.pop('cursor', None)
+
+    return render(request, 'view_logs.html', {
+        'form': form,
+        'logs': logs,
+        'next_page': next_page,
+        'first_page': f'?{first_page.urlencode()}',
+        'is_first_page': 'cursor' not in request.GET,
+    })
+
+@login_required(login_url='home')
+@require_GET
+def get_logs(request):
+    """Cursor-paginated logs as JSON: `{'results': [...], 'next_cursor': token or null}`."""
+    try:
+        form, logs, next_cursor = get_filtered_log_page(request)
+    except InvalidCursor:
+        return JsonResponse(json_return_error_status("Cursor", "is invalid", 400), status=400)
+    if form.errors:
+        return JsonResponse({'status': 400, 'error': form.errors}, status=400)
+
+    return JsonResponse({'results': [log.serialize() for log in logs], 'next_cursor': next_cursor}, encoder=DjangoJSONEncoder)
\ No newline at end of file
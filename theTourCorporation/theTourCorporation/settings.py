@@ -36,6 +36,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'TDMS.middleware.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -43,6 +44,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'TDMS.middleware.AuditLogMiddleware',
 ]
 
 ROOT_URLCONF = 'theTourCorporation.urls'
@@ -132,4 +134,92 @@ EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 EMAIL_HOST_USER = gmail_app_email
 EMAIL_HOST_PASSWORD = gmail_app_password  
-DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
\ No newline at end of file
+DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
+
+# Nearest-location lookups (TDMS.spatial)
+SPATIAL_INDEX_REBUILD_THRESHOLD = 256   # buffered edits before the tree is recompacted
+SPATIAL_INDEX_SYNC_INTERVAL = 5.0       # seconds between checks for changes made by other processes
+
+# Audit log writes (TDMS.audit)
+AUDIT_LOG_STRICT = False        # True saves every Log row inside its request instead of queueing it for a batched write
+AUDIT_LOG_BATCH_SIZE = 100      # queued rows that force an immediate bulk insert
+AUDIT_LOG_FLUSH_INTERVAL = 0.0  # seconds a row may wait; 0 writes after every response
+
+# Server-side checks of the route estimates sent by the planner (Plan.checked_estimates)
+ROUTE_DISTANCE_TOLERANCE = 0.05      # relative difference to the measured route length that is accepted
+ROUTE_SPEED_RANGE_KMH = (2, 130)     # plausible average speeds for a client's duration
+ROUTE_DEFAULT_SPEED_KMH = 40         # used to derive a duration when the client's one is implausible
+
+# Waypoint order optimization (TDMS.tour)
+TOUR_OPTIMIZATION_TIME_LIMIT = 0.15  # seconds of 2-opt/Or-opt search per request
+
+# Streaming exports (TDMS.exports)
+EXPORT_CHUNK_SIZE = 2000  # rows fetched per database round trip
+
+# Map viewport clustering (Location.get_in_view)
+LOCATION_CLUSTER_CELL_PIXELS = 60  # screen size of a cluster cell
+LOCATION_CLUSTER_MIN_COUNT = 2  # fewer locations in a cell are sent one by one
+LOCATION_CLUSTER_MAX_ZOOM = 16  # from this zoom on, every location is sent
+LOCATION_VIEW_MAX_LOCATIONS = 1000  # locations sent for one viewport; more are clustered, then left out
+LOCATION_VIEW_MAX_PIXELS = 8192  # boxes wider or taller than this on screen at their zoom are refused
+
+# Geohash lookups, used instead of the spatial index until a process has built it
+GEOHASH_LOOKUP_MAX_POINTS = 32  # more points at once build the index
+GEOHASH_LOOKUP_MAX_RADIUS = 5000  # meters; larger circles build the index
+
+# Search result cache (TDMS.cache). Entries are culled past MAX_ENTRIES and may stay per
+# process; the version counters that invalidate them must be shared by every worker process,
+# so they live in a database cache (create its table with `manage.py createcachetable`).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'search': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'tdms-search',
+        'TIMEOUT': 300,
+        'OPTIONS': {'MAX_ENTRIES': 5000, 'CULL_FREQUENCY': 4},
+    },
+    'search_versions': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'tdms_cache_versions',
+        'TIMEOUT': None,
+        # One counter per user with bookmarks, plus one for all locations
+        'OPTIONS': {'MAX_ENTRIES': 1000000},
+    },
+}
+SEARCH_CACHE_ALIAS = 'search'
+SEARCH_CACHE_VERSION_ALIAS = 'search_versions'
+SEARCH_CACHE_TIMEOUT = 300  # seconds
+BOOKMARK_IDS_INLINE_MAX = 500  # a user's cached bookmark IDs written into listing queries; more read the bookmark table
+
+# Per-request SQL and timing reports (TDMS.middleware.RequestTimingMiddleware)
+REQUEST_TIMING_SLOW_VIEW_MS = 500  # views slower than this are logged as warnings
+REQUEST_TIMING_SLOW_VIEWS_MS = {  # per-view thresholds, by URL name
+    'planner': 300,
+    'get_location_name': 200,
+}
+REQUEST_TIMING_REPEATED_QUERY_LIMIT = 10  # the same statement run more often is flagged as a likely N+1
+REQUEST_TIMING_SLOWEST_QUERIES = 3  # statements listed in each log line
+REQUEST_TIMING_HEADER = False  # send the Server-Timing header with DEBUG off too
+
+# Metrics exposed at /metrics (TDMS.metrics). With several worker processes, set METRICS_DIR to a
+# directory of this deployment's own, e.g. BASE_DIR / 'metrics': each worker writes its values to a
+# file there, which the endpoint adds up; empty it when the server starts. None reports only the
+# values of the process that answers the scrape.
+METRICS_DIR = None
+METRICS_FLUSH_INTERVAL = 1.0  # seconds between writes of a process's file
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']  # clients allowed to scrape
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'TDMS': {'handlers': ['console'], 'level': 'INFO'},
+        # A line per request (TDMS.middleware); WARNING keeps only slow views and N+1 patterns, e.g. for tests
+        'TDMS.requests': {'level': 'INFO'},
+    },
+}
@@ -0,0 +1,18 @@
+"""
+Settings for `manage.py benchmark`: the project settings on a local SQLite file,
+so seeding synthetic data never touches the PostgreSQL database.
+
+    python manage.py benchmark --settings=theTourCorporation.settings_benchmark
+"""
+
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR
+
+DEBUG = False
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'benchmark.sqlite3',
+    }
+}